@@ -23,11 +23,11 @@ as well as groups for team formation.
 """
 
 import random
-import threading
 import numpy as np
-import time
 
 from configuration import Configuration
+from arrayengine import EngineField
+from clientmux import Reply, All
 
 class Actor(object):
   """Base class for actions required to play Team Formation .
@@ -35,6 +35,7 @@ class Actor(object):
   skills = []
   gsize = 0
   idcounter = 0
+  _engine = None    # ArrayEngine this object is bound to, if any
   def propose(self):
     """Should look at n.group for n in neighbors, and call
        n.group.takeapplication() to make any desired proposals"""
@@ -96,7 +97,8 @@ class UltAgent(object):
   def fake_wait(self):
     """Sleep to simulate time to decide, based on cfg.delay_sim_agents"""
     if Configuration.delay_sim_agents:
-      time.sleep(max(random.gauss(self.delaymean, self.delaysd), 0))
+      self.cfg._clock.sleep(max(random.gauss(self.delaymean, self.delaysd), 0),
+                            self.id, 'ultimatum')
 
   def ultimatum(self, other_player):
     """Notify this agent that they are playing Ultimatum with other_player."""
@@ -181,7 +183,12 @@ class Agent(Actor):
     slow: boolean; does this agent take time (seconds) to make decisions?
     dumb: boolean; does this agent always decide randomly?
     type: 'sim' or 'human'
+  
+  nowpay and switches are stored in an ArrayEngine when one is in use.
   """
+  nowpay = EngineField('nowpay', 'nowpay')
+  switches = EngineField('switches', 'switches')
+  
   def __init__(self, cfg, adat=None, skills=None, aid=None):
     self.cfg = cfg
     if adat is None:
@@ -226,9 +233,9 @@ class Agent(Actor):
     #s = [1]*lev + [0]*(nskills-lev)
     skills = np.zeros(nskills, dtype='int')
     for _ in range(lev):
-      skills[random.choice(nskills)] += 1
+      skills[random.randrange(nskills)] += 1
     #random.shuffle(s)
-    self.skills = skills
+    self.skills[:] = skills   # in place, in case skills is an ArrayEngine view
   
   def randbiases(self):
     """Assign bias to each neighbor edge randomly"""
@@ -248,6 +255,10 @@ class Agent(Actor):
     
   def nowpaycalc(self, pay, addagent=-1, delagent=-1):
     """Calculate current utility taking into account opinions of neighbors"""
+    if addagent == -1 and delagent == -1 and self.id in self.group.biassums:
+      # Current group: use the group's cached bias sum
+      gsize = self.group.gsize
+      return pay/gsize*self.group.biassums[self.id]/gsize
     alist = [a.id for a in self.group.agents if a.id != delagent]
     if addagent != -1:
       alist += [addagent]
@@ -415,7 +426,19 @@ class Group(Actor):
     gsize: number of members ( len(self.agents) )
     slow: boolean; one or more agents take real time to make decisions
     nowpay: pay of each individual agent in the group
+    worth: sum of the worth of all members
+    nslow: number of slow members
+    biassums: agent ID -> sum of that member's bias toward all members
+              (only kept if cfg.bias is set)
+    biastotal: sum of biassums
+  
+  worth, gsize, nslow and the bias sums are updated incrementally by add 
+  and remove; recalc() rebuilds them from scratch.
+  
+  skills, gsize and nowpay are stored in an ArrayEngine when one is in use.
   """
+  gsize = EngineField('gsize', 'gsize')
+  nowpay = EngineField('nowpay', 'gnowpay')
   
   def __init__(self, gid, cfg):
     self.id = gid
@@ -428,23 +451,57 @@ class Group(Actor):
     self.gsize = 0
     self.nowpay = 0
     self.worth = 0
+    self.nslow = 0
+    self.biassums = {}
+    self.biastotal = 0.0
     self.slow = False
     
   def update(self):
-    """ Update all cached values, including gsize, slow, and nowpay"""
-    self.worth = sum(a.worth for a in self.agents)
-    self.gsize = len(self.agents)
-    self.slow = any(a.slow for a in self.agents)
+    """ Update slow and nowpay from the cached group aggregates"""
+    if self.cfg._debug_group_cache:
+      self.checkcache()
+    self.slow = self.nslow > 0
     try:
       if self.cfg.bias:
+        # Mean over members of nowpaycalc(), which is 
+        #   pay/gsize * (biassum/gsize)  for each member
         nowearns = self.cfg.task(self.skills)
-        self.nowpay = sum(a.nowpaycalc(nowearns) for a in self.agents)
-        self.nowpay /= self.gsize
+        self.nowpay = nowearns*self.biastotal/self.gsize**3
       else:
         self.nowpay = self.cfg.task(self.skills)/self.gsize
     except ZeroDivisionError:
       self.nowpay = 0
 
+  def aggregates(self):
+    """Compute worth, gsize, nslow, biassums, and biastotal from scratch"""
+    biassums = {}
+    if self.cfg.bias:
+      for a in self.agents:
+        biassums[a.id] = sum(a.bias.get(m.id, 1.0) for m in self.agents)
+    return (sum(a.worth for a in self.agents), len(self.agents), 
+            sum(1 for a in self.agents if a.slow), 
+            biassums, float(sum(biassums.values())))
+
+  def recalc(self):
+    """Rebuild the cached aggregates, e.g. after agent biases change"""
+    (self.worth, self.gsize, self.nslow, 
+     self.biassums, self.biastotal) = self.aggregates()
+    self.update()
+
+  def checkcache(self):
+    """Raise an AssertionError if the cached aggregates are wrong"""
+    worth, gsize, nslow, biassums, biastotal = self.aggregates()
+    assert (worth, gsize, nslow) == (self.worth, self.gsize, self.nslow), \
+      "Group {} cache: {} != {}".format(self.id, (self.worth, self.gsize, 
+                                        self.nslow), (worth, gsize, nslow))
+    assert sorted(biassums) == sorted(self.biassums), \
+      "Group {} bias cache members differ".format(self.id)
+    assert all(abs(biassums[aid] - self.biassums[aid]) < 1e-6 
+               for aid in biassums), \
+      "Group {} bias sums differ".format(self.id)
+    assert abs(biastotal - self.biastotal) < 1e-6, \
+      "Group {} bias total {} != {}".format(self.id, self.biastotal, biastotal)
+
   def addfirst(self, agent):
     """Add the first agent to the group. Sets the agent's group variable"""
     agent.group = self
@@ -457,7 +514,14 @@ class Group(Actor):
     """
     self.notifyjoin(agent.id, add=True)
     self.agents.append(agent)
-    self.skills = self.withskills(agent)
+    self.skills += agent.skills     # in place, so array engine views stay valid
+    if self._engine is not None:
+      self._engine.join(agent, self)
+    self.worth += agent.worth
+    self.gsize += 1
+    self.nslow += agent.slow
+    if self.cfg.bias:
+      self.addbias(agent)
     self.update()
     
     if self.cfg.fully_connect_groups:
@@ -466,6 +530,8 @@ class Group(Actor):
           self.cfg._Gptr.add_edge(a.id, agent.id, weight=1.0, bias=0.0)
           a.addnbr(agent)
           agent.addnbr(a)
+      if self._engine is not None:
+        self._engine.graph_dirty = True
     
   def remove(self, agent):
     """Remove an agent (if a member) from the group, and update values.
@@ -473,10 +539,41 @@ class Group(Actor):
     """
     if agent in self.agents:
       self.agents.remove(agent)
-      self.skills = self.withoutskills(agent)
+      self.skills -= agent.skills
+      self.worth -= agent.worth
+      self.gsize -= 1
+      self.nslow -= agent.slow
+      if self.cfg.bias:
+        self.removebias(agent)
       self.update()
       self.notifyjoin(agent.id, add=False)
 
+  def addbias(self, agent):
+    """Add a new member's biases to the bias sums (agent already in agents)"""
+    aid = agent.id
+    added = 0.0
+    for a in self.agents:
+      if a is not agent:
+        b = a.bias.get(aid, 1.0)
+        self.biassums[a.id] += b
+        added += b
+    mysum = sum(agent.bias.get(m.id, 1.0) for m in self.agents)
+    self.biassums[aid] = mysum
+    self.biastotal += added + mysum
+
+  def removebias(self, agent):
+    """Remove a departed member's biases from the bias sums"""
+    aid = agent.id
+    removed = self.biassums.pop(aid, 0.0)
+    for a in self.agents:
+      b = a.bias.get(aid, 1.0)
+      self.biassums[a.id] -= b
+      removed += b
+    if self.agents:
+      self.biastotal -= removed
+    else:
+      self.biastotal = 0.0    # Don't let rounding error accumulate
+
   def withskills(self, agent):
     """Return the group's cumulative skills plus the skills of agent"""
     #return [self.skills[i] + agent.skills[i] for i in range(self.nskills)]
@@ -506,17 +603,17 @@ class Group(Actor):
         #print "group", self.id, "proposing to", g.id
         g.takeapplication(self)
 
-  def acceptvote_thread(self, a, applications, votes):
-    """Function to take acceptvotes in separate threads."""
-    vote = a.acceptvote(applications)
-    votes.append(vote)
-
   def consider(self):
     """Consider all applications, and allow members to vote to accept one."""
+    self.start_consider().result()
+
+  def start_consider(self):
+    """Ask every member to vote on the applications, without waiting for
+       human members; result() tabulates the votes and accepts the winner."""
     
     # This function handles both groups and agents in the groupmerge case
     if not len(self.applications):
-      return
+      return Reply.resolved(None)
     
     # This speeds things up immensely in the complete graph!
     #self.applications = random.sample(self.applications, len(self.applications))
@@ -525,24 +622,22 @@ class Group(Actor):
     self.update()
     
     # Have each member vote on who to accept (-1 means accept no one)
-    votes = []
     if self.cfg._threaded_sim:
-      mythreads = []
-      for a in random.sample(self.agents, self.gsize):
-        ## Should only start threads for the human agents
-        if a.slow:
-          t = threading.Thread(target=self.acceptvote_thread, 
-                               args=(a, self.applications, votes))
-          t.start()
-          #print "Starting thread with apps:", [a.id for a in self.applications]
-          mythreads.append(t)
-        else:
-          votes.append(a.acceptvote(self.applications))            
-      for t in mythreads:
-        t.join()
+      voters = random.sample(self.agents, self.gsize)
     else:
-      votes = [a.acceptvote(self.applications) for a in self.agents]
-    
+      voters = self.agents
+    votes = []
+    for a in voters:
+      if a.type == 'human':
+        votes.append(a.start_acceptvote(self.applications))
+      elif a.slow and self.cfg._threaded_sim:
+        # Only slow simulated agents use the pool
+        votes.append(self.cfg._pool.submit(a.acceptvote, self.applications))
+      else:
+        votes.append(Reply.resolved(a.acceptvote(self.applications)))
+    return All(votes).then(self.finish_consider)
+
+  def finish_consider(self, votes):
     if not len(votes):
       print "ERROR: no votes received!"
       self.applications = []
@@ -625,41 +720,38 @@ class Group(Actor):
     """Complete a group merge by clearing out self.acceptances"""
     self.acceptances = []
 
-  def expelvote_thread(self, a, votes):
-    """Function to take expelvotes in separate threads."""
-    vote = a.expelvote()
-    votes[a] = vote
-
   def expel_agent(self):
     """Consider all members, and allow members to vote to expel one.
     
     Returns: an Agent to expel, or None
     """
+    return self.start_expel_agent().result()
+
+  def start_expel_agent(self):
+    """Ask every member to vote, without waiting for human members;
+       result() is the Agent to expel, or None (see expel_agent)."""
     if self.gsize == 1:
-      return None
+      return Reply.resolved(None)
     
     self.update()
     
     # Have each member vote on who to accept (-1 means accept no one)
-    votes = {}
     if self.cfg._threaded_sim:
-      mythreads = []
-      for a in random.sample(self.agents, self.gsize):
-        ## Should only start threads for the human agents
-        if a.slow:
-          t = threading.Thread(target=self.expelvote_thread, args=(a, votes))
-          t.start()
-          mythreads.append(t)
-        else:
-          votes[a] = a.expelvote()
-      for t in mythreads:
-        t.join()
+      voters = random.sample(self.agents, self.gsize)
     else:
-      votes = {a:a.expelvote() for a in self.agents}
-    
-    voters = votes.keys()
-    votes = votes.values()
-    
+      voters = self.agents
+    votes = []
+    for a in voters:
+      if a.type == 'human':
+        votes.append(a.start_expelvote())
+      elif a.slow and self.cfg._threaded_sim:
+        # Only slow simulated agents use the pool
+        votes.append(self.cfg._pool.submit(a.expelvote))
+      else:
+        votes.append(Reply.resolved(a.expelvote()))
+    return All(votes).then(self.finish_expel_agent, voters)
+
+  def finish_expel_agent(self, votes, voters):
     if not len(votes):
       print "ERROR: no votes received!"
       self.applications = []
@@ -745,7 +837,10 @@ class Group(Actor):
     
   def reset(self):
     """Reset the group - remove all members and reset skills"""
-    self.skills = np.zeros(self.cfg.nskills, dtype='int') #[0]*self.cfg.nskills
+    if self._engine is not None:
+      self.skills[:] = 0
+    else:
+      self.skills = np.zeros(self.cfg.nskills, dtype='int') #[0]*self.cfg.nskills
     self.nskills = self.cfg.nskills
     self.agents = []
     self.applications = []
@@ -753,4 +848,7 @@ class Group(Actor):
     self.gsize = 0
     self.nowpay = 0
     self.worth = 0
+    self.nslow = 0
+    self.biassums = {}
+    self.biastotal = 0.0
 
@@ -242,41 +242,49 @@ class Analyzer:
     
 
   def dumpsummary(self, filename):
-    cfg = self.cfg
+    writesummary(filename, self.data, self.cfg.outputcfg())
+
+
+def writesummary(filename, data, configd):
+  """Append a line of results (and the header, if the file is new) to a TSV
+  
+  Arguments:
+    filename: output file
+    data: dictionary of summary results (Analyzer.data)
+    configd: dictionary of configuration options (Configuration.outputcfg())
+  """
+  with open(filename, 'a') as f:
+    #fcntl.flock(f, fcntl.LOCK_EX) ## Does not work over NFS
+    fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
     
-    with open(filename, 'a') as f:
-      #fcntl.flock(f, fcntl.LOCK_EX) ## Does not work over NFS
-      fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
-      
-      configd = cfg.outputcfg()
-      
-      # Generate line of csv data
-      outline = {'timestamp': str(datetime.datetime.now())}
-      #outline =  join res and configd and date
-      outline.update(self.data)
-      outline.update(configd)
-      outline.pop('tasks', None)
-      
-      sortheader = sorted(outline.keys())
-      
-      if cfg.simnumber == 1:
-        Configuration._header = sortheader
-      elif Configuration._header != sortheader:
-        print "Header mismatch!"
-        print "cfg: ", Configuration._header
-        print "now: ", sortheader
-        raise Exception()
-      
-      # add header if empty; otherwise, append
-      if f.tell() == 0:
-        print "Writing header"
-        header = [k for k in sortheader]
-        header = "\t".join(header)+"\n"
-        f.write(header)
-        # date, config, results
-      
-      # Then, output the line of csv data
-      f.write("\t".join(str(outline[k]) for k in sortheader)+"\n")
-      
-      #fcntl.flock(f, fcntl.LOCK_UN)  ## Does not work over NFS
-      fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+    # Generate line of csv data
+    outline = {'timestamp': str(datetime.datetime.now())}
+    #outline =  join res and configd and date
+    outline.update(data)
+    outline.update(configd)
+    outline.pop('tasks', None)
+    
+    sortheader = sorted(outline.keys())
+    
+    # The first line written sets the header (configs may run in any order)
+    if not Configuration._header:
+      Configuration._header = sortheader
+    elif Configuration._header != sortheader:
+      print "Header mismatch!"
+      print "cfg: ", Configuration._header
+      print "now: ", sortheader
+      raise Exception()
+    
+    # add header if empty; otherwise, append
+    if f.tell() == 0:
+      print "Writing header"
+      header = [k for k in sortheader]
+      header = "\t".join(header)+"\n"
+      f.write(header)
+      # date, config, results
+    
+    # Then, output the line of csv data
+    f.write("\t".join(str(outline[k]) for k in sortheader)+"\n")
+    
+    #fcntl.flock(f, fcntl.LOCK_UN)  ## Does not work over NFS
+    fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,186 @@
+#
+# arrayengine.py - stores agent and group state in contiguous numpy arrays
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Array-backed state engine for agents and groups.
+
+When Configuration._array_engine is set, the simulation keeps agent skills,
+group membership, group skill sums, pay and switch counts in numpy arrays
+indexed by agent/group ID. Agent and Group objects stay in place (so
+HumanAgent and the rest of the object API keep working), but become thin
+views onto the arrays, which lets the simulation operate on whole phases
+at once instead of walking objects one at a time.
+"""
+
+import numpy as np
+
+
+class EngineField(object):
+  """Descriptor for an attribute that lives in an ArrayEngine array.
+
+  While the owning object is not bound to an engine (obj._engine is None),
+  the value is stored in the instance dictionary like a normal attribute.
+  Once bound, reads and writes go to engine.<array>[obj.id].
+  """
+  def __init__(self, name, array):
+    self.name = name
+    self.array = array
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+    eng = obj._engine
+    if eng is None:
+      try:
+        return obj.__dict__[self.name]
+      except KeyError:
+        raise AttributeError(self.name)
+    return getattr(eng, self.array).item(obj.id)
+
+  def __set__(self, obj, value):
+    eng = obj._engine
+    if eng is None:
+      obj.__dict__[self.name] = value
+    else:
+      getattr(eng, self.array)[obj.id] = value
+
+
+class ArrayEngine(object):
+  """Holds agent and group state in arrays indexed by agent/group ID.
+
+  Agent and group IDs must be integers in range(n); groups are created
+  with the ID of their first agent, so both fit in arrays of length n.
+
+  Attributes:
+    skills: n x nskills array of agent skills
+    switches: number of times each agent has switched groups
+    nowpay: current pay of each agent
+    membership: group ID of each agent
+    gskills: n x nskills array of cumulative group skills
+    gsize: number of members of each group
+    gnowpay: current per-member pay of each group
+    graph_dirty: True if the social network changed since the last
+                 adjacency snapshot was taken
+  """
+
+  def __init__(self, n, nskills):
+    self.n = n
+    self.nskills = nskills
+    self.skills = np.zeros((n, nskills), dtype='int')
+    self.switches = np.zeros(n, dtype='int')
+    self.nowpay = np.zeros(n)
+    self.membership = np.arange(n)
+    self.gskills = np.zeros((n, nskills), dtype='int')
+    self.gsize = np.zeros(n, dtype='int')
+    self.gnowpay = np.zeros(n)
+    self.graph_dirty = True
+
+  def bind_agent(self, agent):
+    """Move an agent's state into the arrays and make it a view"""
+    aid = agent.id
+    self.skills[aid] = agent.skills
+    self.switches[aid] = agent.switches
+    self.nowpay[aid] = agent.nowpay
+    self.membership[aid] = aid
+    agent.skills = self.skills[aid]     # row view; writes go to the array
+    agent._engine = self
+
+  def bind_group(self, group):
+    """Move a group's state into the arrays and make it a view"""
+    gid = group.id
+    self.gskills[gid] = group.skills
+    self.gsize[gid] = group.gsize
+    self.gnowpay[gid] = group.nowpay
+    group.skills = self.gskills[gid]
+    group._engine = self
+
+  def join(self, agent, group):
+    """Record that agent is now a member of group"""
+    self.membership[agent.id] = group.id
+
+  def teams(self):
+    """Return a list of the group ID of every agent, ordered by agent ID"""
+    return self.membership.tolist()
+
+  def adjacency(self, G):
+    """Return the social network as CSR arrays (indptr, nbrs, weights).
+    
+    The snapshot is cached, and rebuilt only when graph_dirty is set.
+    """
+    if self.graph_dirty:
+      indptr = np.zeros(self.n+1, dtype='int')
+      nbrs = []
+      weights = []
+      for aid in xrange(self.n):
+        for nbr, dat in G[aid].iteritems():
+          nbrs.append(nbr)
+          weights.append(dat['weight'])
+        indptr[aid+1] = len(nbrs)
+      self.csr = (indptr, np.array(nbrs, dtype='int'), 
+                  np.array(weights, dtype='float'))
+      self.graph_dirty = False
+    return self.csr
+
+  def propose_candidates(self, G, taskmany, aids):
+    """Find every neighboring group that agents in aids would apply to.
+    
+    Does the same arithmetic as SimAgent.propose for all agents at once:
+    an agent applies to a neighboring group if joining would raise its pay
+    and it has at least 1.0 total edge weight into that group. 
+    Also refreshes nowpay for the agents in aids, like Agent.update().
+    
+    Arguments:
+      G: the social network
+      taskmany: function returning the pay for each row of a skill array
+                (Configuration.taskmany)
+      aids: list of agent IDs
+    
+    Returns:
+      list of (group ID, pay) lists, one for each agent in aids
+    """
+    aids = np.asarray(aids, dtype='int')
+    indptr, nbrs, weights = self.adjacency(G)
+    member = self.membership
+    
+    # Pay in current group
+    mygroups = member[aids]
+    self.nowpay[aids] = (taskmany(self.gskills[mygroups]) / 
+                         self.gsize[mygroups])
+    
+    # One entry per (agent, neighbor group) pair, with total edge weight
+    selected = np.zeros(self.n, dtype='bool')
+    selected[aids] = True
+    src = np.repeat(np.arange(self.n), np.diff(indptr))
+    edges = selected[src]
+    src = src[edges]
+    ngroups = member[nbrs[edges]]
+    keep = ngroups != member[src]
+    pairs, inv = np.unique(src[keep]*self.n + ngroups[keep], 
+                           return_inverse=True)
+    totalweights = np.bincount(inv, weights=weights[edges][keep])
+    pa, pg = pairs // self.n, pairs % self.n
+    
+    # Pay in each neighboring group
+    gpay = (taskmany(self.gskills[pg] + self.skills[pa]) / 
+            (self.gsize[pg] + 1))
+    good = (gpay > self.nowpay[pa]) & (totalweights >= 1)
+    
+    candidates = {aid:[] for aid in aids.tolist()}
+    for aid, gid, pay in zip(pa[good].tolist(), pg[good].tolist(), 
+                             gpay[good].tolist()):
+      candidates[aid].append((gid, pay))
+    return [candidates[aid] for aid in aids.tolist()]
@@ -0,0 +1,336 @@
+#
+# clientmux.py - multiplexes all client connections on one I/O thread
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Non-blocking transport for the server side of the client protocol.
+
+A ClientMux owns one thread that runs a select() loop over every client
+socket. Each client is wrapped in a Channel, which utils.send_message and
+receive_message accept in place of a socket. Sending only queues the frame
+for the I/O thread, and request() returns a Reply (a future) instead of
+blocking, so the server can send the same request to every human and then
+gather() the answers without a thread per human. HumanAgent's start_
+methods chain their logging onto the Reply with then(), and Group collects
+its members' votes with All, so simulation.run only gathers these; the
+thread pool is left for slow simulated agents.
+
+The frontend answers messages in the order they are sent, so each Channel
+matches incoming messages to waiting Replies first-in, first-out.
+Messages the frontend sends on its own (marked with utils.FLAG_PUSH) are
+not answers; they go to the Channel's onpush callback instead.
+"""
+
+import os
+import errno
+import select
+import socket
+import threading
+import traceback
+import collections
+
+from utils import BUFFER_SIZE, HEADER, FLAG_ABORT, ENCODE_ERRORS
+from utils import iter_frames, get_codec, FrameReader
+
+
+class Reply(object):
+  """The pending result of Channel.receive() or Channel.request()"""
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+    self.error = None
+
+  @classmethod
+  def resolved(cls, value):
+    """Return a Reply that is already done, with value"""
+    reply = cls()
+    reply.set(value)
+    return reply
+
+  def set(self, value):
+    self.value = value
+    self.event.set()
+
+  def fail(self, error):
+    self.error = error
+    self.event.set()
+
+  def done(self):
+    return self.event.is_set()
+
+  def result(self):
+    """Wait for the message, and return it (or raise the channel's error)"""
+    # Wait with a timeout so KeyboardInterrupt still gets through
+    while not self.event.wait(1.0):
+      pass
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+  def then(self, fn, *args):
+    """Return a Then for fn(value, *args)"""
+    return Then(self, fn, args)
+
+
+class Then(object):
+  """The result of fn(value, *args), where value is another pending result
+  (a Reply, an All, a threadpool.Future or another Then).
+  
+  fn is called once, by the first call to result(), in that thread. This
+  is how a HumanAgent finishes a decision (logging it, joining a group) 
+  in the sim thread once the client's answer arrives.
+  """
+  def __init__(self, pending, fn, args=()):
+    self.pending = pending
+    self.fn = fn
+    self.args = args
+    self.finished = False
+    self.value = None
+
+  def done(self):
+    return self.finished or self.pending.done()
+
+  def result(self):
+    if not self.finished:
+      self.value = self.fn(self.pending.result(), *self.args)
+      self.finished = True
+    return self.value
+
+  def then(self, fn, *args):
+    return Then(self, fn, args)
+
+
+class All(object):
+  """Pending results of a list of Replies (or other pending results);
+     result() waits for all of them and returns the list of their values"""
+  def __init__(self, pending):
+    self.pending = list(pending)
+
+  def done(self):
+    return all(p.done() for p in self.pending)
+
+  def result(self):
+    return gather(self.pending)
+
+  def then(self, fn, *args):
+    return Then(self, fn, args)
+
+
+def gather(replies):
+  """Wait for all replies (or other pending results), in order, and 
+     return a list of their values"""
+  return [reply.result() for reply in replies]
+
+
+class Channel(object):
+  """One client connection, driven by a ClientMux.
+
+  Attributes:
+    sock: the (non-blocking) client socket
+    outbuf: frames queued for sending
+    reader: FrameReader for received data
+    inbox: received messages that no one has asked for yet
+    waiting: Replies waiting for the next messages, in order
+    error: the exception that closed the channel, or None
+    onpush: function called (on the I/O thread) with each pushed message,
+            or None to drop them
+  """
+  def __init__(self, mux, sock):
+    self.mux = mux
+    self.sock = sock
+    self.lock = threading.Lock()
+    self.sendlock = threading.Lock()    # One message at a time into outbuf
+    self.outbuf = bytearray()
+    self.reader = FrameReader()
+    self.inbox = collections.deque()
+    self.waiting = collections.deque()
+    self.error = None
+    self.onpush = None
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def send_message(self, message, push=False):
+    """Queue a message for sending; does not wait for it to be sent
+    
+    Frames are queued as they are encoded, so the I/O thread can send 
+    the start of a large message while the rest is being encoded.
+    """
+    with self.sendlock:
+      queued = False
+      try:
+        for frame in iter_frames(message, get_codec(self), push):
+          self.queue(frame)
+          queued = True
+      except ENCODE_ERRORS:
+        if queued:    # Part of the message is queued; tell the client to drop it
+          self.queue(HEADER.pack(0, FLAG_ABORT))
+        raise
+    return True
+
+  def queue(self, data):
+    """Add data to outbuf, and wake the I/O thread to send it"""
+    with self.lock:
+      if self.error is not None:
+        raise self.error
+      self.outbuf += data
+    self.mux.wake()
+
+  def receive(self):
+    """Return a Reply for the next message from the client"""
+    reply = Reply()
+    with self.lock:
+      if self.inbox:
+        reply.set(self.inbox.popleft())
+      elif self.error is not None:
+        reply.fail(self.error)
+      else:
+        self.waiting.append(reply)
+    return reply
+
+  def request(self, message):
+    """Send a message, and return a Reply for the client's answer"""
+    reply = self.receive()
+    self.send_message(message)
+    return reply
+
+  def receive_message(self):
+    """Blocking receive, like utils.receive_message on a socket"""
+    return self.receive().result()
+
+  def wantwrite(self):
+    return len(self.outbuf) > 0
+
+  def flush(self):
+    """Send as much queued data as the socket will take (I/O thread)"""
+    with self.lock:
+      if self.error is not None:
+        return
+      try:
+        sent = self.sock.send(self.outbuf)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        self.close(e)
+        return
+      del self.outbuf[:sent]
+
+  def fill(self):
+    """Read available data and deliver complete messages (I/O thread)"""
+    if self.error is not None:
+      return
+    try:
+      data = self.sock.recv(BUFFER_SIZE)
+    except socket.error as e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        with self.lock:
+          self.close(e)
+      return
+    if not data:
+      with self.lock:
+        self.close(IOError("Client disconnected"))
+      return
+    try:
+      messages = self.reader.feed(data)
+    except Exception as e:    # Oversize frame (IOError) or bad message (ValueError)
+      with self.lock:
+        self.close(e)
+      return
+    # Handle pushed messages first, so anything the client pushed before
+    # an answer is handled before whoever waits on the answer wakes up
+    for message, pushed in messages:
+      if pushed and self.onpush is not None:
+        try:
+          self.onpush(message)
+        except Exception:
+          traceback.print_exc()
+    with self.lock:
+      for message, pushed in messages:
+        if pushed:
+          continue
+        if self.waiting:
+          self.waiting.popleft().set(message)
+        else:
+          self.inbox.append(message)
+
+  def close(self, error):
+    """Close the channel and fail all waiting Replies (call with lock)"""
+    self.error = error
+    while self.waiting:
+      self.waiting.popleft().fail(error)
+    self.mux.unregister(self)
+    self.sock.close()
+
+
+class ClientMux(object):
+  """Runs one select() loop for all registered client sockets"""
+  def __init__(self):
+    self.channels = []
+    self.lock = threading.Lock()
+    self.wakeup_r, self.wakeup_w = os.pipe()
+    self.running = True
+    self.thread = threading.Thread(target=self.loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def register(self, sock):
+    """Hand a connected socket to the I/O thread, and return its Channel"""
+    sock.setblocking(0)
+    channel = Channel(self, sock)
+    with self.lock:
+      self.channels.append(channel)
+    self.wake()
+    return channel
+
+  def unregister(self, channel):
+    with self.lock:
+      if channel in self.channels:
+        self.channels.remove(channel)
+
+  def wake(self):
+    """Interrupt select() so it picks up new channels and output"""
+    os.write(self.wakeup_w, 'x')
+
+  def close(self):
+    self.running = False
+    self.wake()
+    self.thread.join()
+
+  def loop(self):
+    """I/O thread: move data between the sockets and the Channels"""
+    while self.running:
+      with self.lock:
+        channels = list(self.channels)
+      writers = [c for c in channels if c.wantwrite()]
+      readable, writable, _ = select.select([self.wakeup_r] + channels,
+                                            writers, [])
+      if self.wakeup_r in readable:
+        os.read(self.wakeup_r, BUFFER_SIZE)
+      for channel in writable:
+        self.service(channel, channel.flush)
+      for channel in readable:
+        if channel != self.wakeup_r:
+          self.service(channel, channel.fill)
+
+  def service(self, channel, method):
+    """Call a Channel's flush or fill; an error closes only that channel"""
+    try:
+      method()
+    except Exception as e:
+      traceback.print_exc()
+      with channel.lock:
+        if channel.error is None:
+          channel.close(e)
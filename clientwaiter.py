@@ -22,10 +22,14 @@ ClientWaiter class waits for connections from client computers
 running frontend.py.
 """
 
+import os
 import socket
+import select
 import threading
 
-from utils import send_message, SERVER_PORT
+from utils import send_message, receive_message, SERVER_PORT
+from utils import available_codecs, set_codec
+from clientmux import ClientMux
 
 def log(text, level=0):
   """Dummy method to print logging text"""
@@ -40,7 +44,8 @@ class ClientWaiter(object):
   
   Waits for clients until server user presses ENTER. 
   Listens on SERVER_PORT from utils.py.
-  Use getclients() to return the client connections
+  Use getclients() to return the client connections, which are
+  clientmux.Channels sharing one I/O thread.
   """
   def __init__(self):
     """Starts the wait thread, and terminates when user presses ENTER"""
@@ -48,6 +53,8 @@ class ClientWaiter(object):
     self.clientaddrs = []
     self.nclients = 0
     self.socket = None
+    self.mux = ClientMux()
+    self.stop_r, self.stop_w = os.pipe()
     
     # start thread to wait_for_clients
     self.waiting = True
@@ -61,6 +68,7 @@ class ClientWaiter(object):
     log("Waiting for wait thread to terminate...")
     # Kill wait for clients thread
     self.waiting = False
+    os.write(self.stop_w, 'x')
     wait_thread.join()
     log("Wait thread ended")
   
@@ -70,28 +78,43 @@ class ClientWaiter(object):
     sock = self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((ADDRESS, SERVER_PORT))
-    sock.listen(1)
-    sock.settimeout(2.0)
+    sock.listen(128)   # Load tests connect hundreds of seats at once
     while self.waiting:
       #log("Waiting for a connection")
+      # Wait for a connection, or for the main thread to stop us
+      readable, _, _ = select.select([sock, self.stop_r], [], [])
+      if sock not in readable:
+        continue
       try:
         connection, client_address = sock.accept()
       except socket.error, strerror:
-        if str(strerror) != 'timed out':
-          print strerror
+        print strerror
       else:
         i = len(self.clientsockets)
-        if self.client_setup(connection, i):
-          log("Client "+str(i)+" connected!")
-          self.clientsockets.append(connection)
+        try:
+          codec = self.client_setup(connection, i)
+        except (socket.error, IOError, ValueError):
+          codec = None
+        if codec:
+          log("Client "+str(i)+" connected! ("+codec+")")
+          channel = self.mux.register(connection)
+          set_codec(channel, codec)
+          self.clientsockets.append(channel)
         else:
           log("Client {0} at {1} connection failed!".format(i, client_address), 0)
-    sock.settimeout(None)
     self.nclients = len(self.clientsockets)
   
   def client_setup(self, connection, clientnum):
-    """Dummy method to initialize a client once it's connected."""
-    return send_message(connection, ("client_number", clientnum) )
+    """Send a new client its number, and agree on a message codec.
+    
+    The client picks the first codec it has from the list we offer.
+    
+    Returns:
+      the name of the codec to use with this client
+    """
+    send_message(connection, ("client_number", (clientnum, available_codecs())) )
+    command, codec = receive_message(connection)
+    return codec
   
   def getclients(self):
     """Returns the list of client connections"""
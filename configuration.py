@@ -23,6 +23,9 @@ import numpy as np
 import networkx as nx
 import copy
 import math
+import types
+
+from vclock import RealClock
 
 PROTOCOL = 3
 ##   Setting this PROTOCOL flag will set several configuration options at once, for ease of experimentation
@@ -116,6 +119,7 @@ class Configuration(object):
   show_other_team_members = True
   
   do_ratings = True
+  _push_ratings = True    # Clients push rating changes as they happen, instead of the server asking for them before and after every step
   
   show_global_ratings = True
   show_nhistory = 0      # Set to zero to disable
@@ -134,6 +138,8 @@ class Configuration(object):
   #_agent_delays = {'propose':2.5, 'acceptvote':1.5, 'join':1.0, 'expelvote':1.0, 'conclude':1.0, 'publicgoods':2.5}    # Arbitrary
   _agent_delays = {'propose':4.0, 'acceptvote':5.0, 'join':5.0, 'expelvote':3.0, 'conclude':3.0, 'publicgoods':10.0}    # Based on pilot data
   _agent_delay_dev = {'propose':2.0, 'acceptvote':2.5, 'join':1.5, 'expelvote':1.5, 'conclude':1.0, 'publicgoods':5.0}  # Approx as half the IQR
+  _virtual_time = False     # Record agent delays on a simulated clock instead of sleeping (see vclock.py); for fast rehearsals
+  _clock = RealClock()      # Clock used for agent delays and sim timestamps (set by simulation.setup)
   
   social_sim_agents = True
   social_learning_rate = 0.66
@@ -150,6 +156,8 @@ class Configuration(object):
   ## Params for automated simulation
   reset_graph_iters = 0     # Reset the graph after n iterations (0 is keep forever)
   _log_teamstatus = True
+  _topo_mode = 'full'   # 'full' logs every agent's neighbors every sim; 'graph' logs each distinct graph once (see db_logger.log_graph)
+  _teamstatus_mode = 'full'   # 'full' logs every agent at every step; 'delta' logs only changes (see db_logger.log_teamdelta)
   percent_conditional = 0
 
   ## DISPLAY PARAMETERS
@@ -168,10 +176,15 @@ class Configuration(object):
   _draw_grid = False
   _print_summary = True
   _print_group_summary = False
+  _debug_group_cache = False     # Check incremental group aggregates against a full recompute on every Group.update
 
   delaytime = 0.25     # delay between iterations in seconds, for watching the sim
 
-  _threaded_sim = True  # Start new threads for each agent when actions can be completed in parallel (turn on for human subjects)
+  _threaded_sim = True  # Run agent actions in parallel on a thread pool when possible (turn on for human subjects)
+  _pool_size = 32       # Max number of threads in the simulation's thread pool
+  _pool = None          # The simulation's ThreadPool (set by simulation.setup)
+
+  _array_engine = False  # Keep agent/group state in numpy arrays (see arrayengine.py); faster for large automated runs
 
   #skillseed = 12345     # Always init agent skills with this seed. Set to None for random.
   skillseed = None
@@ -224,15 +237,24 @@ class Configuration(object):
   
   
   simnumber = 0
+  _rep = 0          # Repetition number of this configuration in a MultiConfig sweep
   _header = []      # Holds the sorted headings
 
-  _taskdict = {}
+  _task_table_max = 2**18   # Largest pay table (entries) compile_task will build
+  _task_tables = {}         # Compiled pay tables, shared between configs with the same parameters
+  _paytable = None
 
   _dblog = None
+  _db_profile = 'wal'   # SQLite settings for the database (see db_logger.STORAGE_PROFILES)
+  _db_queue_size = 10000   # Most queued database writes; 0 for no limit
+  _db_queue_policy = 'block'  # When the queue is full: block, spill, or sample
+  _log_sink = 'sqlite'  # Where logs go: 'sqlite', 'binlog' (an event log to convert later; see db_logger.BinaryLogger), or 'null'
   
   
   def __init__(self):
     self.task = self.nmemtask
+    self._taskdict = {}
+    self._paytable = None
     #self.task = self.bdtask
     #self.setupbdtask()
     self._Gptr = None
@@ -291,6 +313,7 @@ class Configuration(object):
     synergy = 5
     paypera = range(base, base+self.nskills*synergy, synergy)
     self.pays = [n*p for n,p in zip(nagents, paypera)]
+    self.invalidate_task()
   
   # This task rewards breadth and depth with different values for each skill
   def bdtask2(self, skills):
@@ -300,18 +323,120 @@ class Configuration(object):
     except KeyError:
       depth = min(max(skills), self.nskills)-1
       breadth = min(len([s for s in skills if s != 0]), self.nskills)-1
-      pay = self.pays[depth]*self.values[skills.index(max(skills))]*(depth+1) + self.pays[breadth]*sum(self.values[idx] for idx in range(self.nskills) if skills[idx] > 0)
+      pay = self.pays[depth]*self.values[list(skills).index(max(skills))]*(depth+1) + self.pays[breadth]*sum(self.values[idx] for idx in range(self.nskills) if skills[idx] > 0)
       self._taskdict[tskills] = float(pay)
       return pay
 
   # Set up pay structure for the bdtask2
   def setupbdtask2(self):
-    self.setupbdtask()
     self.values = [(n+1) for n in range(self.nskills)]
     #self.values.reverse()   # Skill 0 has the highest pay
     random.shuffle(self.values) # The high-pay task changes each round
+    self.setupbdtask()    # (also invalidates cached pays)
+  
+  
+  # Pay lookup tables
+  # compile_task() replaces self.task with a lookup into a dense numpy array
+  # of pays. Each skill count is clipped to the largest value that can 
+  # change the pay, and the clipped skill vector is packed into an integer
+  # key (mixed radix, one digit per skill). nmemtask only depends on the
+  # number of members, so its table is indexed by member count instead.
+  def compile_task(self, maxteam=None):
+    """Precompute the current task into a pay table.
+    
+    Arguments:
+      maxteam: largest possible team size, used to bound the table for 
+               tasks with no smaller limit (bdtask2). Defaults to self.n
+    Returns:
+      True if a table was built, False if the task is left uncompiled 
+      (unknown task, or the table would be larger than _task_table_max)
+    """
+    if self._paytable is not None:
+      rawtask = self._rawtask
+    else:
+      rawtask = self.task
+    self._paytable = None
+    self._rawtask = rawtask
+    self.task = rawtask
     self._taskdict = {}
+    if maxteam is None:
+      maxteam = self.n
+    self._maxteam = maxteam
+    
+    name = getattr(rawtask, '__name__', None)
+    nskills = self.nskills
+    if name == 'nmemtask':
+      caps = None
+      dims = [nskills+1]
+      params = ()
+    elif name == 'bdtask':
+      # Depth and breadth are both limited to nskills
+      caps = [nskills]*nskills
+      params = (tuple(self.pays),)
+    elif name == 'bdtask2':
+      # Which skill is deepest matters, so no clipping below the max team skill
+      caps = [maxteam*self.maxskills]*nskills
+      params = (tuple(self.pays), tuple(self.values))
+    elif name == 'multitask' and hasattr(self, 'tasks'):
+      caps = [max(t[0][i] for t in self.tasks) for i in range(nskills)]
+      params = (tuple((tuple(r), p) for r, p in self.tasks),)
+    else:
+      return False
+    if caps is not None:
+      dims = [c+1 for c in caps]
+    if np.prod(dims, dtype='float') > self._task_table_max:
+      return False
+    
+    key = (name, nskills, tuple(dims)) + params
+    try:
+      table = Configuration._task_tables[key]
+    except KeyError:
+      if caps is None:
+        table = np.array([rawtask([m]) for m in range(nskills+1)], dtype='float')
+      else:
+        allskills = np.indices(dims).reshape(nskills, -1).T
+        table = np.array([rawtask(list(s)) for s in allskills], dtype='float')
+      if len(Configuration._task_tables) > 64:
+        Configuration._task_tables.clear()
+      Configuration._task_tables[key] = table
+    
+    self._paytable = table
+    if caps is not None:
+      self._paycaps = np.array(caps, dtype='int')
+      self._payradix = np.array([int(np.prod(dims[i+1:])) for i in range(nskills)], dtype='int')
+    else:
+      self._paycaps = None
+    self.task = self.tabletask
+    return True
   
+  def invalidate_task(self):
+    """Discard cached pays, e.g. after the task parameters change"""
+    self._taskdict = {}
+    if self._paytable is not None:
+      self.compile_task(self._maxteam)
+  
+  def tabletask(self, skills):
+    """Look up the pay for skills in the table built by compile_task"""
+    if self._paycaps is None:
+      return self._paytable.item(min(sum(skills), self.nskills))
+    return self._paytable.item(np.minimum(skills, self._paycaps).dot(self._payradix))
+  
+  def taskmany(self, skills):
+    """Return an array with the pay for each row of the 2D array skills"""
+    skills = np.asarray(skills)
+    if not len(skills):
+      return np.zeros(0)
+    if self._paytable is not None:
+      if self._paycaps is None:
+        return self._paytable[np.minimum(skills.sum(axis=1), self.nskills)]
+      return self._paytable[np.minimum(skills, self._paycaps).dot(self._payradix)]
+    # No table: call the task once per distinct row
+    skills = np.ascontiguousarray(skills)
+    rowview = skills.view(np.dtype((np.void, skills.dtype.itemsize*skills.shape[1])))
+    _, first, inv = np.unique(rowview.ravel(), return_index=True, 
+                              return_inverse=True)
+    pays = np.array([self.task(skills[i]) for i in first], dtype='float')
+    return pays[inv]
   
   #taskname = "equality_doublesize"
   #task = multitask
@@ -637,6 +762,27 @@ class Configuration(object):
     self.utility_tiebreak = utility_tiebreak
     self.utility_tiebreaker = Configuration._tiebreak_map[self.utility_tiebreak]
   
+  def __getstate__(self):
+    """Pickle task/utility functions by name, so configs can be sent 
+       to other processes (see sweep.py)"""
+    state = self.__dict__.copy()
+    state.pop('_pool', None)      # Threads can't be pickled; each process makes its own
+    state.pop('_clock', None)
+    for k, v in state.items():
+      if (isinstance(v, (types.MethodType, types.FunctionType)) and 
+          getattr(Configuration, v.__name__, None) is not None):
+        state[k] = ('_cfgfunc', v.__name__, isinstance(v, types.MethodType))
+    return state
+  
+  def __setstate__(self, state):
+    for k, v in state.iteritems():
+      if isinstance(v, tuple) and len(v) == 3 and v[0] == '_cfgfunc':
+        if v[2]:
+          state[k] = getattr(self, v[1])
+        else:
+          state[k] = Configuration.__dict__[v[1]]
+    self.__dict__.update(state)
+  
   def printself(self):
     for k,v in vars(self).iteritems():
       if k[0] != '_':
@@ -747,6 +893,7 @@ elif PROTOCOL == 100:
   Configuration._margin_time = 0
   Configuration.delay_sim_agents = False
   Configuration._threaded_sim = False
+  Configuration._array_engine = True
   Configuration.reset_graph_iters = 20
   Configuration._log_teamstatus = False
   Configuration.percent_conditional = 0.5
@@ -813,8 +960,10 @@ class MultiConfig(Configuration):
                             curr.rewire_grid_graph = rw
                             for r in range(self.reps):
                               curr.simnumber += 1
+                              curr._rep = r
                               yield copy.copy(curr)
                         else:
                           for r in range(self.reps):
                             curr.simnumber += 1
+                            curr._rep = r
                             yield copy.copy(curr)
@@ -20,6 +20,16 @@
 
 import sqlite3
 import time
+import collections
+import struct
+import cPickle
+import os
+import json
+import zlib
+import base64
+import hashlib
+import atexit
+import weakref
 
 # Try to use this as little as possible...
 from configuration import Configuration
@@ -27,177 +37,286 @@ from configuration import Configuration
 import threading
 import Queue
 
-def r2(pay):
-  """ Shorthand for 'round to 2 decimals' """
-  return round(pay, 2)
+# PRAGMA settings for each connection, by profile name.
+# 'wal' lets readers work alongside the writer, and only syncs to disk at 
+# checkpoints (a power failure can lose the last commits, but not corrupt 
+# the database). 'default' keeps SQLite's rollback journal and full syncs.
+STORAGE_PROFILES = {
+  'default': [],
+  'wal': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+          ('cache_size', -16000),     # Negative is in KiB, so 16 MB
+          ('temp_store', 'MEMORY')],
+}
 
-class DBLogger(object):
-  """Handles logging results to SQLite3 database
+# Queue item asking the insert thread to commit (see DBLogger.commit)
+_COMMIT = (None, None, False)
+
+# Record header of a binary event log (see BinaryLogger): payload length
+BINLOG_HEADER = struct.Struct('!I')
+
+# What queue_insert does when the insert queue is full:
+#   'block': wait for room
+#   'spill': append the rows to dbfile+'.spill', and queue them again
+#            at the next flush_inserts()
+#   'sample': keep one of every sample_every inserts (waiting for room),
+#             and drop the rest
+QUEUE_POLICIES = ('block', 'spill', 'sample')
+
+class Table(object):
+  """One table of the database schema
   
-  Contains numerous methods for logging all aspects of team formation.
-  Uses a threaded batch insert system to reduce database commits 
-  and improve performance.
-  """
+  columns: column definitions, as in CREATE TABLE
+  auto: the integer key column that SQLite fills in, or None.
+        An 'auto' rowid column is added to the definitions.
   
-  def __init__(self, dbfile):
-    self.dbfile = dbfile
-    
-    self.NO_LOGGING = False     # TEMP: Set to true to disable database output
-    
-    self.sessionid = None   # Init from database in self.setup()
-    self.setup()
-    
-    # Threaded producer-consumer code
-    self.insthread = None
-    self.autoins = False
-    self.forcecommit = False
-    self.insqueue = Queue.Queue()
+  fields are the columns except auto. Log methods build each row once, as
+  a plain tuple of the fields (sqlite3 binds exact tuples fastest), and 
+  insert is the statement for such a row. Row is a namedtuple of the 
+  fields, for reading rows back (see get_teamstatus).
+  """
+  def __init__(self, name, columns, auto='rowid'):
+    self.name = name
+    if auto == 'rowid':
+      columns = 'rowid integer primary key asc,\n         '+columns
+    self.create = 'CREATE TABLE IF NOT EXISTS {0}\n        ({1})'.format(name, columns)
+    names = [col.split()[0] for col in columns.split(',')]
+    self.fields = [col for col in names if col != auto]
+    self.Row = collections.namedtuple(name, self.fields)
+    self.insert = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+      name, ', '.join(self.fields), ','.join('?'*len(self.fields)))
 
-  # Team formation:
-  #   what do people apply to?
-  #     turn id, user id, group, current pay, new group pay, applied or not  (max group pay?)
-  #     (also, what have people applied to previously?)
-  #   how do people pick new teammates?
-  #     turn id, user id, applicant id, current pay, new pay, accepted or not  (max applicant pay?)
-  #     (also, who have people accepted previously?)
-  #   how do people decide what team to join?
-  #     turn id, user id, group, current pay, new group pay, joined or not  (max group pay?)
-  
-  def setup(self):
-    """Setup database schema and get new sessionid"""
-    # Types: NULL, INTEGER, REAL, TEXT, BLOB
-    conn = sqlite3.connect(self.dbfile)
-    conn.execute('''CREATE TABLE IF NOT EXISTS sessions 
-        (sessionid integer primary key asc, 
-         starttime real, endtime real DEFAULT -1)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS session_config
-        (sessionid integer primary key asc, 
-         ultimatum_rounds integer, 
+# Types: NULL, INTEGER, REAL, TEXT, BLOB
+TABLES = [
+  Table('sessions', '''sessionid integer primary key asc,
+         starttime real, endtime real DEFAULT -1''', auto='sessionid'),
+  Table('session_config', '''sessionid integer primary key asc,
+         ultimatum_rounds integer,
          intro_sim integer,
          public_goods integer, hide_public_goods integer,
          pubgoods_mult real,
          ratings integer, timelimit real, nhumans integer,
          show_team_members integer, keep_teams integer,
          dynamic_network integer, keep_graph integer,
-         show_global_ratings integer, show_nhistory integer)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS tfsummary
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, simnum integer,
+         show_global_ratings integer, show_nhistory integer''', auto=None),
+  Table('tfsummary', '''timestamp real, sessionid integer, simnum integer,
          start_time real, end_time real, elapsed_time real, iterations integer,
          num_groups integer, singletons integer,
-         avg_switches real, avg_earnings real, 
-         human_pay real, dumb_pay real, greedy_pay real)
-         ''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS tfdata
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, simnum integer,
-         colname text, nvalue real, tvalue text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS log 
-        (rowid integer primary key asc,
-         timestamp real unique, sessionid integer, 
-        description text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS agent_config
-        (rowid integer primary key asc,
-         sessionid integer, agentid integer,
-         agenttype text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS ultimatum 
-        (rowid integer primary key asc,
-        timestamp real unique, sessionid integer, 
-        giver integer, receiver integer, 
-        amount integer, accepted integer,
-        stime real, etime real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS ultevent
-         (rowid integer primary key asc,
-          timestamp real, sessionid integer,
-          userid integer, otherid integer, 
-          eventtype text, value integer,
-          sframe integer, eframe integer,
-          stime real, etime real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS neighborlist
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
-         simnum integer, userid integer, neighbors text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS neighbors
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
-         simnum integer, userid integer, neighbor integer)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS tflog
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
+         avg_switches real, avg_earnings real,
+         human_pay real, dumb_pay real, greedy_pay real'''),
+  Table('tfdata', '''timestamp real, sessionid integer, simnum integer,
+         colname text, nvalue real, tvalue text'''),
+  Table('log', '''timestamp real unique, sessionid integer,
+         description text'''),
+  Table('agent_config', '''sessionid integer, agentid integer,
+         agenttype text'''),
+  Table('ultimatum', '''timestamp real unique, sessionid integer,
+         giver integer, receiver integer,
+         amount integer, accepted integer,
+         stime real, etime real'''),
+  Table('ultevent', '''timestamp real, sessionid integer,
+         userid integer, otherid integer,
+         eventtype text, value integer,
+         sframe integer, eframe integer,
+         stime real, etime real'''),
+  Table('neighborlist', '''timestamp real, sessionid integer,
+         simnum integer, userid integer, neighbors text'''),
+  Table('neighbors', '''timestamp real, sessionid integer,
+         simnum integer, userid integer, neighbor integer'''),
+  Table('tflog', '''timestamp real, sessionid integer,
          eventtype text, simnum integer, iternum integer,
          userid integer, otherid integer,
          currentpay real, newpay real, maxpay real,
-         nsame integer, chosen integer)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS tfevent
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
+         nsame integer, chosen integer'''),
+  Table('tfevent', '''timestamp real, sessionid integer,
          userid integer, simnum integer, iternum integer,
-         eventtype text, 
+         eventtype text,
          sframe integer, eframe integer,
-         stime real, etime real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS teamstatus
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
+         stime real, etime real'''),
+  Table('teamstatus', '''timestamp real, sessionid integer,
          eventtype text, simnum integer, internum integer,
          activeagent integer,
          agentid integer, teamid integer,
-         currentpay real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS ratingstatus
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
+         currentpay real'''),
+  Table('teamphase', '''timestamp real, sessionid integer,
+         eventtype text, simnum integer, internum integer,
+         activeagent integer,
+         phase integer, snapshot integer'''),
+  Table('teamdelta', '''sessionid integer, simnum integer, phase integer,
+         agentid integer, teamid integer,
+         currentpay real'''),
+  Table('ratingstatus', '''timestamp real, sessionid integer,
          eventtype text, simnum integer, iternum integer,
          userid integer, otherid integer,
          myrtg real, globalrtg real,
-         minrtg integer, maxrtg integer
-         )''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS globalratings
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
+         minrtg integer, maxrtg integer'''),
+  Table('globalratings', '''timestamp real, sessionid integer,
          simnum integer, iternum integer,
          userid integer, avgrating real,
-         eframe real, etime real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS tfrounds
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
+         eframe real, etime real'''),
+  Table('tfrounds', '''timestamp real, sessionid integer,
          simnum integer, userid integer, groupid integer, human integer,
-         pay real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS pglog
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
+         pay real'''),
+  Table('pglog', '''timestamp real, sessionid integer,
          simnum integer, userid integer, groupid integer,
-         contrib real, keep real, pay real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS pglog_extra
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
+         contrib real, keep real, pay real'''),
+  Table('pglog_extra', '''timestamp real, sessionid integer,
          simnum integer, userid integer, groupid integer,
          contrib real, keep real, pay real,
          avgrating real, avgcontrib real, multiplier real,
-         sharedamount real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS exitquestionids
-        (qid integer primary key asc, qtext text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS exitresponses
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
-         userid integer, qid integer, qresponse text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS introresponses 
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer, 
-         userid integer, gender text, college text, status text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS ratings
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
+         sharedamount real'''),
+  Table('exitquestionids', '''qid integer primary key asc, qtext text''', auto='qid'),
+  Table('exitresponses', '''timestamp real, sessionid integer,
+         userid integer, qid integer, qresponse text'''),
+  Table('introresponses', '''timestamp real, sessionid integer,
+         userid integer, gender text, college text, status text'''),
+  Table('ratings', '''timestamp real, sessionid integer,
          userid integer, otherid integer,
-         rating integer, 
+         rating integer,
          eframe integer, etime real,
-         simnum integer, iternum integer, step text)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS finalpay
-        (rowid integer primary key asc,
-         timestamp real, sessionid integer,
-         userid integer, pay real, exchange_rate real)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS simtime
-        (rowid integer primary key asc,
+         simnum integer, iternum integer, step text'''),
+  Table('finalpay', '''timestamp real, sessionid integer,
+         userid integer, pay real, exchange_rate real'''),
+  Table('simtime', '''timestamp real, sessionid integer,
+         simnum integer, iternum real, stime real, etime real, ttime real'''),
+  Table('sweepdone', '''fingerprint text primary key,
+         timestamp real, sessionid integer, simnum integer''', auto=None),
+  Table('graphs', '''graphid text primary key,
          timestamp real, sessionid integer,
-         simnum integer, iternum real, stime real, etime real, ttime real)''')
+         parentid text, nnodes integer, nedges integer,
+         edges text''', auto=None),
+  Table('simgraph', '''timestamp real, sessionid integer,
+         simnum integer, eventtype text, graphid text'''),
+]
+SCHEMA = dict((table.name, table) for table in TABLES)
+
+VIEWS = [
+  # Rebuilds teamstatus rows from teamphase and teamdelta: at each step,
+  # every agent's latest change at or before that step
+  '''CREATE VIEW IF NOT EXISTS teamstatus_delta AS
+        SELECT p.timestamp, p.sessionid, p.eventtype, p.simnum, p.internum,
+               p.activeagent, d.agentid, d.teamid, d.currentpay
+        FROM teamphase p JOIN teamdelta d
+          ON d.sessionid = p.sessionid AND d.simnum = p.simnum
+         AND d.phase = (SELECT max(d2.phase) FROM teamdelta d2
+                        WHERE d2.sessionid = p.sessionid 
+                          AND d2.simnum = p.simnum
+                          AND d2.agentid = d.agentid
+                          AND d2.phase <= p.phase)''',
+]
+
+# Secondary indexes, as (table, columns): the columns analysis filters on
+INDEXES = [
+  ('tfsummary', ('sessionid', 'simnum')),
+  ('tfdata', ('sessionid', 'simnum')),
+  ('agent_config', ('sessionid', 'agentid')),
+  ('ultevent', ('sessionid', 'userid')),
+  ('neighborlist', ('sessionid', 'simnum')),
+  ('neighbors', ('sessionid', 'simnum')),
+  ('tflog', ('sessionid', 'simnum', 'iternum')),
+  ('tflog', ('userid', 'sessionid')),
+  ('tfevent', ('sessionid', 'simnum', 'iternum')),
+  ('tfevent', ('userid', 'sessionid')),
+  ('teamstatus', ('sessionid', 'simnum', 'internum')),
+  ('teamphase', ('sessionid', 'simnum', 'phase')),
+  ('teamdelta', ('sessionid', 'simnum', 'agentid', 'phase')),
+  ('ratingstatus', ('sessionid', 'simnum', 'iternum')),
+  ('globalratings', ('sessionid', 'simnum', 'iternum')),
+  ('tfrounds', ('sessionid', 'simnum')),
+  ('pglog', ('sessionid', 'simnum')),
+  ('pglog_extra', ('sessionid', 'simnum')),
+  ('exitresponses', ('sessionid', 'userid')),
+  ('introresponses', ('sessionid', 'userid')),
+  ('ratings', ('sessionid', 'simnum', 'iternum')),
+  ('ratings', ('userid', 'sessionid')),
+  ('finalpay', ('sessionid', 'userid')),
+  ('simtime', ('sessionid', 'simnum')),
+  ('simgraph', ('sessionid', 'simnum')),
+]
+
+# Loggers with an insert thread or event log, closed at exit (see close())
+_loggers = weakref.WeakSet()
+
+def r2(pay):
+  """ Shorthand for 'round to 2 decimals' """
+  return round(pay, 2)
+
+class DBLogger(object):
+  """Handles logging results to SQLite3 database
+  
+  Contains numerous methods for logging all aspects of team formation.
+  Uses a threaded batch insert system to reduce database commits 
+  and improve performance.
+  
+  All writes after setup() go through the insert queue, and the insert
+  thread owns the only writing connection, so writes never wait on each 
+  other for the database lock.
+  """
+  DRAIN_MAX = 1000    # Most queued items the insert thread takes at once
+  NO_LOGGING = False  # Set to true to disable database output (see NullLogger)
+  
+  def __init__(self, dbfile, profile='wal', maxqueue=0, policy='block', 
+               newsession=True):
+    """
+    dbfile: SQLite database file name
+    profile: key of STORAGE_PROFILES
+    maxqueue: most items in the insert queue, or 0 for no limit
+    policy: what to do with inserts when the queue is full 
+            (see QUEUE_POLICIES)
+    newsession: False to open the database without starting a session 
+                (to read it, migrate it, or convert a binary log into it)
+    """
+    if policy not in QUEUE_POLICIES:
+      raise ValueError("Unknown insert queue policy: "+str(policy))
+    self.dbfile = dbfile
+    self.pragmas = STORAGE_PROFILES[profile]
+    
+    self.sessionid = None   # Init from database in self.setup()
+    if newsession:
+      self.setup()
+    
+    # Threaded producer-consumer code
+    self.insthread = None
+    self.autoins = False
+    self.insqueue = Queue.Queue(maxqueue)
+    self.policy = policy
+    self.sample_every = 10
+    self.spillfile = dbfile+'.spill'
+    self.spilllock = threading.Lock()
+    self.noverflow = 0
+    self.statlock = threading.Lock()
+    self.counts = {'items':0, 'rows':0, 'maxdepth':0, 
+                   'wait':0.0, 'maxwait':0.0,
+                   'spilled':0, 'dropped':0}
+    self.sqlcache = {}          # (table, number of columns) -> INSERT text
+    self.flush_rows = 5000      # Write batched rows once this many wait,
+    self.flush_interval = 1.0   # or once the oldest has waited this long
+    
+    self.graphids = set()       # Graphs logged by log_graph
+    self.lastgraph = None       # (graph ID, nodes, edges, deltas since full)
+    self.graph_deltas = 20      # Most deltas in a row before a full graph
+  
+  def connect(self):
+    """Open a connection to the database with the storage profile applied"""
+    conn = sqlite3.connect(self.dbfile)
+    for name, value in self.pragmas:
+      conn.execute('PRAGMA {0}={1}'.format(name, value))
+    return conn
+
+  # Team formation:
+  #   what do people apply to?
+  #     turn id, user id, group, current pay, new group pay, applied or not  (max group pay?)
+  #     (also, what have people applied to previously?)
+  #   how do people pick new teammates?
+  #     turn id, user id, applicant id, current pay, new pay, accepted or not  (max applicant pay?)
+  #     (also, who have people accepted previously?)
+  #   how do people decide what team to join?
+  #     turn id, user id, group, current pay, new group pay, joined or not  (max group pay?)
+  
+  def setup(self):
+    """Setup database schema and get new sessionid"""
+    conn = self.connect()
+    self.create_tables(conn)
+    self.create_indexes(conn)
     conn.commit()
     
     timestamp = time.time()
@@ -208,6 +327,49 @@ class DBLogger(object):
     conn.commit()
     
     conn.close()
+  
+  def migrate(self):
+    """Bring an existing database up to the current schema and indexes
+    
+    Does not start a session, so it is safe to run on old databases
+    (python db_logger.py migrate dbfile).
+    """
+    conn = self.connect()
+    self.create_tables(conn)
+    self.create_indexes(conn)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+  
+  def create_tables(self, conn):
+    """Create any missing tables (from TABLES) and views"""
+    for table in TABLES:
+      conn.execute(table.create)
+    for view in VIEWS:
+      conn.execute(view)
+  
+  def create_indexes(self, conn):
+    """Create any missing indexes from INDEXES, and the unique question index
+    
+    Older databases could store a question text more than once; those
+    duplicates are merged (keeping the lowest qid) before the unique index 
+    is built.
+    """
+    for table, columns in INDEXES:
+      conn.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({2})'.format(
+        table, '_'.join(columns), ', '.join(columns)))
+    try:
+      conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS exitquestionids_qtext
+          ON exitquestionids (qtext)''')
+    except sqlite3.IntegrityError:
+      conn.execute('''UPDATE exitresponses SET qid = 
+          (SELECT min(q2.qid) FROM exitquestionids q1 JOIN exitquestionids q2
+           ON q1.qtext = q2.qtext WHERE q1.qid = exitresponses.qid)
+          WHERE qid IN (SELECT qid FROM exitquestionids)''')
+      conn.execute('''DELETE FROM exitquestionids WHERE qid NOT IN
+          (SELECT min(qid) FROM exitquestionids GROUP BY qtext)''')
+      conn.execute('''CREATE UNIQUE INDEX exitquestionids_qtext
+          ON exitquestionids (qtext)''')
     
     
   def log_config(self, u_rounds, intro_sim, pubgoods, hide_pubgoods, 
@@ -224,27 +386,25 @@ class DBLogger(object):
         
   def log_sessionend(self):
     """Log timestamp of session end to 'sessions' table"""
+    if self.NO_LOGGING: return
     endtime = time.time()
-    conn = sqlite3.connect(self.dbfile)
-    conn.execute('UPDATE sessions SET endtime=? WHERE sessionid=?', (endtime, self.sessionid))
-    conn.commit()
-    conn.close()
+    self.queue_sql('UPDATE sessions SET endtime=? WHERE sessionid=?', 
+                   (endtime, self.sessionid))
+    self.commit()
         
   def log_gen(self, message):
     """Log generic message to 'log' table"""
     if self.NO_LOGGING: return
     timestamp = time.time()
     
-    self.queue_insert('log', (None, timestamp, self.sessionid, message))
+    self.queue_insert('log', (timestamp, self.sessionid, message))
         
   def log_summary(self, data):
     """Log sim summary statistics to a single row in 'tfsummary' table"""
     if self.NO_LOGGING: return
     timestamp = time.time()
     
-    outdata = tuple([None, timestamp, self.sessionid]+list(data))
-    
-    self.queue_insert('tfsummary', outdata)
+    self.queue_insert('tfsummary', (timestamp, self.sessionid)+tuple(data))
         
   def log_summary_gen(self, simnum, data):
     """Log all summary data values to separate rows in 'tfdata' table"""
@@ -256,10 +416,10 @@ class DBLogger(object):
     for item, value in ditems:
       try:
         v = float(value)
-        inserts.append( (None, timestamp, self.sessionid, simnum, item, v, '') )
+        inserts.append( (timestamp, self.sessionid, simnum, item, v, '') )
       except (ValueError, TypeError):
         t = str(value)
-        inserts.append( (None, timestamp, self.sessionid, simnum, item, -1, t) )
+        inserts.append( (timestamp, self.sessionid, simnum, item, -1, t) )
       except:
         print "Problem with:", item, value
     
@@ -271,9 +431,7 @@ class DBLogger(object):
     agents: list of (agent id, agent type) tuples
     """
     if self.NO_LOGGING: return
-    inserts = []
-    for aid, atype in agents:
-      inserts.append( (None, self.sessionid, aid, atype) )
+    inserts = [(self.sessionid, aid, atype) for aid, atype in agents]
     
     self.queue_insert('agent_config', inserts, many=True)
         
@@ -282,43 +440,36 @@ class DBLogger(object):
     if self.NO_LOGGING: return
     timestamp = time.time()
     
-    self.queue_insert('ultimatum', (None, timestamp, self.sessionid, p1, p2, amount, accepted, stime, etime))
+    self.queue_insert('ultimatum', (timestamp, self.sessionid, p1, p2, amount, accepted, stime, etime))
     
-  def tflog_insert(self, inserts):
-    """Log team formation event to 'tflog' table
+  def tflog_insert(self, timestamp, eventtype, simnum, iternum, userid, 
+                   otherids, currentpay, newpays, maxpay, chosen):
+    """Log the options of a team formation decision to 'tflog' table
     
     This method is generic and used by other log methods
     to log the relevant data for each step of team formation
     
-    inserts = (None, timestamp, sessionid, eventtype, 
-               simnum, iternum, userid, otherid, 
-               currentpay, newpay, maxpay, chosen)
+    otherids, newpays, chosen: one entry per option
+    The nsame column counts how many options had the same newpay.
     """
     if self.NO_LOGGING: return
-  
-    # Create a column that counts how many other options had the same value
-    # newpay is column 9 
-    # nsame is column 11
-    
-    nsames = {} # (value, count) dictionary
-    for ins in inserts:
-      nsames[ins[9]] = nsames.get(ins[9], 0)+1
     
-    # splice in the nsame column (not elegant)
-    newinserts = [ins[0:11]+(nsames[ins[9]], ins[11]) for ins in inserts]
+    nsames = collections.Counter(newpays)
+    sessionid = self.sessionid
+    inserts = [(timestamp, sessionid, eventtype, simnum, iternum, userid, 
+                   otherid, currentpay, newpay, maxpay, nsames[newpay], choice)
+               for otherid, newpay, choice in zip(otherids, newpays, chosen)]
     
-    self.queue_insert('tflog', newinserts, many=True)
+    self.queue_insert('tflog', inserts, many=True)
       
-  def tfevent_insert(self, data):
-    """Log a team formation event to 'tfevent' table
-    
-    data = (None, timestamp, sessionid, userid, simnum, iternum, 
-            eventtype, startframe, endframe, starttime, endtime)
-    """
-    
+  def tfevent_insert(self, timestamp, userid, simnum, iternum, eventtype, 
+                     sframe=-1, eframe=-1, stime=-1, etime=-1):
+    """Log a team formation event to 'tfevent' table"""
     if self.NO_LOGGING: return
     
-    self.queue_insert('tfevent', data)
+    self.queue_insert('tfevent', (
+      timestamp, self.sessionid, userid, simnum, iternum, eventtype, 
+      sframe, eframe, stime, etime))
       
   def ultevent_insert(self, userid, otherid, eventtype, value, 
                       sframe, eframe, stime, etime):
@@ -326,7 +477,7 @@ class DBLogger(object):
     if self.NO_LOGGING: return
     timestamp = time.time()
     
-    self.queue_insert('ultevent', (None, timestamp, self.sessionid, userid, otherid, eventtype, value, sframe, eframe, stime, etime))
+    self.queue_insert('ultevent', (timestamp, self.sessionid, userid, otherid, eventtype, value, sframe, eframe, stime, etime))
       
   def log_topo(self, simnum, aid, nbrids):
     """Log graph topology info to 'neighborlist' and 'neighbors' tables
@@ -339,13 +490,52 @@ class DBLogger(object):
     nbrids = sorted(nbrids)
     nbridstring = ','.join([str(nid) for nid in nbrids])
     # Insert timestamp, round, aid, str(nbrids)
-    inserts = []
-    for nid in nbrids:
-      inserts.append( (None, timestamp, self.sessionid, simnum, aid, nid) )
+    inserts = [(timestamp, self.sessionid, simnum, aid, nid) for nid in nbrids]
     
-    self.queue_insert('neighborlist', (None, timestamp, self.sessionid, simnum, aid, nbridstring))
+    self.queue_insert('neighborlist', (timestamp, self.sessionid, simnum, aid, nbridstring))
     self.queue_insert('neighbors', inserts, many=True)
       
+  def log_graph(self, simnum, adjacency, eventtype='simstart'):
+    """Log the graph of a sim to 'graphs' (once per distinct graph) and 'simgraph'
+    
+    A compact alternative to log_topo; read back with get_topo().
+    adjacency: list of (agent ID, [neighbor IDs]) for every agent
+    eventtype: 'simstart', or 'simend' for the graph after rewiring
+    
+    The graph ID is a hash of the nodes and edges, so a graph already 
+    logged (by any session) is only referenced. A graph close to the last 
+    one logged (like after rewiring) is stored as the edges added and 
+    removed since that one.
+    """
+    if self.NO_LOGGING: return
+    timestamp = time.time()
+    nodes = sorted(aid for aid, nbrids in adjacency)
+    edges = set((min(aid, nid), max(aid, nid)) 
+                for aid, nbrids in adjacency for nid in nbrids)
+    graphid = hashlib.sha1(json.dumps([nodes, sorted(edges)])).hexdigest()
+    
+    if graphid not in self.graphids:
+      parentid = None
+      depth = 0
+      data = {'nodes':nodes, 'edges':sorted(edges)}
+      if self.lastgraph is not None:
+        lastid, lastnodes, lastedges, lastdepth = self.lastgraph
+        added = edges - lastedges
+        removed = lastedges - edges
+        if (lastnodes == nodes and lastdepth < self.graph_deltas and 
+            len(added) + len(removed) < len(edges)):
+          parentid = lastid
+          depth = lastdepth+1
+          data = {'add':sorted(added), 'remove':sorted(removed)}
+      encoded = base64.b64encode(zlib.compress(json.dumps(data)))
+      self.queue_sql(SCHEMA['graphs'].insert.replace('INSERT', 'INSERT OR IGNORE', 1),
+                     (graphid, timestamp, self.sessionid, parentid, 
+                      len(nodes), len(edges), encoded))
+      self.graphids.add(graphid)
+      self.lastgraph = (graphid, nodes, edges, depth)
+    
+    self.queue_insert('simgraph', (timestamp, self.sessionid, simnum, eventtype, graphid))
+  
   def log_apply(self, simnum, iternum, aid, gids, 
                 currpay, newpays, applications, 
                 sframe=-1, eframe=-1, stime=-1, etime=-1):
@@ -356,13 +546,13 @@ class DBLogger(object):
     newpays: list of how much each new group pays
     applications: list of which group IDs applied to
     """
+    if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    maxpay = r2(max(newpays))
-    for gid, newpay in zip(gids, newpays):
-      inserts.append( (None, timestamp, self.sessionid, 'apply', simnum, iternum, aid, gid, r2(currpay), r2(newpay), maxpay, gid in applications) )
-    self.tflog_insert(inserts)
-    self.tfevent_insert( (None, timestamp, self.sessionid, aid, simnum, iternum, 'apply', sframe, eframe, stime, etime) )
+    newpays = [r2(newpay) for newpay in newpays]
+    chosen = [gid in applications for gid in gids]
+    self.tflog_insert(timestamp, 'apply', simnum, iternum, aid, gids, 
+                      r2(currpay), newpays, max(newpays), chosen)
+    self.tfevent_insert(timestamp, aid, simnum, iternum, 'apply', sframe, eframe, stime, etime)
     
   def log_accept(self, simnum, iternum, aid, naids, 
                  currpay, newpays, accepts, 
@@ -374,13 +564,13 @@ class DBLogger(object):
     newpays: list of how much each applicant would pay
     accepts: ID of agent receiving accept vote
     """
+    if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    maxpay = r2(max(newpays))
-    for aidvote, newpay in zip(naids, newpays):
-      inserts.append( (None, timestamp, self.sessionid, 'acceptvote', simnum, iternum, aid, aidvote, r2(currpay), r2(newpay), maxpay, aidvote == accepts) )
-    self.tflog_insert(inserts)
-    self.tfevent_insert( (None, timestamp, self.sessionid, aid, simnum, iternum, 'acceptvote', sframe, eframe, stime, etime) )
+    newpays = [r2(newpay) for newpay in newpays]
+    chosen = [aidvote == accepts for aidvote in naids]
+    self.tflog_insert(timestamp, 'acceptvote', simnum, iternum, aid, naids, 
+                      r2(currpay), newpays, max(newpays), chosen)
+    self.tfevent_insert(timestamp, aid, simnum, iternum, 'acceptvote', sframe, eframe, stime, etime)
     
   def log_join(self, simnum, iternum, aid, gids, 
                currpay, newpays, acceptance, 
@@ -392,13 +582,13 @@ class DBLogger(object):
     newpays: list of how much each group would pay
     acceptance: ID of group chosen to join
     """
+    if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    maxpay = r2(max(newpays))
-    for gid, newpay in zip(gids, newpays):
-      inserts.append( (None, timestamp, self.sessionid, 'join', simnum, iternum, aid, gid, r2(currpay), r2(newpay), maxpay, gid == acceptance) )
-    self.tflog_insert(inserts)
-    self.tfevent_insert( (None, timestamp, self.sessionid, aid, simnum, iternum, 'join', sframe, eframe, stime, etime) )
+    newpays = [r2(newpay) for newpay in newpays]
+    chosen = [gid == acceptance for gid in gids]
+    self.tflog_insert(timestamp, 'join', simnum, iternum, aid, gids, 
+                      r2(currpay), newpays, max(newpays), chosen)
+    self.tfevent_insert(timestamp, aid, simnum, iternum, 'join', sframe, eframe, stime, etime)
     
   def log_expel(self, simnum, iternum, aid, naids, 
                 currpay, newpays, expels, 
@@ -412,12 +602,11 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    maxpay = r2(max(newpays))
-    for aide, newpay in zip(naids, newpays):
-      inserts.append( (None, timestamp, self.sessionid, 'expelvote', simnum, iternum, aid, aide, r2(currpay), r2(newpay), maxpay, aid == expels) )
-    self.tflog_insert(inserts)
-    self.tfevent_insert( (None, timestamp, self.sessionid, aid, simnum, iternum, 'expelvote', sframe, eframe, stime, etime) )
+    newpays = [r2(newpay) for newpay in newpays]
+    chosen = [aid == expels for aide in naids]
+    self.tflog_insert(timestamp, 'expelvote', simnum, iternum, aid, naids, 
+                      r2(currpay), newpays, max(newpays), chosen)
+    self.tfevent_insert(timestamp, aid, simnum, iternum, 'expelvote', sframe, eframe, stime, etime)
   
   def log_conclusion(self, groups, simnum):
     """Log final group id and pay to 'tfrounds' table
@@ -432,7 +621,7 @@ class DBLogger(object):
       gid = g.id
       for a in g.agents:
         #pay = a.nowpay
-        inserts.append( (None, timestamp, self.sessionid, simnum, a.id, gid, (1 if a.type=='human' else 0), pay) )
+        inserts.append( (timestamp, self.sessionid, simnum, a.id, gid, (1 if a.type=='human' else 0), pay) )
     
     self.queue_insert('tfrounds', inserts, many=True)
     
@@ -452,17 +641,17 @@ class DBLogger(object):
     if self.NO_LOGGING: return
     timestamp = time.time()
     iternum = -1
-    inserts = []
-    for otherid, othercontrib in zip(otherids, othercontribs):
-      inserts.append( (None, timestamp, self.sessionid, 'pubgood', simnum, iternum, userid, otherid, usercontrib, othercontrib, usercontrib+keep, -1) )   # A little hacky to shove this into tflog, but we'll leave it for now.
-    self.tflog_insert(inserts)
+    # A little hacky to shove this into tflog, but we'll leave it for now.
+    self.tflog_insert(timestamp, 'pubgood', simnum, iternum, userid, otherids, 
+                      usercontrib, othercontribs, usercontrib+keep, 
+                      [-1]*len(otherids))
     # currentpay = usercontrib
     # newpay = othercontrib
     # maxpay = amount group earned
     
-    #self.queue_insert('pglog', (None, timestamp, self.sessionid, simnum, userid, gid, usercontrib, keep, pay))
+    #self.queue_insert('pglog', (timestamp, self.sessionid, simnum, userid, gid, usercontrib, keep, pay))
     
-    self.tfevent_insert( (None, timestamp, self.sessionid, userid, simnum, iternum, 'pubgood', sframe, eframe, stime, etime) )
+    self.tfevent_insert(timestamp, userid, simnum, iternum, 'pubgood', sframe, eframe, stime, etime)
     
   def log_all_pubgoods(self, simnum, pgtuples): 
     """Log pubgoods data to 'pglog' table
@@ -471,9 +660,8 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    for agentid, groupid, contrib, keep, pay in pgtuples:
-      inserts.append( (None, timestamp, self.sessionid, simnum, agentid, groupid, contrib, keep, pay) )
+    inserts = [(timestamp, self.sessionid, simnum, agentid, groupid, contrib, keep, pay)
+               for agentid, groupid, contrib, keep, pay in pgtuples]
     self.queue_insert('pglog', inserts, many=True)
     
   def log_all_pubgoods_extra(self, simnum, pgtuples): 
@@ -486,8 +674,8 @@ class DBLogger(object):
     inserts = []
     exinserts = []
     for agentid, groupid, contrib, keep, pay, avgrating, avgcontrib, multiplier, sharedamount in pgtuples:
-      inserts.append( (None, timestamp, self.sessionid, simnum, agentid, groupid, contrib, keep, pay) )
-      exinserts.append( (None, timestamp, self.sessionid, simnum, agentid, groupid, contrib, keep, pay, avgrating, avgcontrib, multiplier, sharedamount) )
+      inserts.append( (timestamp, self.sessionid, simnum, agentid, groupid, contrib, keep, pay) )
+      exinserts.append( (timestamp, self.sessionid, simnum, agentid, groupid, contrib, keep, pay, avgrating, avgcontrib, multiplier, sharedamount) )
     self.queue_insert('pglog', inserts, many=True)
     self.queue_insert('pglog_extra', exinserts, many=True)
     
@@ -500,12 +688,26 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    for gid, gmembers, gpay in gdata:
-      for aid in gmembers:
-        inserts.append( (None, timestamp, self.sessionid, eventtype, simnum, iternum, activeagent, aid, gid, gpay) )
+    inserts = [(timestamp, self.sessionid, eventtype, simnum, iternum, activeagent, aid, gid, gpay)
+               for gid, gmembers, gpay in gdata for aid in gmembers]
     
     self.queue_insert('teamstatus', inserts, many=True)
+  
+  def log_teamdelta(self, simnum, phase, iternum, eventtype, changes, activeagent=-1, snapshot=False):
+    """Log one team status step to 'teamphase', and its changes to 'teamdelta'
+    
+    A compact alternative to log_teamstatus; read back with the 
+    teamstatus_delta view or get_teamdelta().
+    phase: number of this step in the sim (starting at 0)
+    changes = (agent ID, group ID, group pay) for each agent whose team
+              or pay changed since the last step (or every agent if snapshot)
+    """
+    if self.NO_LOGGING: return
+    timestamp = time.time()
+    self.queue_insert('teamphase', (timestamp, self.sessionid, eventtype, simnum, iternum, activeagent, phase, int(snapshot)))
+    if changes:
+      inserts = [(self.sessionid, simnum, phase, aid, gid, gpay) for aid, gid, gpay in changes]
+      self.queue_insert('teamdelta', inserts, many=True)
         
   def log_ratings(self, logdata):
     """Log each agent's ratings of the other agents to 'ratings' table
@@ -514,10 +716,8 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    iternum = -1
-    inserts = []
-    for userid, otherid, rating, eframe, etime, simnum, iternum, step in logdata:
-      inserts.append( (None, timestamp, self.sessionid, userid, otherid, rating, eframe, etime, simnum, iternum, step) )
+    inserts = [(timestamp, self.sessionid, userid, otherid, rating, eframe, etime, simnum, iternum, step)
+               for userid, otherid, rating, eframe, etime, simnum, iternum, step in logdata]
     
     self.queue_insert('ratings', inserts, many=True)
       
@@ -532,9 +732,8 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    for otherid, myrtg, globalrtg, minrtg, maxrtg in zip(otherids, myrtgs, globalrtgs, minrtgs, maxrtgs):
-      inserts.append( (None, timestamp, self.sessionid, eventtype, simnum, iternum, aid, otherid, myrtg, globalrtg, minrtg, maxrtg) )
+    inserts = [(timestamp, self.sessionid, eventtype, simnum, iternum, aid, otherid, myrtg, globalrtg, minrtg, maxrtg)
+               for otherid, myrtg, globalrtg, minrtg, maxrtg in zip(otherids, myrtgs, globalrtgs, minrtgs, maxrtgs)]
     
     self.queue_insert('ratingstatus', inserts, many=True)
       
@@ -545,9 +744,8 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    for aid, rating in aidratingdict.iteritems():
-      inserts.append( (None, timestamp, self.sessionid, simnum, iternum, aid, rating, eframe, etime) )
+    inserts = [(timestamp, self.sessionid, simnum, iternum, aid, rating, eframe, etime) 
+               for aid, rating in aidratingdict.iteritems()]
     
     self.queue_insert('globalratings', inserts, many=True)
       
@@ -556,41 +754,158 @@ class DBLogger(object):
     
     responses = (gender, college, status)
     """
+    if self.NO_LOGGING: return
     timestamp = time.time()
     gender, college, status = responses
     
-    self.queue_insert('introresponses', (None, timestamp, self.sessionid, aid, gender, college, status))
-    
-  def get_qid(self, qtext, conn):
-    """Get exit survey question ID, given a question's text
+    self.queue_insert('introresponses', (timestamp, self.sessionid, aid, gender, college, status))
     
-    If question's text is not found, add it to 'exitquestionids' table
-    """
-    q = conn.execute('SELECT qid FROM exitquestionids WHERE qtext = ?', (qtext,) )
-    result = q.fetchone()
-    if result is not None:
-      return result[0]
-    else:
-      conn.execute('INSERT INTO exitquestionids(qtext) VALUES (?)', (qtext,))
-      q = conn.execute('SELECT qid FROM exitquestionids WHERE qtext = ?', (qtext,) )
-      result = q.fetchone()
-      if result is not None:
-        return result[0]
-      else:
-        raise KeyError("qtext not found in exitquestionids after creation!")
-
   def log_exitsurvey(self, aid, responses):
     """Log exit survey responses to 'exitresponses'
     
     responses = (question text, question response)
+    Question texts are stored once in 'exitquestionids', and each response
+    refers to its question by ID.
     """
+    if self.NO_LOGGING: return
     timestamp = time.time()
-    conn = sqlite3.connect(self.dbfile) # KEEP
-    for qtext, qresponse in responses:
-      qid = self.get_qid(qtext, conn)
-      conn.execute('INSERT INTO exitresponses VALUES (?,?,?,?,?,?)', (None, timestamp, self.sessionid, aid, qid, qresponse))
-    conn.commit() # KEEP
-    conn.close() # KEEP
+    self.queue_sql('''INSERT INTO exitquestionids(qtext) SELECT ? 
+        WHERE NOT EXISTS (SELECT 1 FROM exitquestionids WHERE qtext = ?)''', 
+        [(qtext, qtext) for qtext, qresponse in responses], many=True)
+    self.queue_sql('''INSERT INTO exitresponses 
+        (timestamp, sessionid, userid, qid, qresponse) VALUES (?,?,?,
+        (SELECT min(qid) FROM exitquestionids WHERE qtext = ?), ?)''', 
+        [(timestamp, self.sessionid, aid, qtext, qresponse) 
+         for qtext, qresponse in responses], many=True)
+    self.commit()
+  
+  def log_sweepdone(self, fingerprint, simnum):
+    """Record a completed sweep configuration in 'sweepdone'
+    
+    Committed right away, together with the configuration's results 
+    queued before it (including any spilled from a full queue), so that 
+    an interrupted sweep knows exactly which results it has already written.
+    """
+    if self.NO_LOGGING: return
+    self.requeue_spilled()
+    timestamp = time.time()
+    self.queue_sql('INSERT OR REPLACE INTO sweepdone VALUES (?,?,?,?)', 
+                   (fingerprint, timestamp, self.sessionid, simnum))
+    self.commit()
+  
+  def get_sweepdone(self):
+    """Return the set of fingerprints of completed sweep configurations"""
+    conn = self.connect()
+    done = set(row[0] for row in conn.execute('SELECT fingerprint FROM sweepdone'))
+    conn.close()
+    return done
+  
+  def select_rows(self, instable, where, params):
+    """Return the rows of a table matching where, as its Row namedtuples"""
+    table = SCHEMA[instable]
+    conn = self.connect()
+    rows = conn.execute('SELECT {0} FROM {1} WHERE {2} ORDER BY rowid'.format(
+      ', '.join(table.fields), instable, where), params).fetchall()
+    conn.close()
+    return [table.Row._make(row) for row in rows]
+  
+  def get_teamstatus(self, sessionid, simnum):
+    """Return the team status of one sim, in the order it was logged
+    
+    Returns a list of teamstatus Rows. Reads 'teamstatus', or the delta 
+    tables if the sim was logged in 'delta' mode (see get_teamdelta).
+    """
+    rows = self.select_rows('teamstatus', 'sessionid=? AND simnum=?', 
+                            (sessionid, simnum))
+    if not rows:
+      rows = self.get_teamdelta(sessionid, simnum)
+    return rows
+  
+  def get_decisions(self, userid, sessionid=None):
+    """Return a user's team formation choices, as a list of tflog Rows
+    
+    sessionid: only this session, or None for every session
+    """
+    if sessionid is None:
+      return self.select_rows('tflog', 'userid=?', (userid,))
+    return self.select_rows('tflog', 'userid=? AND sessionid=?', 
+                            (userid, sessionid))
+  
+  def get_teamdelta(self, sessionid, simnum):
+    """Return the full team status of one sim logged by log_teamdelta
+    
+    Returns a list of teamstatus Rows, in step order.
+    Faster than the teamstatus_delta view for a whole sim.
+    """
+    conn = self.connect()
+    deltas = {}
+    for phase, aid, gid, gpay in conn.execute(
+        'SELECT phase, agentid, teamid, currentpay FROM teamdelta '
+        'WHERE sessionid=? AND simnum=? ORDER BY phase, rowid', (sessionid, simnum)):
+      deltas.setdefault(phase, []).append( (aid, gid, gpay) )
+    phases = conn.execute(
+        'SELECT timestamp, eventtype, internum, activeagent, phase FROM teamphase '
+        'WHERE sessionid=? AND simnum=? ORDER BY phase', (sessionid, simnum)).fetchall()
+    conn.close()
+    
+    Row = SCHEMA['teamstatus'].Row
+    rows = []
+    state = {}
+    for timestamp, eventtype, iternum, activeagent, phase in phases:
+      for aid, gid, gpay in deltas.get(phase, ()):
+        state[aid] = (gid, gpay)
+      for aid in sorted(state):
+        gid, gpay = state[aid]
+        rows.append( Row(timestamp, sessionid, eventtype, simnum, iternum, activeagent, aid, gid, gpay) )
+    return rows
+  
+  def get_graph(self, graphid):
+    """Return (nodes, edges) of a graph logged by log_graph
+    
+    edges: sorted list of (agent ID, agent ID) pairs, lowest ID first
+    """
+    conn = self.connect()
+    chain = []
+    while graphid is not None:
+      graphid, encoded = conn.execute(
+        'SELECT parentid, edges FROM graphs WHERE graphid=?', (graphid,)).fetchone()
+      chain.append(json.loads(zlib.decompress(base64.b64decode(encoded))))
+    conn.close()
+    
+    full = chain.pop()
+    nodes = full['nodes']
+    edges = set(tuple(edge) for edge in full['edges'])
+    for delta in reversed(chain):
+      edges.update(tuple(edge) for edge in delta['add'])
+      edges.difference_update(tuple(edge) for edge in delta['remove'])
+    return nodes, sorted(edges)
+  
+  def get_topo(self, sessionid, simnum, eventtype='simstart'):
+    """Return the neighbors of each agent in a sim, as {agent ID: [neighbor IDs]}
+    
+    Reads the graph from log_graph, or 'neighborlist' if the sim was 
+    logged with log_topo (which has only the 'simstart' graph).
+    """
+    conn = self.connect()
+    row = conn.execute('''SELECT graphid FROM simgraph 
+        WHERE sessionid=? AND simnum=? AND eventtype=?''', 
+        (sessionid, simnum, eventtype)).fetchone()
+    if row is None:
+      rows = conn.execute('''SELECT userid, neighbors FROM neighborlist
+          WHERE sessionid=? AND simnum=? ORDER BY rowid''', (sessionid, simnum)).fetchall()
+      conn.close()
+      return dict((aid, [int(nid) for nid in nbrs.split(',') if nid]) 
+                  for aid, nbrs in rows)
+    conn.close()
+    
+    nodes, edges = self.get_graph(row[0])
+    topo = dict((aid, []) for aid in nodes)
+    for a, b in edges:
+      topo[a].append(b)
+      topo[b].append(a)
+    for nbrids in topo.itervalues():
+      nbrids.sort()
+    return topo
   
   def log_finalpay(self, paydata):
     """Log final pay for each agent to 'finalpay' table
@@ -599,48 +914,264 @@ class DBLogger(object):
     """
     if self.NO_LOGGING: return
     timestamp = time.time()
-    inserts = []
-    for userid, pay in paydata:
-      inserts.append( (None, timestamp, self.sessionid, userid, pay, Configuration.exchange_rate) )
+    inserts = [(timestamp, self.sessionid, userid, pay, Configuration.exchange_rate) 
+               for userid, pay in paydata]
     
     self.queue_insert('finalpay', inserts, many=True)
         
+  def log_delays(self, simnum, iternum, delays):
+    """Log sim agent delays from a virtual clock to 'tfevent' table
+    
+    delays: list of (userid, eventtype, starttime, endtime)
+    """
+    if self.NO_LOGGING: return
+    timestamp = time.time()
+    
+    inserts = [(timestamp, self.sessionid, userid, simnum, iternum, eventtype, -1, -1, stime, etime)
+               for userid, eventtype, stime, etime in delays]
+    self.queue_insert('tfevent', inserts, many=True)
+  
   def log_simtime(self, simnum, iternum, stime, etime):
     """Log elapsed time of a simulation round to 'simtime' table"""
     if self.NO_LOGGING: return
     timestamp = time.time()
     
-    self.queue_insert('simtime', (None, timestamp, self.sessionid, simnum, iternum, stime, etime, etime-stime))
+    self.queue_insert('simtime', (timestamp, self.sessionid, simnum, iternum, stime, etime, etime-stime))
         
   def queue_insert(self, instable, instuple, many=False):
     """Queue an insert for the database
     
     instable:  the table in which to make the insert
-    instuple:  tuple of values for each column, or list of these tuples
+    instuple:  tuple of values for each of the table's fields (see Table),
+               or list of these tuples
     many: False if this is a single insert, True if instuple is a list
           (decides whether to use execute or executemany to make the insert)
+    
+    If the queue is full, follows self.policy (see QUEUE_POLICIES)
+    """
+    self.put( (instable, instuple, many), len(instuple) if many else 1 ) 
+  
+  def queue_sql(self, sql, params, many=False):
+    """Queue any other write for the database (made by the insert thread)
+    
+    params: tuple of parameters for sql, or list of these tuples if many
+    Always waits for room in the queue.
+    """
+    self.put( (None, (sql, params), many) )
+  
+  def commit(self):
+    """Ask the insert thread to commit everything queued so far"""
+    self.put(_COMMIT)
+  
+  def put(self, item, nrows=0):
+    """Add an item to the insert queue, and update the queue statistics.
+    
+    nrows: number of rows inserted by item, or 0 if it is not an insert
+           (only inserts are spilled or dropped when the queue is full)
     """
-    self.insqueue.put( (instable, instuple, many) ) 
+    start = time.time()
+    if nrows and self.policy != 'block':
+      try:
+        self.insqueue.put(item, False)
+      except Queue.Full:
+        self.overflow(item, nrows)
+    else:
+      self.insqueue.put(item)
+    wait = time.time() - start
+    depth = self.insqueue.qsize()
+    with self.statlock:
+      counts = self.counts
+      counts['items'] += 1
+      counts['rows'] += nrows
+      counts['wait'] += wait
+      counts['maxwait'] = max(counts['maxwait'], wait)
+      counts['maxdepth'] = max(counts['maxdepth'], depth)
+  
+  def requeue(self, item):
+    """Queue an item returned by drain_inserts (in another process) again
+    
+    Only table inserts may be spilled or dropped by self.policy.
+    """
+    instable, instuple, many = item
+    if instable is None:    # queue_sql or _COMMIT
+      self.put(item)
+    else:
+      self.put(item, len(instuple) if many else 1)
+  
+  def overflow(self, item, nrows):
+    """Handle an insert that did not fit in the queue, by self.policy"""
+    if self.policy == 'spill':
+      instable, instuple, many = item
+      line = json.dumps([instable, instuple, many])
+      with self.spilllock:
+        with open(self.spillfile, 'a') as f:
+          f.write(line+'\n')
+      with self.statlock:
+        self.counts['spilled'] += nrows
+    else:   # 'sample'
+      with self.statlock:
+        self.noverflow += 1
+        keep = self.noverflow % self.sample_every == 0
+        if not keep:
+          self.counts['dropped'] += nrows
+      if keep:
+        self.insqueue.put(item)
+  
+  def requeue_spilled(self):
+    """Queue the inserts from the spill file again, and remove it.
+    
+    Waits for room in the queue, so do not call from the insert thread.
+    """
+    replayfile = self.spillfile+'.replay'
+    with self.spilllock:
+      if not os.path.exists(self.spillfile):
+        return
+      os.rename(self.spillfile, replayfile)
+    with open(replayfile) as f:
+      for line in f:
+        self.insqueue.put(tuple(json.loads(line)))
+    os.remove(replayfile)
+  
+  def stats(self):
+    """Return a dictionary of insert queue statistics:
+    
+    depth: items in the queue now; maxdepth: most items seen in the queue
+    items, rows: number of items and inserted rows queued
+    wait, maxwait: total and longest time (seconds) spent queueing an item
+    spilled, dropped: rows spilled to the spill file, or dropped
+    """
+    with self.statlock:
+      stats = dict(self.counts)
+    stats['depth'] = self.insqueue.qsize()
+    return stats
+  
+  def insert_sql(self, instable, ncols):
+    """INSERT statement for a table with ncols columns.
+    
+    Rows of the table's fields use its generated statement; 
+    other rows must give every column (including rowid).
+    The text is cached, so it is built once per table, and sqlite3 finds
+    its prepared statement in the connection's statement cache.
+    """
+    sql = self.sqlcache.get( (instable, ncols) )
+    if sql is None:
+      table = SCHEMA.get(instable)
+      if table is not None and len(table.fields) == ncols:
+        sql = table.insert
+      else:
+        sql = 'INSERT INTO '+instable+' VALUES (?'+',?'*(ncols-1)+')'
+      self.sqlcache[(instable, ncols)] = sql
+    return sql
+  
+  def batch_item(self, batch, item):
+    """Add the rows of a queued insert to batch, a dictionary of 
+       (table, number of columns) -> list of rows"""
+    instable, instuple, many = item
+    if not many:
+      instuple = [instuple]
+    if len(instuple) and len(instuple[0]):  # Ensure at least one insert exists
+      batch.setdefault( (instable, len(instuple[0])), [] ).extend(instuple)
+  
+  def write_batch(self, conn, batch):
+    """Write all rows in batch, with one executemany per table, and 
+       empty it. Returns True if there were any rows."""
+    wrote = bool(batch)
+    for (instable, ncols), rows in batch.iteritems():
+      try:
+        conn.executemany(self.insert_sql(instable, ncols), rows)
+      except sqlite3.Error as e:
+        print "Database write failed:", e, instable
+    batch.clear()
+    return wrote
+  
+  def write_item(self, conn, item):
+    """Make one write queued with queue_sql"""
+    instable, (sql, params), many = item
+    try:
+      if many:
+        conn.executemany(sql, params)
+      else:
+        conn.execute(sql, params)
+    except sqlite3.Error as e:
+      print "Database write failed:", e, sql
+  
+  def write_items(self, conn, items, batch, commits=False):
+    """Write or batch each queued item, in order.
+    
+    Inserts are added to batch; any other write (or commit) first writes 
+    the batch, so it sees every insert queued before it.
+    
+    commits: True if conn has writes not yet committed
+    Returns:
+      the new value of commits
+    """
+    for item in items:
+      instable, instuple, many = item
+      if instable is not None:
+        self.batch_item(batch, item)
+        continue
+      commits = self.write_batch(conn, batch) or commits
+      if instuple is None:    # _COMMIT, possibly unpickled from a worker
+        conn.commit()
+        commits = False
+      else:
+        self.write_item(conn, item)
+        commits = True
+    return commits
+  
+  def convert_binlog(self, logfile):
+    """Write the records of a binary event log (see BinaryLogger) to the 
+       database, and return the number of records"""
+    conn = self.connect()
+    self.create_tables(conn)
+    batch = {}
+    items = []
+    nrecords = 0
+    for item in read_binlog(logfile):
+      items.append(item)
+      if len(items) >= self.DRAIN_MAX:
+        self.write_items(conn, items, batch)
+        self.write_batch(conn, batch)
+        nrecords += len(items)
+        items = []
+    self.write_items(conn, items, batch)
+    self.write_batch(conn, batch)
+    nrecords += len(items)
+    conn.commit()
+    conn.close()
+    return nrecords
+  
+  def get_items(self, timeout):
+    """Wait up to timeout for a queued item, and return it along with any 
+       others already waiting (up to DRAIN_MAX). Raises Queue.Empty."""
+    items = [self.insqueue.get(block=True, timeout=timeout)]
+    try:
+      while len(items) < self.DRAIN_MAX:
+        items.append(self.insqueue.get(False))
+    except Queue.Empty:
+      pass
+    return items
   
   def batch_inserts(self, forcecommit=True):
-    """Insert all items from self.insqueue and commit if forcecommit is set."""
-    conn = sqlite3.connect(self.dbfile)
-    while not self.insqueue.empty():
+    """Insert all items from self.insqueue and commit if forcecommit is set.
+    
+    Only for use when the insert thread is not running.
+    """
+    conn = self.connect()
+    batch = {}
+    while True:
       try:
-        instable, instuple, many = self.insqueue.get(False)
+        items = self.get_items(0)
       except Queue.Empty:
         break
-      else:
-        if not many:
-          nqs = len(instuple)-1
-          conn.execute('INSERT INTO '+instable+' VALUES (?'+',?'*nqs+')', instuple)
-        elif len(instuple):     # Ensure at least one insert exists
-          nqs = len(instuple[0])-1
-          conn.executemany('INSERT INTO '+instable+' VALUES (?'+',?'*nqs+')', instuple)
+      self.write_items(conn, items, batch)
+      for item in items:
         self.insqueue.task_done()
+    self.write_batch(conn, batch)
             
     if forcecommit:
       conn.commit()
+    conn.close()
     
   def batch_insert_thread(self):
     """Thread that makes batch inserts from self.insqueue
@@ -648,33 +1179,42 @@ class DBLogger(object):
     Speeds up performance by minimizing number of commits 
     for bursts of inserts.
     
-    Get all waiting inserts and execute them.
-    Once no inserts come in for 2 seconds, commit all inserts.
+    Take all waiting items from the queue at once, and collect their rows 
+    by table. Write them with one executemany per table once 
+    self.flush_rows rows are waiting, or the oldest has waited 
+    self.flush_interval seconds.
+    Once no inserts come in for 2 seconds, or when commit() is called, 
+    commit all inserts.
     Continue while self.autoins
+    
+    This thread's connection is the only one that writes to the database.
     """
     print "Database insert thread started"
+    Empty = Queue.Empty     # Module globals may be gone at interpreter exit
     commits = False
-    conn = sqlite3.connect(self.dbfile)
+    batch = {}
+    oldest = 0    # When the oldest row in batch was queued (about)
+    conn = self.connect()
     while self.autoins:
       try:
-        instable, instuple, many = self.insqueue.get(block=True, timeout=2.0)
-        if not many:
-          nqs = len(instuple)-1
-          conn.execute('INSERT INTO '+instable+' VALUES (?'+',?'*nqs+')', instuple)
-        elif len(instuple):     # Ensure at least one insert exists
-          nqs = len(instuple[0])-1
-          conn.executemany('INSERT INTO '+instable+' VALUES (?'+',?'*nqs+')', instuple)
-        self.insqueue.task_done()
-        
-        if self.forcecommit:
-          conn.commit()
-        else:
-          commits = True
-      except Queue.Empty:
+        items = self.get_items(2.0)
+      except Empty:
+        commits = self.write_batch(conn, batch) or commits
         if commits:
           conn.commit()
           commits = False
-      self.forcecommit = False
+        continue
+      if not batch:
+        oldest = time.time()
+      commits = self.write_items(conn, items, batch, commits)
+      nrows = sum(len(rows) for rows in batch.itervalues())
+      if nrows >= self.flush_rows or (nrows and 
+                                      time.time() - oldest >= self.flush_interval):
+        commits = self.write_batch(conn, batch) or commits
+      for item in items:
+        self.insqueue.task_done()
+    self.write_batch(conn, batch)
+    conn.commit()
     conn.close()
     print "Database insert thread ended"
     
@@ -684,15 +1224,30 @@ class DBLogger(object):
     t = threading.Thread(target=self.batch_insert_thread)
     self.insthread = t
     
-    # Note that this could lose data! 
-    # But also makes it easier to quit the server...
+    # A daemon thread makes it easier to quit the server; close() (also
+    # called at exit) makes sure nothing queued is lost.
     t.daemon = True
     
     t.start()
+    _loggers.add(self)
     
   def stop_batch_insert_thread(self):
     """End the batch insert thread"""
     self.autoins = False
+  
+  def close(self):
+    """Write everything queued (and spilled), and stop the insert thread"""
+    if self.insthread is None or not self.insthread.is_alive():
+      return
+    self.flush_inserts()
+    self.autoins = False
+    self.commit()   # Wake the thread up, so it sees autoins
+    self.insthread.join()
+    self.insthread = None
+    stats = self.stats()
+    if stats['spilled'] or stats['dropped']:
+      print "Database inserts: {0} rows, {1} spilled, {2} dropped".format(
+        stats['rows'], stats['spilled'], stats['dropped'])
     
   def __del__(self):
     """On object destruction, do inserts and end the batch insert thread"""
@@ -701,5 +1256,163 @@ class DBLogger(object):
       self.insthread.join()
 
   def flush_inserts(self):
-    """Ensure that insert queue is empty"""
+    """Ensure that insert queue is empty, and everything is committed"""
+    self.requeue_spilled()
+    self.commit()
     self.insqueue.join()
+
+  def detach(self):
+    """Make this logger hold its inserts instead of writing them.
+    
+    For use in a worker process that inherited (forked) a copy of the 
+    parent's logger: the insert queue is replaced with a fresh one, 
+    and the parent writes whatever drain_inserts() returns.
+    """
+    self.autoins = False
+    self.insthread = None
+    self.insqueue = Queue.Queue()
+  
+  def drain_inserts(self):
+    """Remove and return all queued inserts as (table, tuple, many)"""
+    inserts = []
+    while True:
+      try:
+        inserts.append(self.insqueue.get(False))
+      except Queue.Empty:
+        return inserts
+      self.insqueue.task_done()
+
+
+
+class BinaryLogger(DBLogger):
+  """A DBLogger that appends its writes to a binary event log
+  
+  Each queued write becomes one record in dbfile+'.binlog': a 4-byte 
+  length, then the pickled (table, rows, many) queue item. Writing costs 
+  a pickle and a buffered append in the calling thread, with no insert 
+  thread or SQLite work; 'python db_logger.py convert' writes the records
+  to the database afterwards.
+  
+  The database is still used for the schema, the session ID and reads,
+  so reads (like get_sweepdone) do not see the log until it is converted.
+  """
+  BUFFER_MAX = 65536    # Write out the buffer once it holds this many bytes
+  
+  def __init__(self, dbfile, *args, **kwargs):
+    DBLogger.__init__(self, dbfile, *args, **kwargs)
+    self.logfile = dbfile+'.binlog'
+    self.loglock = threading.Lock()
+    self.buf = bytearray()
+    self.fd = os.open(self.logfile, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+    _loggers.add(self)
+  
+  def put(self, item, nrows=0):
+    if self.fd is None:     # Detached: hold the item for drain_inserts
+      DBLogger.put(self, item, nrows)
+      return
+    instable, instuple, many = item
+    if instable is None and instuple is None:   # _COMMIT
+      self.flush_log()
+      return
+    data = cPickle.dumps(item, 2)
+    with self.loglock:
+      self.buf += BINLOG_HEADER.pack(len(data))
+      self.buf += data
+      if len(self.buf) >= self.BUFFER_MAX:
+        self.write_log()
+  
+  def write_log(self):
+    """Write out the buffer (call with loglock)"""
+    while self.buf:
+      del self.buf[:os.write(self.fd, self.buf)]
+  
+  def flush_log(self):
+    with self.loglock:
+      if self.fd is not None:
+        self.write_log()
+  
+  def start_batch_insert_thread(self):
+    pass      # Records are written by the caller
+  
+  def flush_inserts(self):
+    self.flush_log()
+  
+  def close(self):
+    with self.loglock:
+      if self.fd is not None:
+        self.write_log()
+        os.close(self.fd)
+        self.fd = None
+  
+  def detach(self):
+    # Drop the parent's buffer and file without writing them: the parent
+    # writes its own, and this process's inserts go back to the parent
+    DBLogger.detach(self)
+    self.buf = bytearray()
+    self.fd = None
+
+
+class NullLogger(DBLogger):
+  """A DBLogger that logs nothing, and never opens the database"""
+  NO_LOGGING = True
+  
+  def setup(self):
+    self.sessionid = 0
+  
+  def put(self, item, nrows=0):
+    pass
+  
+  def start_batch_insert_thread(self):
+    pass
+  
+  def flush_inserts(self):
+    pass
+  
+  def get_sweepdone(self):
+    return set()
+
+
+# Values of Configuration._log_sink
+LOG_SINKS = {'sqlite':DBLogger, 'binlog':BinaryLogger, 'null':NullLogger}
+
+
+def read_binlog(logfile):
+  """Yield the queue items recorded in a binary event log.
+  
+  Stops at a truncated last record (from a crash while writing).
+  """
+  with open(logfile, 'rb') as f:
+    while True:
+      header = f.read(BINLOG_HEADER.size)
+      if not header:
+        return
+      data = ''
+      if len(header) == BINLOG_HEADER.size:
+        size, = BINLOG_HEADER.unpack(header)
+        data = f.read(size)
+      if len(header) < BINLOG_HEADER.size or len(data) < size:
+        print "Ignoring truncated record at the end of", logfile
+        return
+      yield cPickle.loads(data)
+
+
+@atexit.register
+def _close_loggers():
+  """Drain the insert queues before the interpreter tears down modules"""
+  for dblog in list(_loggers):
+    dblog.close()
+
+
+if __name__ == '__main__':
+  import sys
+  if len(sys.argv) == 3 and sys.argv[1] == 'migrate':
+    DBLogger(sys.argv[2], newsession=False).migrate()
+  elif len(sys.argv) == 4 and sys.argv[1] == 'convert':
+    n = DBLogger(sys.argv[3], newsession=False).convert_binlog(sys.argv[2])
+    print n, "records written to", sys.argv[3]
+  else:
+    print "Usage: python db_logger.py migrate dbfile"
+    print "  adds any missing tables and indexes to an existing database"
+    print "       python db_logger.py convert logfile dbfile"
+    print "  writes a binary event log (from the 'binlog' sink) to a database"
+    sys.exit(1)
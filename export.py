@@ -0,0 +1,231 @@
+#
+# export.py - exports a session database to columnar (Parquet/Arrow) files
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Exports the tables of a simlog database to Parquet or Arrow files.
+
+Usage: python export.py dbfile outdir [--format parquet|arrow]
+                        [--chunk rows] [table ...]
+
+Each table is read in chunks of rows and written to typed columnar files,
+partitioned like Hive datasets:
+  outdir/table/sessionid=1/simnum=2/part-0.parquet
+(tables without a simnum column are partitioned by sessionid only).
+Only one chunk is held in memory at a time, whatever the database size.
+
+'tfdata' (one row per summary value) is written as 'tfdata_wide' instead,
+with one row per sim and one column per summary value.
+
+Needs the pyarrow package.
+"""
+
+import os
+import sys
+import sqlite3
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+
+CHUNK_ROWS = 50000
+FORMATS = {'parquet':'.parquet', 'arrow':'.arrow'}
+PARTITION_COLUMNS = ('sessionid', 'simnum')
+
+
+def arrow_type(decltype):
+  """Return the Arrow type for a declared SQLite column type"""
+  decltype = decltype.lower()
+  if 'int' in decltype:
+    return pa.int64()
+  if 'real' in decltype:
+    return pa.float64()
+  return pa.string()
+
+
+class PartitionWriter(object):
+  """Writes chunks of rows to one file per partition.
+
+  Rows must arrive sorted by partition, so only one file is open at a time.
+  """
+  def __init__(self, outdir, schema, partcols, fmt='parquet'):
+    self.outdir = outdir
+    self.schema = schema
+    self.partcols = partcols
+    self.fmt = fmt
+    self.key = None
+    self.writer = None
+    self.nfiles = 0
+    self.nrows = 0
+
+  def open(self, key):
+    parts = ['{0}={1}'.format(col, val) for col, val in zip(self.partcols, key)]
+    path = os.path.join(self.outdir, *parts)
+    if not os.path.exists(path):
+      os.makedirs(path)
+    filename = os.path.join(path, 'part-0'+FORMATS[self.fmt])
+    if self.fmt == 'parquet':
+      self.writer = pq.ParquetWriter(filename, self.schema)
+    else:
+      self.writer = pa.ipc.new_file(filename, self.schema)
+    self.key = key
+    self.nfiles += 1
+
+  def write(self, key, rows):
+    """Write rows (a list of tuples in schema order) to partition key"""
+    if key != self.key:
+      self.close()
+      self.open(key)
+    columns = zip(*rows)
+    arrays = [pa.array(list(col), type=field.type)
+              for col, field in zip(columns, self.schema)]
+    self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+    self.nrows += len(rows)
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+      self.writer = None
+      self.key = None
+
+
+def table_columns(conn, table):
+  """Return [(column name, declared type)] for a table"""
+  return [(row[1], row[2]) for row in conn.execute('PRAGMA table_info({0})'.format(table))]
+
+
+def table_order(conn, table, partcols):
+  """Return the columns to order an export of table by: the partition
+     columns, then rowid (so rows keep the order they were logged in)"""
+  sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?",
+                     (table,)).fetchone()[0]
+  if 'WITHOUT ROWID' in sql.upper():
+    return list(partcols)
+  return list(partcols) + ['rowid']
+
+
+def export_table(conn, table, outdir, fmt='parquet', chunk=CHUNK_ROWS):
+  """Export one table, partitioned by sessionid and simnum where it has them"""
+  columns = table_columns(conn, table)
+  names = [name for name, decltype in columns]
+  partcols = [col for col in PARTITION_COLUMNS if col in names]
+  fields = [pa.field(name, arrow_type(decltype)) for name, decltype in columns
+            if name not in partcols]
+  keep = [i for i, name in enumerate(names) if name not in partcols]
+  partidx = [names.index(col) for col in partcols]
+
+  writer = PartitionWriter(os.path.join(outdir, table), pa.schema(fields),
+                           partcols, fmt)
+  order = ', '.join(table_order(conn, table, partcols))
+  cursor = conn.execute('SELECT * FROM {0}{1}'.format(
+    table, ' ORDER BY '+order if order else ''))
+  rows = []
+  key = None
+  for row in cursor:
+    rowkey = tuple(row[i] for i in partidx)
+    if rows and (rowkey != key or len(rows) >= chunk):
+      writer.write(key, rows)
+      rows = []
+    key = rowkey
+    rows.append(tuple(row[i] for i in keep))
+  if rows:
+    writer.write(key, rows)
+  writer.close()
+  return writer.nrows, writer.nfiles
+
+
+def export_tfdata(conn, outdir, fmt='parquet', chunk=CHUNK_ROWS):
+  """Export 'tfdata' pivoted to one row per sim, one column per value
+
+  log_summary_gen stores numbers in nvalue (with an empty tvalue), and
+  anything else in tvalue; a column is text if any sim logged text.
+  """
+  coltypes = conn.execute('''SELECT colname, max(tvalue != '') FROM tfdata
+      GROUP BY colname ORDER BY colname''').fetchall()
+  colnames = [name for name, istext in coltypes]
+  colindex = dict((name, i) for i, name in enumerate(colnames))
+  textcols = set(name for name, istext in coltypes if istext)
+  fields = [pa.field('simnum', pa.int64()), pa.field('timestamp', pa.float64())]
+  fields += [pa.field(name, pa.string() if istext else pa.float64())
+             for name, istext in coltypes]
+  writer = PartitionWriter(os.path.join(outdir, 'tfdata_wide'),
+                           pa.schema(fields), ['sessionid'], fmt)
+
+  cursor = conn.execute('''SELECT sessionid, simnum, timestamp, colname,
+      nvalue, tvalue FROM tfdata ORDER BY sessionid, simnum, rowid''')
+  rows = []
+  session = sim = None
+  current = None
+  for sessionid, simnum, timestamp, colname, nvalue, tvalue in cursor:
+    if (sessionid, simnum) != (session, sim):
+      if current is not None:
+        rows.append(tuple(current))
+      if rows and (sessionid != session or len(rows) >= chunk):
+        writer.write((session,), rows)
+        rows = []
+      session, sim = sessionid, simnum
+      current = [simnum, timestamp] + [None]*len(colnames)
+    if colname in textcols:
+      value = tvalue if tvalue != '' else repr(nvalue)
+    else:
+      value = nvalue
+    current[2+colindex[colname]] = value
+  if current is not None:
+    rows.append(tuple(current))
+  if rows:
+    writer.write((session,), rows)
+  writer.close()
+  return writer.nrows, writer.nfiles
+
+
+def export_db(dbfile, outdir, tables=None, fmt='parquet', chunk=CHUNK_ROWS):
+  """Export tables (default: all of them) of dbfile to outdir"""
+  if pa is None:
+    raise ImportError("Exporting needs the pyarrow package")
+  if fmt not in FORMATS:
+    raise ValueError("Unknown export format: "+str(fmt))
+  conn = sqlite3.connect(dbfile)
+  if not tables:
+    tables = [row[0] for row in conn.execute(
+      "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")]
+  for table in tables:
+    if table == 'tfdata':
+      nrows, nfiles = export_tfdata(conn, outdir, fmt, chunk)
+      table = 'tfdata_wide'
+    else:
+      nrows, nfiles = export_table(conn, table, outdir, fmt, chunk)
+    print table, nrows, "rows in", nfiles, "files"
+  conn.close()
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  fmt = 'parquet'
+  chunk = CHUNK_ROWS
+  if '--format' in args:
+    i = args.index('--format')
+    fmt = args[i+1]
+    del args[i:i+2]
+  if '--chunk' in args:
+    i = args.index('--chunk')
+    chunk = int(args[i+1])
+    del args[i:i+2]
+  if len(args) < 2 or fmt not in FORMATS:
+    print __doc__
+    sys.exit(1)
+  export_db(args[0], args[1], args[2:], fmt, chunk)
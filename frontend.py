@@ -47,6 +47,13 @@ def log(text, level=0):
   # write text to file
 
 
+# Step marked on ratings made while the server waits on each command
+# (the names match the steps HumanAgent used when it polled for ratings)
+RATING_STEPS = {'propose':'apply', 'acceptvote':'acceptvote', 
+                'acceptvote_groupmerge':'acceptvote', 'expelvote':'expelvote',
+                'consider':'join', 'publicgoods':'publicgoods', 
+                'postprocess':'postprocess', 'exitsurvey':'exitsurvey'}
+
 class TFNetBack(threading.Thread):
   def __init__(self, serverIP, frontend):
     threading.Thread.__init__(self)
@@ -54,7 +61,10 @@ class TFNetBack(threading.Thread):
     self.tkroot = frontend.root
     self.msgnum = 0
     self.sendqueue = Queue.Queue()
+    self.sendlock = threading.Lock()    # Responses and pushes share the socket
     self.serverIP = serverIP
+    self.step = 'NA'
+    self.pgconcluded = False
 
   def run(self):
     self.server_setup(self.serverIP)
@@ -69,6 +79,13 @@ class TFNetBack(threading.Thread):
         print "Connection refused; is server running yet?"
         time.sleep(2.0)
     self.connection = conn
+    
+    # Get our client number, and choose a codec from the server's list
+    command, (clientnum, codecs) = receive_message(conn)
+    self.client_setup(clientnum)
+    codec = choose_codec(codecs)
+    send_message(conn, ('codec', codec))
+    set_codec(conn, codec)
   
   def event_loop(self):
     # Start a loop of waiting for messages
@@ -90,6 +107,8 @@ class TFNetBack(threading.Thread):
     log("Received command: "+command)
     
     if '<<'+command+'>>' in self.tkroot.bind():
+      self.step = self.rating_step(command)
+      
       # Give the data to the frontend
       self.frontend.dataqueue.put( (self.msgnum, command, data) )
       
@@ -99,11 +118,30 @@ class TFNetBack(threading.Thread):
       
       # May need to wait on the result?
       response = self.sendqueue.get()
+      self.step = 'NA'
       if response != 'done':
-        send_message(self.connection, response)
+        self.send(response)
     else:
       log("Command has no valid binding")
 
+  def rating_step(self, command):
+    # The postprocess after a public goods round is its own step
+    if command == 'publicgoods_conclusion':
+      self.pgconcluded = True
+    elif command == 'postprocess' and self.pgconcluded:
+      self.pgconcluded = False
+      return 'pg_postprocess'
+    return RATING_STEPS.get(command, 'NA')
+
+  def send(self, message):
+    with self.sendlock:
+      send_message(self.connection, message)
+
+  def push(self, message):
+    """Send a message the server did not ask for (see HumanAgent.handle_push)"""
+    with self.sendlock:
+      send_message(self.connection, message, push=True)
+
   def client_setup(self, clientnum):
     self.clientnum = clientnum
     log("I am client "+str(clientnum)+"!")
@@ -263,7 +301,6 @@ class TFGui(object):
     
     self.root.bind('<<setmyid>>', self.m_setmyid)
     self.root.bind('<<initvideo>>', self.m_initvideo)
-    self.root.bind('<<getframetimes>>', self.m_getframetimes)
     self.root.bind('<<startcapture>>', self.m_startcapture)
     self.root.bind('<<stopcapture>>', self.m_stopcapture)
     self.root.bind('<<endcapture>>', self.m_endcapture)
@@ -275,6 +312,7 @@ class TFGui(object):
     self.root.bind('<<updatenbrs>>', self.m_updatenbrs)
     self.root.bind('<<updatemyteam>>', self.m_updatemyteam)
     self.root.bind('<<updateteam>>', self.m_updateteam)
+    self.root.bind('<<updatestate>>', self.m_updatestate)
     self.root.bind('<<propose>>', self.m_propose)
     self.root.bind('<<acceptvote>>', self.m_acceptvote)
     self.root.bind('<<acceptvote_groupmerge>>', self.m_acceptvote_groupmerge)
@@ -480,18 +518,15 @@ class TFGui(object):
     self.setState(exwid['submit'], tk.DISABLED)
     
     # Hijack the backend's connection
-    conn = self.backend.connection
     
     # Send number of questions
     n_qs = len(exwid['qtexts'])
-    send_message(conn, n_qs)
+    self.backend.send(n_qs)
     
     # Send each question 
     for qtext, qwid in exwid['qtexts']:#.iteritems():
       response = qwid.get(1.0, tk.END)
-      rlen = BUFFER_SIZE - len(qtext) - 10
-      shortresp = response[:rlen]
-      send_message(conn, (qtext, shortresp) )
+      self.backend.send( (qtext, response) )
     
     # Unlock the message backend so we can continue processing messages
     #self.backend.sendqueue.put('done')
@@ -719,7 +754,7 @@ class TFGui(object):
     
   def u_sendoffer(self):
     self.markend()
-    self.backend.sendqueue.put(self.uwidgets['offervar'].get())
+    self.submit_decision(self.uwidgets['offervar'].get())
     
   def u_waitoffer(self, other_player, is_offer=True):
     # Waiting for offer from player 1
@@ -793,11 +828,11 @@ class TFGui(object):
     
   def u_yesoffer(self):
     self.markend()
-    self.backend.sendqueue.put(True)
+    self.submit_decision(True)
     
   def u_nooffer(self):
     self.markend()
-    self.backend.sendqueue.put(False)
+    self.submit_decision(False)
     
   def u_conclusion(self, other_player, amount, result, role):
     # Summarize what happened
@@ -856,7 +891,7 @@ class TFGui(object):
     self.markend()
     self.setState(self.uwidgets['conclusion_widgets']['ok'], tk.DISABLED)
     self.uwidgets['conclusion_widgets']['ok'].config(text='Waiting...')
-    self.backend.sendqueue.put('send_done')
+    self.submit_decision('send_done')
   
   
   def add_history(self, other_player, amount, result, role):
@@ -1066,6 +1101,11 @@ class TFGui(object):
     
     self.sb = None
     self.teamview = None
+    self.teamlabel = None
+    self.teamrows = None    # agent ID -> frame in the team view, or None
+    self.myoval = None
+    self.myskilltext = None
+    self.nbritems = {}      # neighbor ID -> [oval, label, skill text, x, y]
     
     self.make_neighborview()
     
@@ -1266,29 +1306,66 @@ class TFGui(object):
       raise IndexError('Not enough avatars!')
     
     tk.Label(self.teamwords, text='Your team', font=self.fontmid).grid(row=0,column=0)
-    tk.Label(self.teamwords, text='(Team '+self.gname(self.myteam)+')', font=self.fontsm).grid(row=1,column=0)
+    self.teamlabel = tk.Label(self.teamwords, text='(Team '+self.gname(self.myteam)+')', font=self.fontsm)
+    self.teamlabel.grid(row=1,column=0)
     
     neighbors.remove(self.myid)
     neighbors.insert(0,self.myid)
     
     # pack with one entry for each team member, with their avatar
+    self.teamrows = {}
     for i, aid in enumerate(neighbors):
-      frame = tk.Frame(self.teamview, borderwidth=2, relief=tk.GROOVE)
-      img = tk.Label(frame, image=self.avatars[aid], height=64)
-      lab = tk.Label(frame, text=('You' if aid == self.myid else self.aname(aid)), font=self.fontmed)
-      img.grid(row=0, column=0)
-      lab.grid(row=0, column=1)
+      frame = self.make_teamrow(aid)
       frame.grid(row=i, column=0, sticky='nsew')
+      self.teamrows[aid] = frame
     
     self.teamwords.grid(row=0, column=2, sticky='nsew')
     self.teamview.grid(row=1, column=2, sticky='nsew')
     
     self.nteam = len(neighbors)
+  
+  def make_teamrow(self, aid):
+    frame = tk.Frame(self.teamview, borderwidth=2, relief=tk.GROOVE)
+    img = tk.Label(frame, image=self.avatars[aid], height=64)
+    lab = tk.Label(frame, text=('You' if aid == self.myid else self.aname(aid)), font=self.fontmed)
+    img.grid(row=0, column=0)
+    lab.grid(row=0, column=1)
+    return frame
+  
+  def change_team(self, joined, left):
+    # Add and remove members in the existing team view
+    if self.teamrows is None:
+      return
+    for aid in left:
+      self.teamrows.pop(aid).destroy()
+    for aid in joined:
+      self.teamrows[aid] = self.make_teamrow(aid)
+    order = [self.myid] + sorted(aid for aid in self.teamrows if aid != self.myid)
+    for i, aid in enumerate(order):
+      self.teamrows[aid].grid(row=i, column=0, sticky='nsew')
+    self.nteam = len(order)
+  
+  def change_myteam(self):
+    # Show a new team or skill for me in the existing team and neighbor views
+    color = self.colors[self.myteam]
+    if self.teamview is not None:
+      self.teamview.config(background=color)
+      self.teamlabel.config(text='(Team '+self.gname(self.myteam)+')')
+    if self.myoval is not None:
+      self.canvas.itemconfig(self.myoval, fill=color)
+      if self.myskilltext is not None:
+        self.canvas.delete(self.myskilltext)
+        self.myskilltext = None
+      if self.myskill != -1:
+        centtl = self.csize/2 - self.nsize/2
+        centbr = self.csize/2 + self.nsize/2
+        self.myskilltext = self.canvas.create_text(centbr, centtl, text=str(self.myskill), font=self.fontsm)
     
   def make_teamview_publicgoods(self, neighbors, contribs):
     if self.teamview is not None:
       self.teamwords.destroy()
       self.teamview.destroy()
+    self.teamrows = None
     
     self.teamwords = tk.Frame(self.mainscreen, borderwidth=2, relief=tk.GROOVE)
     self.teamview = tk.Frame(self.mainscreen, borderwidth=2, relief=tk.SUNKEN, background=self.colors[self.myteam])
@@ -1456,7 +1533,11 @@ class TFGui(object):
       eframe = -1; etime = time.time()
     #print "Ratings:", [(aid, rv.get()) for aid,rv in self.ratingvars.items()]
     print "Rating:", aid, self.ratingvars[aid].get()
-    self.ratinglog.append( [self.myid, aid, self.ratingvars[aid].get(), eframe, etime] )
+    rating = [self.myid, aid, self.ratingvars[aid].get(), eframe, etime]
+    if self.cfgdict.get('_push_ratings'):
+      self.backend.push( ('ratings', [rating + [self.backend.step]]) )
+    else:
+      self.ratinglog.append(rating)
     
   def hide_reputation(self, aid):
     self.globalratingwidgets[aid].grid_remove()
@@ -1556,6 +1637,7 @@ class TFGui(object):
     posns = [(rad*math.sin(i*theta), rad*math.cos(i*theta)) for i in range(nnbr)]
     
     can.delete(tk.ALL)
+    self.nbritems = {}
     
     # Draw 'spokes' to neighbors
     for x,y in posns:
@@ -1565,8 +1647,9 @@ class TFGui(object):
     self.myoval = can.create_oval(centtl, centtl, centbr, centbr, fill=self.colors[self.myteam], width=2)
     can.create_text(cent, cent, text='You', font=self.fontsm)
     self.canvas.create_image(centtl, centtl, image=self.avatars_sm[self.myid])
+    self.myskilltext = None
     if self.myskill != -1:
-      self.canvas.create_text(centbr, centtl, text=str(self.myskill), font=self.fontsm)
+      self.myskilltext = self.canvas.create_text(centbr, centtl, text=str(self.myskill), font=self.fontsm)
     
     #print gdata
     #print self.colors
@@ -1576,17 +1659,38 @@ class TFGui(object):
     
     # Draw ovals for neighbors
     for (nbrid, gid, skill), (x,y) in zip(gdata,posns):
-      can.create_oval(centtl+x, centtl+y, centbr+x, centbr+y, fill=self.colors[gid], width=2)
+      oval = can.create_oval(centtl+x, centtl+y, centbr+x, centbr+y, fill=self.colors[gid], width=2)
       
       can.create_image(centtl+x, centtl+y, image=self.avatars_sm[nbrid])
-      can.create_text(cent+x, cent+y, text=self.gname(gid), font=self.fontsm)
+      label = can.create_text(cent+x, cent+y, text=self.gname(gid), font=self.fontsm)
       #can.create_text(cent+x, cent+y, text=str(nbrid), font=self.fontsm)
       #can.create_image(cent+x, cent+y, image=self.avatars_sm[nbrid])
       
+      skilltext = None
       if skill != -1:
-        can.create_text(centbr+x, centtl+y, text=str(skill), font=self.fontsm)
+        skilltext = can.create_text(centbr+x, centtl+y, text=str(skill), font=self.fontsm)
+      self.nbritems[nbrid] = [oval, label, skilltext, x, y]
         
     self.canvas.grid(row=0, column=0)
+  
+  def change_neighbors(self, changes):
+    # Update the drawn neighbors whose (nbrid, gid, skill) changed,
+    # instead of redrawing the whole canvas
+    can = self.canvas
+    centtl = self.csize/2 - self.nsize/2
+    centbr = self.csize/2 + self.nsize/2
+    for nbrid, gid, skill in changes:
+      if nbrid not in self.nbritems:    # Not drawn (see update_neighbors)
+        continue
+      item = self.nbritems[nbrid]
+      oval, label, skilltext, x, y = item
+      can.itemconfig(oval, fill=self.colors[gid])
+      can.itemconfig(label, text=self.gname(gid))
+      if skilltext is not None:
+        can.delete(skilltext)
+        item[2] = None
+      if skill != -1:
+        item[2] = can.create_text(centbr+x, centtl+y, text=str(skill), font=self.fontsm)
     
   # Unused
   #def update_myteam(self):
@@ -1716,6 +1820,12 @@ class TFGui(object):
       
     self.save_screen(self.stime, self.sframe)
       
+  def submit_decision(self, decision):
+    # Answer with the decision and the frame times from markstart/markend
+    # (see HumanAgent.decide)
+    frametimes = (self.sframe, self.eframe, self.stime, self.etime)
+    self.backend.sendqueue.put( (decision, frametimes) )
+      
   def markend(self):
     if self.vidrec:
       self.eframe, self.etime = self.vidrec.queryframetime()
@@ -1724,10 +1834,6 @@ class TFGui(object):
 
     self.save_screen(self.etime, self.eframe)
       
-  def m_getframetimes(self, event):
-    self.getdata(event)
-    self.backend.sendqueue.put( (self.sframe, self.eframe, self.stime, self.etime) )
-  
   def m_startcapture(self, event):
     self.getdata(event)
     if self.do_video:
@@ -1775,6 +1881,24 @@ class TFGui(object):
     self.make_teamview(team_members)
     self.backend.sendqueue.put('done')
   
+  def m_updatestate(self, event):
+    # Any of pay, myteam, team, and nbrs that changed (see HumanAgent.sendstate)
+    state = self.getdata(event)
+    if 'pay' in state:
+      self.mwidgets['nowpay'].config(text=CURR+str(round(state['pay'],2)))
+    if 'myteam' in state:
+      self.myteam, self.myskill = state['myteam']
+      self.change_myteam()
+    if 'team' in state:
+      self.make_teamview(state['team'])
+    if 'teamdelta' in state:
+      self.change_team(*state['teamdelta'])
+    if 'nbrs' in state:
+      self.update_neighbors(state['nbrs'])
+    if 'nbrdelta' in state:
+      self.change_neighbors(state['nbrdelta'])
+    self.backend.sendqueue.put('done')
+  
   def m_propose(self, event):
     data = self.getdata(event)
     self.show_screen(self.mainscreen)
@@ -1951,7 +2075,7 @@ class TFGui(object):
     self.remove_reminder(submitbutton)
     
     offer = int(self.mwidgets['pgwidgets']['offerspin'].get())
-    self.backend.sendqueue.put(offer)
+    self.submit_decision(offer)
   
   def m_publicgoods_conclusion(self, event):
     data = self.getdata(event)
@@ -2035,7 +2159,7 @@ class TFGui(object):
     self.setState(self.sb, tk.DISABLED)
     self.submit.config(text='Waiting...')
     self.remove_reminder(self.submit)
-    self.backend.sendqueue.put(applications)
+    self.submit_decision(applications)
   
   def submit_accept(self):
     self.markend()
@@ -2045,7 +2169,7 @@ class TFGui(object):
     self.setState(self.sb, tk.DISABLED)
     self.submit.config(text='Waiting...')
     self.remove_reminder(self.submit)
-    self.backend.sendqueue.put(self.choice.get())
+    self.submit_decision(self.choice.get())
     
   def submit_postprocess(self):
     self.markend()
@@ -26,15 +26,21 @@ which simply takes messages describing what screen to display, with what info,
 and receives input from the user.
 
 Numerous functions use send_and_receive to ask for user input, and ensure that
-the program (or thread) blocks until it has been received.
+the program (or thread) blocks until it has been received. On a multiplexed
+connection (see clientmux.py), request() returns a Reply instead, so the
+server can wait on many humans at once: each decision (propose, acceptvote,
+etc) is split into start_X, which sends the screen and returns a pending
+result, and finish_X, which runs when the answer is collected.
 """
 
-import json
+import collections
 import numpy as np
 
 from configuration import Configuration
 from agentgroup import Agent
 from utils import send_message, receive_message, send_and_receive
+from utils import is_serializable
+from clientmux import Reply
 
 CURR = u'\xA7'
 
@@ -52,6 +58,8 @@ class HumanAgent(Agent):
     finalpay: total pay, only set after the exit survey is submitted
     messages: list accumulator of message strings that are sent to the user as
               a summary of the turn during the postprocess stage.
+    laststate: the pay/team/neighbor state the client is showing, as last 
+               sent by sendstate()
   """
   
   def __init__(self, cfg, connection, adat=None, skills=None, aid=None):
@@ -75,6 +83,14 @@ class HumanAgent(Agent):
     
     self.current_ratings = {}
     self.finalpay = -1
+    self.laststate = {}
+    
+    # Only a multiplexed connection can receive pushed messages
+    self.pushratings = (cfg.do_ratings and cfg._push_ratings and
+                        hasattr(connection, 'request'))
+    self.pushedratings = collections.deque()    # Pushed, not yet logged
+    if self.pushratings:
+      self.client.onpush = self.handle_push
     
     send_message(self.client, ('setmyid', self.id))
     self.sendcfg()
@@ -82,21 +98,29 @@ class HumanAgent(Agent):
   def sendcfg(self):
     """Send the current configuration to the client as a dictionary.
     
-    Sends only the variables which can be packed with JSON.
+    Sends only the variables which can be serialized.
     Blocks until client confirms that it has received the message
     """
-    cfgdict = self.cfg.outputcfg(showhidden=True)
-    # remove all things that are not jsonnable
-    jsoncfg = {}
-    for k,v in cfgdict.iteritems():
-      try:    # This is hacky...
-        json.dumps(v)
-        jsoncfg[k] = v
-      except TypeError:
-        pass
-    send_and_receive(self.client, ('setconfig', jsoncfg))
+    send_and_receive(self.client, ('setconfig', self.clientcfg()))
     # Make sure the config gets set before moving on
 
+  def clientcfg(self):
+    """Return the configuration variables which can be sent to the client"""
+    cfgdict = self.cfg.outputcfg(showhidden=True)
+    cfgdict = {k:v for k,v in cfgdict.iteritems() if is_serializable(v)}
+    cfgdict['_push_ratings'] = self.pushratings
+    return cfgdict
+
+  def request(self, message):
+    """Send a message to the client, and return a Reply for its answer.
+    
+    On a multiplexed connection this does not wait for the answer;
+    call result() on the Reply (or clientmux.gather) to get it.
+    """
+    if hasattr(self.client, 'request'):
+      return self.client.request(message)
+    return Reply.resolved(send_and_receive(self.client, message))
+
   def gname(self, gid):
     """Get the name (letter) of a group from an integer group ID"""
     return self.gletters[gid]
@@ -117,15 +141,25 @@ class HumanAgent(Agent):
     
   def instructions(self):
     """Tell client to show instructions screen and close preview window"""
+    self.start_instructions().result()
+    #if self.cfg.do_ratings: self.showratings()
+    self.logp(("Instructions done for", self.id))
+
+  def start_instructions(self):
+    """Send the instructions screen without waiting for the player.
+    
+    Returns:
+      a Reply that is done when the player has finished the instructions
+    """
     if self.cfg.do_ratings: self.hideratings()
     
     send_message(self.client, ('endpreview', 0))
     
-    self.sendcfg()
+    # The client answers in order, so the config is set before the
+    # instructions reply arrives
+    self.request(('setconfig', self.clientcfg()))
     
-    send_and_receive(self.client, ('instructions', 0))
-    #if self.cfg.do_ratings: self.showratings()
-    self.logp(("Instructions done for", self.id))
+    return self.request(('instructions', 0))
 
   def initratings(self, neighbors):
     """Tell client to create the ratings sidebar"""
@@ -182,39 +216,83 @@ class HumanAgent(Agent):
     """Client: terminate video capture"""
     send_message(self.client, ('endcapture', 0))
 
+  def reset(self):
+    super(HumanAgent, self).reset()
+    self.laststate = {}
+
   def update(self):
     """Update current pay and neighbors here and in the GUI"""
     if self.cfg.bias:
       self.nowpay = self.nowpaycalc(self.cfg.task(self.group.skills))
     else:
       self.nowpay = self.cfg.task(self.group.skills)/self.group.gsize
-    send_message(self.client, ('updatepay', self.nowpay) )
     
     if self.cfg.show_skills:
-      send_message(self.client, ('updatemyteam', (self.group.id, int(np.where(self.skills)[0][0])) ))
+      myteam = (self.group.id, int(np.where(self.skills)[0][0]))
     else:
-      send_message(self.client, ('updatemyteam', (self.group.id, -1)) )
+      myteam = (self.group.id, -1)
     
-    send_message(self.client, ('updateteam', sorted([a.id for a in self.group.agents])))
-    self.updatenbrs()
+    self.sendstate({'pay':self.nowpay, 'myteam':myteam, 
+                    'team':sorted([a.id for a in self.group.agents]),
+                    'nbrs':self.nbrdata()})
 
   def updatenbrs(self):
     """Update graphical view of neighbors in the GUI"""
+    self.sendstate({'nbrs':self.nbrdata()})
+
+  def nbrdata(self):
+    """Return (id, group id, skill) of each neighbor, for the GUI"""
     #nbrdata = [(n.id, n.group.id) for n in self.nbrs]  # old nbrdata
     if self.cfg.show_skills:
-      nbrdata = [(n.id, n.group.id, int(np.where(n.skills)[0][0])) for n in self.nbrs]
+      return [(n.id, n.group.id, int(np.where(n.skills)[0][0])) for n in self.nbrs]
     else:
-      nbrdata = [(n.id, n.group.id, -1) for n in self.nbrs]
-    send_message(self.client, ('updatenbrs', nbrdata) )
+      return [(n.id, n.group.id, -1) for n in self.nbrs]
 
-  def getframetimes(self):
-    """Get the start and end frame numbers and timestamps from the last event.
+  def sendstate(self, state):
+    """Send the parts of state that changed since the last call to the 
+    client, in one 'updatestate' message. Sends nothing if nothing changed.
+    
+    If the client already has a team or neighbor list, only the changes
+    are sent: 'teamdelta' is (joined IDs, left IDs), and 'nbrdelta' is the
+    list of nbrdata entries that changed (if the neighbors are the same).
+    
+    Arguments:
+      state: dictionary with any of the keys
+             'pay' (float), 'myteam' (group ID, skill), 
+             'team' (list of member IDs), 'nbrs' (see nbrdata)
+    """
+    last = self.laststate
+    changed = {k:v for k,v in state.iteritems() if last.get(k) != v}
+    if not changed:
+      return
+    message = dict(changed)
+    if 'team' in changed and 'team' in last:
+      old, new = set(last['team']), set(changed['team'])
+      message['teamdelta'] = (sorted(new - old), sorted(old - new))
+      del message['team']
+    if 'nbrs' in changed and 'nbrs' in last:
+      old, new = last['nbrs'], changed['nbrs']
+      if [n[0] for n in old] == [n[0] for n in new]:
+        message['nbrdelta'] = [n for o, n in zip(old, new) if o != n]
+        del message['nbrs']
+    last.update(changed)
+    send_message(self.client, ('updatestate', message))
+
+  def decide(self, message):
+    """Ask the client for a decision, and wait for the answer.
+    
+    The client answers with its decision and the frame times of the event,
+    so logging the decision needs no extra round trip.
     
     Returns:
-      tuple of (start frame, end frame, start time, end time)
+      tuple of (decision, frametimes), where frametimes is
+      (start frame, end frame, start time, end time);
       frame numbers are ints, times are Unix timestamps
+    
+    The start_ methods use request() instead, to not wait for the answer.
     """
-    return send_and_receive(self.client, ('getframetimes', 0))
+    decision, frametimes = self.request(message).result()
+    return decision, frametimes
 
   def logratings(self, simnum = None, iternum = None, step = 'NA'):
     """Get all accumulated ratings from the client and log to database.
@@ -230,26 +308,69 @@ class HumanAgent(Agent):
     ratings are assigned to the correct step, collect ratings once before the
     step starts, and again after the step ends, marking with the step name on
     the second call. (see usage in code)
+    
+    If the client pushes its ratings, just logs the ones pushed so far 
+    (see handle_push), which are already marked with their step.
     """
     if not self.cfg.do_ratings: return
+    if self.pushratings:
+      ratings = []
+      while self.pushedratings:
+        ratings.extend(self.pushedratings.popleft())
+      if ratings:
+        self.cfg._dblog.log_ratings(ratings)
+      return
     ratings = send_and_receive(self.client, ('getratinglog', 0))
+    for r in ratings:
+      r.append(step)
+    self.storeratings(ratings, simnum, iternum)
+
+  def handle_push(self, message):
+    """Handle a message the client pushed on its own.
+    
+    Called on the connection's I/O thread (see clientmux.Channel.onpush).
+    The client pushes ('ratings', ratings) each time the player changes a
+    rating, with each rating marked with the client's current step.
+    
+    The ratings are only marked and buffered here; logratings logs them 
+    from the sim thread, as a full database queue would block the I/O 
+    thread (and every client with it).
+    """
+    command, data = message
+    if command == 'ratings':
+      self.markratings(data)
+      self.pushedratings.append(data)
+    else:
+      self.logp(("Agent", self.id, "unknown push:", command))
+
+  def storeratings(self, ratings, simnum = None, iternum = None):
+    """Log ratings from the client, and update self.current_ratings.
+    
+    Arguments:
+      ratings: list of [myid, otherid, rating, eframe, etime, step]
+      simnum, iternum: defaults to the current round and iteration
+    """
     if not len(ratings):
       return
-    if not simnum:
-      try:
-        simnum, iternum = self.cfg.simnumber, self.cfg.iternum
-      except AttributeError:
-        simnum, iternum = -1, -1
     try:
-      for r in ratings:
-        r.extend( [simnum, iternum, step] )
-        self.current_ratings[r[1]] = r[2]
+      self.markratings(ratings, simnum, iternum)
       self.cfg._dblog.log_ratings(ratings)
     except AttributeError:
       print "PROBLEM!"
       print "ratings data is:", ratings
     self.logp(("Agent", self.id, "ratings:", ratings))
 
+  def markratings(self, ratings, simnum = None, iternum = None):
+    """Add simnum and iternum to ratings, and update self.current_ratings"""
+    if not simnum:
+      try:
+        simnum, iternum = self.cfg.simnumber, self.cfg.iternum
+      except AttributeError:
+        simnum, iternum = -1, -1
+    for r in ratings:
+      r[5:5] = [simnum, iternum]
+      self.current_ratings[r[1]] = r[2]
+
   def logratingstatus(self, eventtype, otherids, gmembers=None):
     """Log the current ratings that a user is seeing when making a decision.
     
@@ -319,6 +440,16 @@ class HumanAgent(Agent):
     send_message(self.client, ('updatehistory', pghistory))
 
   def propose(self):
+    self.start_propose().result()
+
+  def start_propose(self):
+    """Send the propose screen without waiting for the player.
+    
+    Returns:
+      a pending result (see clientmux.Then); its result() waits for the 
+      player, logs the applications and gives them to the groups.
+      The other start_ methods work the same way.
+    """
     task = self.cfg.task
     self.update()   ## Maybe needs to come after the propose message!
     
@@ -326,7 +457,7 @@ class HumanAgent(Agent):
     nbrgroups.discard(self.group)
     
     if not len(nbrgroups):
-      return
+      return Reply.resolved(None)
     
     idgroups = {g.id:g for g in nbrgroups}
 
@@ -337,10 +468,12 @@ class HumanAgent(Agent):
     self.logratings()
     self.logratingstatus('apply', gids+(-1, ), gmembers+([a.id for a in self.group.agents],))
 
-    # Send all data to GUI and blocking receive
-    # Wait for user to reply with list of applications
-    applications = send_and_receive(self.client, ('propose', gdata) )
-    
+    # Send all data to GUI; the user replies with a list of applications
+    return self.request(('propose', gdata)).then(
+      self.finish_propose, gids, newpays, idgroups)
+
+  def finish_propose(self, answer, gids, newpays, idgroups):
+    applications, frametimes = answer
     self.logratings(step='apply')
     
     if len(applications):
@@ -349,7 +482,7 @@ class HumanAgent(Agent):
     else:
       self.messages.append('You did not apply to any groups')
 
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.log_apply(
       self.cfg.simnumber, self.cfg.iternum, self.id, gids, self.nowpay, 
       newpays, applications, sframe, eframe, stime, etime
@@ -362,10 +495,14 @@ class HumanAgent(Agent):
       g.takeapplication(self)
   
   def acceptvote(self, applicants):
+    return self.start_acceptvote(applicants).result()
+
+  def start_acceptvote(self, applicants):
+    """Send the acceptvote screen; result() is the Agent voted for, or None"""
     if not len(applicants):
       # If no applicants, shouldn't be calling this function, but in any case, 
       # return None
-      return None
+      return Reply.resolved(None)
     
     task = self.cfg.task
     self.update()
@@ -382,10 +519,12 @@ class HumanAgent(Agent):
     self.logratings()
     self.logratingstatus('acceptvote', naids)
     
-    # Send all data to GUI and blocking receive
-    # Wait for user to reply with list of applications
-    accept_id = send_and_receive(self.client, ('acceptvote', gdata) )
-    
+    # Send all data to GUI; the user replies with the ID to accept
+    return self.request(('acceptvote', gdata)).then(
+      self.finish_acceptvote, naids, newpays, idagents)
+
+  def finish_acceptvote(self, answer, naids, newpays, idagents):
+    accept_id, frametimes = answer
     self.logratings(step='acceptvote')
 
     naids = list(naids)
@@ -394,7 +533,7 @@ class HumanAgent(Agent):
     naids.append(-1)
     newpays.append(self.nowpay)
     
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.log_accept(
       self.cfg.simnumber, self.cfg.iternum, self.id, naids, self.nowpay,
       newpays, accept_id, sframe, eframe, stime, etime
@@ -413,6 +552,10 @@ class HumanAgent(Agent):
       return None
 
   def expelvote(self):
+    return self.start_expelvote().result()
+
+  def start_expelvote(self):
+    """Send the expelvote screen; result() is the Agent voted out, or None"""
     task = self.cfg.task
     self.update()
     nowpay = self.nowpay
@@ -427,13 +570,15 @@ class HumanAgent(Agent):
     self.logratings()
     self.logratingstatus('expelvote', naids)
     
-    # Send all data to GUI and blocking receive
-    # Wait for user to reply with list of applications
-    expel_id = send_and_receive(self.client, ('expelvote', gdata) )
-    
+    # Send all data to GUI; the user replies with the ID to expel
+    return self.request(('expelvote', gdata)).then(
+      self.finish_expelvote, naids, newpays, idagents)
+
+  def finish_expelvote(self, answer, naids, newpays, idagents):
+    expel_id, frametimes = answer
     self.logratings(step='expelvote')
 
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.log_expel(
       self.cfg.simnumber, self.cfg.iternum, self.id, naids, self.nowpay, 
       newpays, expel_id, sframe, eframe, stime, etime
@@ -451,10 +596,14 @@ class HumanAgent(Agent):
 
 
   def consider(self):
+    self.start_consider().result()
+
+  def start_consider(self):
+    """Send the join screen; result() switches to the group chosen"""
     if not len(self.acceptances) or \
        not len([g.gsize for g in self.acceptances if g.gsize > 0]):
       self.messages.append('You received no acceptances')
-      return
+      return Reply.resolved(None)
     
     task = self.cfg.task
     self.update()
@@ -469,10 +618,12 @@ class HumanAgent(Agent):
     self.logratingstatus('join', gids+(-1, ), 
                          gmembers+([a.id for a in self.group.agents], ))
     
-    # Send all data to GUI and blocking receive
-    # Wait for user to reply with list of applications
-    choice_id = send_and_receive(self.client, ('consider', gdata) )
-    
+    # Send all data to GUI; the user replies with the group to join
+    return self.request(('consider', gdata)).then(
+      self.finish_consider, gids, gsizes, gpays, idgroups)
+
+  def finish_consider(self, answer, gids, gsizes, gpays, idgroups):
+    choice_id, frametimes = answer
     self.logratings(step='join')
     
     if choice_id == -1:
@@ -489,7 +640,7 @@ class HumanAgent(Agent):
     gids.append(-1)
     gsizes.append(self.group.gsize)
     gpays.append(self.nowpay)
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.log_join(
       self.cfg.simnumber, self.cfg.iternum, self.id, gids, self.nowpay, gpays, 
       choice_id, sframe, eframe, stime, etime
@@ -525,13 +676,19 @@ class HumanAgent(Agent):
         self.messages.append('No agents '+changewords[add]+' your team')
   
   def postprocess_iter(self):
-    # Send all data to GUI and blocking receive
+    self.start_postprocess_iter().result()
+
+  def start_postprocess_iter(self):
+    """Send the end of turn screen; result() waits for the player"""
     self.update()
     if len(self.messages):
-      send_and_receive(self.client, ('turndone', '\n'.join(self.messages)) )
+      reply = self.request(('turndone', '\n'.join(self.messages)))
     else:
       self.log("No new messages for human player", 6)
-    
+      reply = Reply.resolved(None)
+    return reply.then(self.finish_postprocess_iter)
+
+  def finish_postprocess_iter(self, answer):
     #if self.cfg.do_ratings:
     #  self.logratings(step='postprocess_iter')
     self.logratings()
@@ -541,12 +698,19 @@ class HumanAgent(Agent):
     self.messages = []
   
   def postprocess(self, globalpay=None):
+    self.start_postprocess(globalpay).result()
+
+  def start_postprocess(self, globalpay=None):
+    """Send the end of sim screen; result() waits for the player"""
     self.update()
     self.messages.append('You earned '+CURR+str(round(self.nowpay, 2)))
         
     self.logratings()
     send_message(self.client, ('addpay', round(self.nowpay, 2)) )
-    send_and_receive(self.client, ('postprocess', '\n'.join(self.messages)) )
+    return self.request(('postprocess', '\n'.join(self.messages))).then(
+      self.finish_postprocess)
+
+  def finish_postprocess(self, answer):
     self.logratings(step='postprocess')
     
     
@@ -568,10 +732,21 @@ class HumanAgent(Agent):
   
   ## PUBLIC GOODS FUNCTIONS:
   def publicgoods(self, pgdict, potmult):
+    self.start_publicgoods(pgdict, potmult).result()
+
+  def start_publicgoods(self, pgdict, potmult):
+    """Send the public goods instructions and contribution screens;
+       result() adds the player's (contribution, amount kept) to pgdict"""
     self.update()
     
+    # Before the instructions, so no round trip waits behind them 
+    # (ratings are hidden until the instructions are done)
+    self.logratings()
+    
+    # The client answers in order, so the contribution screen comes 
+    # up once the player is done with the instructions
     if self.cfg.do_ratings: self.hideratings()
-    send_and_receive(self.client, ('publicgoods_instructions', potmult))
+    self.request(('publicgoods_instructions', potmult))
     if self.cfg.do_ratings: self.showratings()
     
     ## Send team as neighbors
@@ -580,13 +755,18 @@ class HumanAgent(Agent):
                   for n in self.group.agents if n != self]
     else:
       teamdata = [(n.id, n.group.id, -1) for n in self.group.agents if n != self]
-    send_message(self.client, ('updatenbrs', teamdata) )    
+    self.sendstate({'nbrs':teamdata})
     
-    self.logratings()
     self.logratingstatus('pubgood', [n.id for n in self.group.agents if n != self])
     
     # Send current pay with the publicgoods message
-    contrib = send_and_receive(self.client, ('publicgoods', (int(self.nowpay), potmult)))
+    # (the client changes its pay display while the player chooses)
+    self.laststate.pop('pay', None)
+    return self.request(('publicgoods', (int(self.nowpay), potmult))).then(
+      self.finish_publicgoods, pgdict)
+
+  def finish_publicgoods(self, answer, pgdict):
+    contrib, self.pgframetimes = answer
     self.logratings(step='publicgoods')
     
     self.logp(("Agent", self.id, "contribs", contrib, "/", int(self.nowpay)))
@@ -596,6 +776,11 @@ class HumanAgent(Agent):
   
     
   def publicgoods_postprocess(self, startpay, keep, contrib, privatepay, potpay, teampays):
+    self.start_publicgoods_postprocess(startpay, keep, contrib, privatepay, 
+                                       potpay, teampays).result()
+
+  def start_publicgoods_postprocess(self, startpay, keep, contrib, privatepay, potpay, teampays):
+    """Send the public goods results; result() waits for the player"""
     maxcontrib = startpay
     newpay = privatepay + potpay
     
@@ -621,17 +806,17 @@ class HumanAgent(Agent):
     teammateids = [n.id for n in self.group.agents]
     contribs = [teampays[n][0] for n in teammateids]
     
-    send_message(self.client, ('updatemyteam', (self.group.id, str(contrib)) )) 
     teammates = list(self.group.agents)
     teammates.remove(self)
     teamids = [n.id for n in teammates]
     teamdata = [(n.id, n.group.id, teampays[n.id][0]) for n in teammates]
-    send_message(self.client, ('updatenbrs', teamdata) )
+    self.sendstate({'myteam':(self.group.id, str(contrib)), 'nbrs':teamdata})
     
     send_message(self.client, ('publicgoods_conclusion', (newpay, (teammateids, contribs))))
+    self.laststate.pop('team', None)    # The conclusion redraws the team view
     send_message(self.client, ('addpay', round(newpay, 2)) )
     
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = self.pgframetimes
     self.cfg._dblog.log_pubgoods(self.cfg.simnumber, 
         self.id, self.group.id, 
         teamids, contrib, 
@@ -641,7 +826,10 @@ class HumanAgent(Agent):
     
     self.logratings()
     
-    send_and_receive(self.client, ('postprocess', '\n'.join(self.messages)) )
+    return self.request(('postprocess', '\n'.join(self.messages))).then(
+      self.finish_publicgoods_postprocess)
+
+  def finish_publicgoods_postprocess(self, answer):
     self.logratings(step='pg_postprocess')
     
     self.logratingstatus('simend', range(self.cfg.n))
@@ -663,9 +851,9 @@ class HumanAgent(Agent):
     send_message(self.client, ('d_instructions', None))
   
   def ask_for_offer(self, other_player):
-    amount = send_and_receive(self.client, ('u_makeoffer', other_player))
+    amount, frametimes = self.decide(('u_makeoffer', other_player))
     
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.ultevent_insert(
       self.id, other_player, 'make_offer', amount, sframe, eframe, stime, etime
     )
@@ -676,10 +864,10 @@ class HumanAgent(Agent):
     send_message(self.client, ('u_waitoffer', other_player))
   
   def decide_offer(self, other_player, amount):
-    result = send_and_receive(self.client, 
-                              ('u_decideoffer', (other_player, amount)))
+    result, frametimes = self.decide(
+      ('u_decideoffer', (other_player, amount)))
     
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.ultevent_insert(
       self.id, other_player, 'decide_offer', result, sframe, eframe, stime, etime
     )
@@ -690,8 +878,8 @@ class HumanAgent(Agent):
     send_message(self.client, ('u_waitdecide', other_player))
   
   def show_conclusion_u(self, other_player, amount, result, role):
-    send_and_receive(self.client, 
-                     ('u_conclusion', (other_player, amount, result, role)))
+    done, frametimes = self.decide(
+      ('u_conclusion', (other_player, amount, result, role)))
     
     if result:
       if role == 0:
@@ -700,7 +888,7 @@ class HumanAgent(Agent):
         my_amount = amount
     else:
       my_amount = 0
-    sframe, eframe, stime, etime = self.getframetimes()
+    sframe, eframe, stime, etime = frametimes
     self.cfg._dblog.ultevent_insert(
       self.id, other_player, 'conclusion', my_amount, 
       sframe, eframe, stime, etime)
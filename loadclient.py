@@ -0,0 +1,399 @@
+#
+# loadclient.py - headless stand-in for frontend.py, for load testing
+#                 the server with many human seats
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Headless clients that play human seats against simserver.py.
+
+Each Seat connects like frontend.py (TFNetBack) does, and answers every
+command without a GUI: a Policy makes the decisions, and the seat waits
+a think time before answering, drawn from the pilot-based human delays
+in Configuration._agent_delays (scaled by speed; 0 answers at once).
+Many seats run from one process, one thread each.
+
+Each seat records how long it waited on the server for every message:
+the time from when it finished with the previous message (sent its
+answer, or had none to send) to when the next one arrived, filed under
+the command that arrived. This is the server's round trip as the player
+sees it, including phase barriers. The histograms of all seats are
+merged and printed when the seats finish.
+
+Usage: loadclient.py server_ip nseats [policy] [--speed x] [--seed n]
+"""
+
+import sys
+import math
+import time
+import random
+import socket
+import threading
+
+from configuration import Configuration
+from utils import send_message, receive_message, SERVER_PORT
+from utils import choose_codec, set_codec
+
+# Configuration._agent_delays stage for each command that waits on a player
+THINK_STAGES = {'propose':'propose', 'acceptvote':'acceptvote',
+                'acceptvote_groupmerge':'acceptvote', 'consider':'join',
+                'expelvote':'expelvote', 'publicgoods':'publicgoods',
+                'turndone':'conclude', 'postprocess':'conclude',
+                'u_makeoffer':'conclude', 'd_makeoffer':'conclude',
+                'u_decideoffer':'conclude', 'u_conclusion':'conclude'}
+
+# Commands answered with (decision, frametimes); see TFGui.submit_decision
+DECISIONS = ('propose', 'acceptvote', 'acceptvote_groupmerge', 'consider',
+             'expelvote', 'publicgoods', 'u_makeoffer', 'd_makeoffer',
+             'u_decideoffer', 'u_conclusion')
+
+# Commands answered with 'send_done' once the player clicks OK
+CONFIRMS = ('instructions', 'publicgoods_instructions', 'turndone',
+            'postprocess')
+
+# Step marked on pushed ratings (see frontend.RATING_STEPS)
+RATING_STEPS = {'propose':'apply', 'acceptvote':'acceptvote',
+                'acceptvote_groupmerge':'acceptvote', 'expelvote':'expelvote',
+                'consider':'join', 'publicgoods':'publicgoods',
+                'postprocess':'postprocess'}
+
+
+class RandomPolicy(object):
+  """Makes random choices among the options the server offers"""
+  def __init__(self, rng):
+    self.rng = rng
+
+  def propose(self, gdata, nowpay):
+    # gdata: (gid, gsize, newpay, members) for each neighboring group
+    return [g[0] for g in gdata if self.rng.random() < 0.5]
+
+  def acceptvote(self, adata, nowpay):
+    # adata: (aid, newpay) for each applicant
+    return self.rng.choice([a[0] for a in adata] + [-1])
+
+  def consider(self, gdata, nowpay):
+    return self.rng.choice([g[0] for g in gdata] + [-1])
+
+  def expelvote(self, adata, nowpay):
+    return self.rng.choice([a[0] for a in adata] + [-1])
+
+  def publicgoods(self, pay):
+    return self.rng.randint(0, pay)
+
+  def makeoffer(self):
+    return self.rng.randint(0, 10)
+
+  def decideoffer(self, amount):
+    return self.rng.random() < 0.5
+
+
+class GreedyPolicy(RandomPolicy):
+  """Chooses the option that pays the most, like a myopic sim agent"""
+  def propose(self, gdata, nowpay):
+    return [g[0] for g in gdata if g[2] > nowpay]
+
+  def acceptvote(self, adata, nowpay):
+    return self.best(adata, nowpay)
+
+  def consider(self, gdata, nowpay):
+    return self.best([(g[0], g[2]) for g in gdata], nowpay)
+
+  def expelvote(self, adata, nowpay):
+    return self.best(adata, nowpay)
+
+  def best(self, options, nowpay):
+    """ID with the highest pay in (id, pay) options, or -1 if none beats
+       nowpay"""
+    bestid, bestpay = -1, nowpay
+    for oid, pay in options:
+      if pay > bestpay:
+        bestid, bestpay = oid, pay
+    return bestid
+
+  def publicgoods(self, pay):
+    return pay
+
+  def makeoffer(self):
+    return 5
+
+  def decideoffer(self, amount):
+    return amount > 0
+
+POLICIES = {'random':RandomPolicy, 'greedy':GreedyPolicy}
+
+
+class LatencyHistogram(object):
+  """Counts latencies in buckets that double in width, from 1 ms"""
+  NBUCKETS = 24   # The last bucket holds everything over 2**22 ms
+
+  def __init__(self):
+    self.counts = [0]*self.NBUCKETS
+    self.n = 0
+    self.total = 0.0
+    self.maximum = 0.0
+
+  def add(self, secs):
+    ms = secs*1000.0
+    bucket = 0 if ms < 1.0 else min(int(math.log(ms, 2))+1, self.NBUCKETS-1)
+    self.counts[bucket] += 1
+    self.n += 1
+    self.total += secs
+    self.maximum = max(self.maximum, secs)
+
+  def merge(self, other):
+    self.counts = [a+b for a, b in zip(self.counts, other.counts)]
+    self.n += other.n
+    self.total += other.total
+    self.maximum = max(self.maximum, other.maximum)
+
+  @staticmethod
+  def bucket_limit(bucket):
+    """Upper end of a bucket, in seconds"""
+    return 2**bucket / 1000.0
+
+  def percentile(self, p):
+    """Upper end of the bucket holding the p-th percentile, in seconds"""
+    target = p/100.0 * self.n
+    seen = 0
+    for bucket, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= target:
+        return min(self.bucket_limit(bucket), self.maximum)
+    return self.maximum
+
+  def report(self, width=40):
+    """Lines of a text bar chart of the non-empty buckets"""
+    lines = []
+    top = max(self.counts)
+    for bucket, count in enumerate(self.counts):
+      if count:
+        bar = '#'*max(1, count*width/top)
+        lines.append('  <{0:>9.3f}s {1:>7} {2}'.format(
+          self.bucket_limit(bucket), count, bar))
+    return lines
+
+
+class Seat(threading.Thread):
+  """One headless client, playing one human seat.
+
+  Attributes:
+    latency: command -> LatencyHistogram of waits for that command
+  """
+  def __init__(self, serverIP, policy, rng, speed=1.0):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.serverIP = serverIP
+    self.policy = policy
+    self.rng = rng
+    self.speed = speed
+    self.latency = {}
+    self.error = None
+
+    self.connection = None
+    self.clientnum = None
+    self.myid = None
+    self.cfgdict = {}
+    self.neighbors = []
+    self.ratinglog = []
+    self.ratings = {}
+    self.nowpay = 0.0
+    self.totalpay = 0.0
+
+  def run(self):
+    try:
+      self.server_setup()
+      self.event_loop()
+    except (socket.error, IOError, ValueError) as e:
+      self.error = e
+
+  def server_setup(self):
+    conn = None
+    while not conn:
+      try:
+        conn = socket.create_connection( (self.serverIP, SERVER_PORT) )
+      except socket.error:
+        time.sleep(2.0)
+    self.connection = conn
+
+    command, (clientnum, codecs) = receive_message(conn)
+    self.clientnum = clientnum
+    codec = choose_codec(codecs)
+    send_message(conn, ('codec', codec))
+    set_codec(conn, codec)
+
+  def event_loop(self):
+    """Answer messages until the server closes the connection"""
+    ready = time.time()
+    while True:
+      try:
+        command, data = receive_message(self.connection)
+      except IOError:
+        return
+      arrived = time.time()
+      if command not in self.latency:
+        self.latency[command] = LatencyHistogram()
+      self.latency[command].add(arrived - ready)
+      self.handle_message(command, data)
+      ready = time.time()
+
+  def send(self, message, push=False):
+    send_message(self.connection, message, push)
+
+  def think(self, command):
+    """Wait as long as a player might take to answer command"""
+    stage = THINK_STAGES.get(command)
+    if not self.speed or stage is None:
+      return
+    mean = Configuration._agent_delays[stage]
+    dev = Configuration._agent_delay_dev[stage]
+    time.sleep(max(self.rng.gauss(mean, dev), 0.25) * self.speed)
+
+  def rate(self, command):
+    """Sometimes rate a neighbor, like a player clicking the stars"""
+    if not self.neighbors or self.rng.random() > 0.2:
+      return
+    aid = self.rng.choice(self.neighbors)
+    rating = self.rng.randint(1, 5)
+    self.ratings[aid] = rating
+    event = [self.myid, aid, rating, -1, time.time()]
+    if self.cfgdict.get('_push_ratings'):
+      event.append(RATING_STEPS.get(command, 'NA'))
+      self.send( ('ratings', [event]), push=True )
+    else:
+      self.ratinglog.append(event)
+
+  def decide(self, command, data):
+    policy = self.policy
+    if command == 'propose':
+      return policy.propose(data, self.nowpay)
+    elif command == 'acceptvote':
+      return policy.acceptvote(data, self.nowpay)
+    elif command == 'consider':
+      return policy.consider(data, self.nowpay)
+    elif command == 'expelvote':
+      return policy.expelvote(data, self.nowpay)
+    elif command == 'publicgoods':
+      pay, potmult = data
+      return policy.publicgoods(pay)
+    elif command in ('u_makeoffer', 'd_makeoffer'):
+      return policy.makeoffer()
+    elif command == 'u_decideoffer':
+      other_player, amount = data
+      return policy.decideoffer(amount)
+    elif command == 'u_conclusion':
+      return 'send_done'
+    return -1   # acceptvote_groupmerge: accept no one
+
+  def handle_message(self, command, data):
+    if command == 'setconfig':
+      self.cfgdict = data
+      self.send('send_done')
+    elif command == 'setmyid':
+      self.myid = data
+    elif command == 'initratings':
+      self.neighbors = [aid for aid in data if aid != self.myid]
+    elif command == 'updatestate':
+      if 'pay' in data:
+        self.nowpay = data['pay']
+    elif command == 'addpay':
+      self.totalpay += data
+    elif command in DECISIONS:
+      stime = time.time()
+      self.think(command)
+      decision = self.decide(command, data)
+      self.rate(command)
+      self.send( (decision, (-1, -1, stime, time.time())) )
+    elif command in CONFIRMS:
+      self.think(command)
+      self.send('send_done')
+    elif command == 'introsurvey':
+      self.send( ('NA', 'NA', 'load test') )
+    elif command == 'getratinglog':
+      ratinglog, self.ratinglog = self.ratinglog, []
+      self.send(ratinglog)
+    elif command == 'getratings':
+      self.send(self.ratings)
+    elif command == 'exitsurvey':
+      self.send(1)
+      self.send( ('Load test', 'Answered by loadclient.py') )
+      self.send(self.totalpay)
+    # Everything else is display-only; the frontend sends no answer
+
+
+def merge_latency(seats):
+  """Merge the seats' histograms into one per command"""
+  merged = {}
+  for seat in seats:
+    for command, hist in seat.latency.iteritems():
+      merged.setdefault(command, LatencyHistogram()).merge(hist)
+  return merged
+
+def report(seats, elapsed):
+  """Print per-command server round trip latency for all seats"""
+  merged = merge_latency(seats)
+  nmsgs = sum(h.n for h in merged.itervalues())
+  failed = [s for s in seats if s.error is not None]
+  print "{0} seats, {1} messages in {2:.1f}s ({3:.1f} msgs/s), {4} errors".format(
+    len(seats), nmsgs, elapsed, nmsgs/max(elapsed, 1e-9), len(failed))
+  print "{0:<26}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}".format(
+    'command', 'n', 'mean', 'p50', 'p90', 'p99', 'max')
+  for command, hist in sorted(merged.iteritems()):
+    print "{0:<26}{1:>8}{2:>10.3f}{3:>10.3f}{4:>10.3f}{5:>10.3f}{6:>10.3f}".format(
+      command, hist.n, hist.total/hist.n, hist.percentile(50),
+      hist.percentile(90), hist.percentile(99), hist.maximum)
+  for command, hist in sorted(merged.iteritems()):
+    if command in DECISIONS or command in CONFIRMS:
+      print command
+      for line in hist.report():
+        print line
+
+def run_seats(serverIP, nseats, policy='random', speed=1.0, seed=None):
+  """Start nseats seats, wait for them to finish, and print the report"""
+  master = random.Random(seed)
+  seats = []
+  for i in range(nseats):
+    rng = random.Random(master.getrandbits(32))
+    seats.append(Seat(serverIP, POLICIES[policy](rng), rng, speed))
+  start = time.time()
+  for seat in seats:
+    seat.start()
+  try:
+    for seat in seats:
+      # Join with a timeout so KeyboardInterrupt still gets through
+      while seat.is_alive():
+        seat.join(1.0)
+  except KeyboardInterrupt:
+    print "Interrupted"
+  report(seats, time.time() - start)
+  return seats
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  speed = 1.0
+  seed = None
+  if '--speed' in args:
+    i = args.index('--speed')
+    speed = float(args[i+1])
+    del args[i:i+2]
+  if '--seed' in args:
+    i = args.index('--seed')
+    seed = int(args[i+1])
+    del args[i:i+2]
+  if len(args) < 2 or (len(args) > 2 and args[2] not in POLICIES):
+    print __doc__
+    sys.exit(1)
+  run_seats(args[0], int(args[1]), args[2] if len(args) > 2 else 'random',
+            speed, seed)
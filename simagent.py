@@ -22,9 +22,11 @@ Includes DumbAgent which decides randomly, and greedy SimAgent.
 """
 
 import random
-import time
 
 from agentgroup import Agent, UltAgent
+
+# tfevent eventtype for each tf_delay stage, where the names differ
+_TFEVENT_TYPES = {'propose':'apply', 'publicgoods':'pubgood'}
  
 class DumbAgent(Agent, UltAgent):
   """Barebones agent that makes all decisions randomly."""
@@ -116,7 +118,8 @@ class SimAgent(Agent, UltAgent):
     self.pgmem = {}         # Memory of what other agents have contributed
       
     if self.cfg.delay_sim_agents:
-      self.slow = True
+      # On a virtual clock the delays don't block, so no need for threads
+      self.slow = not self.cfg._virtual_time
       self.tf_delay = self.tf_delay_real
     else:
       self.tf_delay = self.tf_delay_null
@@ -151,7 +154,8 @@ class SimAgent(Agent, UltAgent):
         (self.id < self.cfg.delay_n_sims or not self.cfg.delay_n_sims)):
       rand_delay = random.gauss(self.cfg._agent_delays[stage],
                                 self.cfg._agent_delay_dev[stage])
-      time.sleep(max(rand_delay, 0.25))
+      self.cfg._clock.sleep(max(rand_delay, 0.25), self.id, 
+                            _TFEVENT_TYPES.get(stage, stage))
 
   def switchgroup(self, newgroup):
     """Switch group, and reset memory (because something changed"""
@@ -213,15 +217,23 @@ class SimAgent(Agent, UltAgent):
       else:
         gpay = task(newskills)/(group.gsize+1)
         if gpay > self.nowpay and totalweights.get(group.id, 0) >= 1:
-          if (not self.cfg.agent_memory or 
-              self.do_mem(self.proposemem.get((group, gpay),0))):
-            group.takeapplication(self)
+          self.applyto(group, gpay)
+
+  def applyto(self, group, gpay):
+    """Apply to group, which would pay gpay, subject to agent_memory.
+    
+    Called by propose, and by the simulation's batched propose step
+    (which does the pay comparisons for all agents at once).
+    """
+    if (not self.cfg.agent_memory or 
+        self.do_mem(self.proposemem.get((group, gpay),0))):
+      group.takeapplication(self)
 
-            self.logp(("agent", self.id, "in group", self.group.id, 
-                       "proposing to", group.id), 6)
-            
-            if self.cfg.agent_memory:
-              self.proposemem[(group, gpay)] = self.proposemem.get((group, gpay) ,0) + 1
+      self.logp(("agent", self.id, "in group", self.group.id, 
+                 "proposing to", group.id), 6)
+      
+      if self.cfg.agent_memory:
+        self.proposemem[(group, gpay)] = self.proposemem.get((group, gpay) ,0) + 1
 
   def acceptvote(self, applicants):
     """Look at all applicants, and accept one that improves pay most.
@@ -30,9 +30,10 @@ from graph import GraphManager
 from analyzer import Analyzer
 from agentgroup import Agent
 from clientwaiter import ClientWaiter
-from db_logger import DBLogger
+from db_logger import LOG_SINKS
 from simulation import simulation
 from configuration import Configuration, MultiConfig
+from sweep import SweepRunner
 
 
 def heartbeat_thread():
@@ -44,7 +45,8 @@ def heartbeat_thread():
 if __name__ == '__main__':
   alt_options = ['single', 'auto']
   
-  dblog = DBLogger('simlog.db')
+  dblog = LOG_SINKS[Configuration._log_sink]('simlog.db', Configuration._db_profile,
+                   Configuration._db_queue_size, Configuration._db_queue_policy)
   Configuration._dblog = dblog
   dblog.start_batch_insert_thread()
   
@@ -128,13 +130,7 @@ if __name__ == '__main__':
     dblog.log_agentconfig(atypes)
     
     ## GIVE INTRO SURVEY HERE
-    mythreads = []
-    for a in sim.humans:
-      t = threading.Thread(target=a.introsurvey)
-      mythreads.append(t)
-      t.start()
-    for t in mythreads:
-      t.join()
+    sim.joinall([sim.pool.submit(a.introsurvey) for a in sim.humans])
   
     if Configuration._do_video:
       for a in sim.humans:
@@ -337,13 +333,7 @@ if __name__ == '__main__':
     ## END BIG IF STATEMENT
     
     ## GIVE EXIT SURVEY HERE
-    mythreads = []
-    for a in sim.humans:
-      t = threading.Thread(target=a.exitsurvey)
-      mythreads.append(t)
-      t.start()
-    for t in mythreads:
-      t.join()
+    sim.joinall([sim.pool.submit(a.exitsurvey) for a in sim.humans])
     
     # Collect final pay from the human agents
     paydata = []
@@ -356,6 +346,7 @@ if __name__ == '__main__':
     #    a.hideratings()
     
     dblog.log_sessionend()
+    dblog.close()
     k=raw_input('END OF EXPERIMENT. Press Enter to terminate server.')
       
   elif sys.argv[1] == 'single':    # Run a single ... exit survey?
@@ -383,13 +374,7 @@ if __name__ == '__main__':
     #for t in mythreads:
       #t.join()
       
-    mythreads = []
-    for a in sim.humans:
-      t = threading.Thread(target=a.exitsurvey)
-      mythreads.append(t)
-      t.start()
-    for t in mythreads:
-      t.join()
+    sim.joinall([sim.pool.submit(a.exitsurvey) for a in sim.humans])
     ## END TEST
     
     sim.run()
@@ -404,25 +389,20 @@ if __name__ == '__main__':
     plt.show()
   
   elif sys.argv[1] == 'auto':     ## Automated option: run sims without humans and log to a file
+    # Usage: simserver.py auto outfile [workers] [--shard i/k]
+    # Completed configs are recorded in the database and skipped on restart
+    args = sys.argv[2:]
+    shard = None
+    if '--shard' in args:
+      i = args.index('--shard')
+      shard = tuple(int(x) for x in args[i+1].split('/'))
+      del args[i:i+2]
     allconfs = MultiConfig()
-    outfile = sys.argv[2]
+    outfile = args[0]
+    workers = int(args[1]) if len(args) > 1 else 1
     
     confs = [conf for conf in allconfs.itersims()]
     random.shuffle(confs)
     
-    #for conf in allconfs.itersims():
-    for conf in confs:
-      conf.printself()
-      gm = GraphManager(conf)
-      gm.setup()
-      sim = simulation()
-      if sim.setup(gm.G, conf):
-        sim.run()
-      Gdone = sim.export()
-      ann = Analyzer()
-      ann.load(Gdone, conf)
-      ann.summary()
-      ann.dumpsummary(outfile)
-      if conf._pause_after_sim:
-        k=raw_input()
-      Agent.agentid = 0 
+    SweepRunner(confs, outfile, workers, shard).run()
+    dblog.close()
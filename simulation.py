@@ -24,7 +24,12 @@ from itertools import izip
 import threading
 import matplotlib.pyplot as plt
 
+from threadpool import ThreadPool
+from clientmux import gather
+from vclock import RealClock, VirtualClock
+
 from configuration import Configuration
+from arrayengine import ArrayEngine
 from agentgroup import Group
 from humanagent import HumanAgent
 from simagent import SimAgent, DumbAgent
@@ -43,6 +48,21 @@ class simulation:
     self.cfg = config
     self.G = graph.copy()
     self.cfg._Gptr = self.G
+    self.cfg.compile_task()
+    if getattr(self, 'pool', None) is None:
+      self.pool = ThreadPool(config._pool_size)
+    self.cfg._pool = self.pool
+    if not config._virtual_time:
+      self.clock = RealClock()
+    elif not isinstance(getattr(self, 'clock', None), VirtualClock):
+      # Keep one virtual clock across sims, so simulated time keeps going
+      self.clock = VirtualClock()
+    self.clock.parallel = config._threaded_sim
+    self.cfg._clock = self.clock
+    if config._array_engine:
+      self.engine = ArrayEngine(config.n, config.nskills)
+    else:
+      self.engine = None
     self.initgraph()
     self.initagents()
     self.initgroups()
@@ -151,6 +171,7 @@ class simulation:
       for t in threads:
         active_threads = active_threads or t.is_alive()
       time.sleep(1.0)
+    self.clock.sync()
       
     for h in humans:
       h.u_review()
@@ -178,7 +199,7 @@ class simulation:
     c1 = self.idnodes[giver_id]
     c2 = self.idnodes[receiver_id]
     
-    stime = time.time()
+    stime = self.clock.time()
     
     c1.ultimatum(c2.id)
     c2.ultimatum(c1.id)
@@ -195,7 +216,7 @@ class simulation:
     c1.show_conclusion_u(c2.id, amount, result, 0)
     c2.show_conclusion_u(c1.id, amount, result, 1)
     
-    etime = time.time()
+    etime = self.clock.time()
   
     self.cfg._dblog.log_ultimatum(giver_id, receiver_id, amount, result, stime, etime)
   
@@ -203,12 +224,72 @@ class simulation:
     cfg = self.cfg
     if cfg._log_teamstatus:
       gdata = [(g.id, [a.id for a in g.agents], g.nowpay) for g in groups if len(g.agents)]
-      cfg._dblog.log_teamstatus(cfg.simnumber, cfg.iternum, eventtype, gdata, activeagent)
+      if cfg._teamstatus_mode == 'delta':
+        self.log_teamdelta(eventtype, gdata, activeagent)
+      else:
+        cfg._dblog.log_teamstatus(cfg.simnumber, cfg.iternum, eventtype, gdata, activeagent)
   
-  def joinall(self, mythreads):
-    for i,t in enumerate(mythreads):
-      self.log("Waiting for "+str(i))
-      t.join()
+  def log_teamdelta(self, eventtype, gdata, activeagent=-1):
+    """Log the agents whose team or pay changed since the last step
+    
+    The first step of a sim logs every agent (a snapshot).
+    """
+    cfg = self.cfg
+    teamstate = self.teamstate
+    snapshot = not teamstate
+    changes = []
+    for gid, gmembers, gpay in gdata:
+      for aid in gmembers:
+        if teamstate.get(aid) != (gid, gpay):
+          teamstate[aid] = (gid, gpay)
+          changes.append( (aid, gid, gpay) )
+    cfg._dblog.log_teamdelta(cfg.simnumber, self.teamphase, cfg.iternum, 
+                             eventtype, changes, activeagent, snapshot)
+    self.teamphase += 1
+  
+  def log_delays(self, iternum):
+    """Log agent delays recorded by a virtual clock to 'tfevent'"""
+    cfg = self.cfg
+    delays = self.clock.drain()
+    if delays:
+      cfg._dblog.log_delays(cfg.simnumber, iternum, delays)
+  
+  def joinall(self, futures, deadline=None, agents=None):
+    """Wait for futures from self.pool, and return their results.
+    
+    Tasks not started by deadline (a self.clock time) are cancelled 
+    (see ThreadPool.wait). If agents is given, one per future, the IDs 
+    of the agents whose task was cancelled are logged.
+    """
+    self.log("Waiting for "+str(len(futures))+" tasks", 6)
+    results = self.pool.wait(futures, deadline, self.clock)
+    if agents is not None:
+      for a, f in zip(agents, futures):
+        if f.cancelled():
+          self.log("Agent "+str(a.id)+" ran out of time and was cancelled")
+    return results
+  
+  def batch_propose(self):
+    """Do the propose step for all fast sim agents at once.
+    
+    Uses the array engine to compare pay in every neighboring group 
+    in bulk, instead of calling SimAgent.propose for each agent.
+    Humans, slow agents, and non-greedy agents are left out, 
+    as is the bias model, and must still call propose().
+    
+    Returns:
+      dictionary mapping agent ID -> list of (Group, pay) to apply to
+    """
+    if self.engine is None or self.cfg.bias:
+      return {}
+    aids = [a.id for a in self.agents 
+            if isinstance(a, SimAgent) and not a.slow]
+    if not aids:
+      return {}
+    candidates = self.engine.propose_candidates(self.G, self.cfg.taskmany, aids)
+    groupdict = self.groupdict
+    return {aid:[(groupdict[gid], gpay) for gid, gpay in cands] 
+            for aid, cands in izip(aids, candidates)}
   
   def run(self, endtime=0):
     cfg = self.cfg
@@ -217,6 +298,12 @@ class simulation:
     groups = self.groups
     log = self.log
     
+    if self.engine is not None:
+      self.engine.graph_dirty = True    # The graph may have changed since the last run
+    
+    self.teamstate = {}     # agent id -> (team id, pay) last logged
+    self.teamphase = 0      # number of team status steps logged this sim
+    
     lastteams = [0]*n
     iters = 0
     deaditers = 0 
@@ -230,17 +317,9 @@ class simulation:
     #    a.hideratings()     
     
     ### PARALLEL
-    if cfg._threaded_sim and self.humans:
-      mythreads = []
-      for a in self.humans:
-        ## Should only start threads for the human agents
-        t = threading.Thread(target=a.instructions)
-        mythreads.append(t)
-        t.start()
-      self.joinall(mythreads)
-    elif self.humans:
-      for a in self.humans:
-        a.instructions()
+    if self.humans:
+      # Send all instructions first, then wait for every human
+      gather([a.start_instructions() for a in self.humans])
     
     #print "Instructions done; press ENTER"  ##TEMP HACK!!!
     #raw_input()
@@ -253,34 +332,56 @@ class simulation:
     if cfg._verbose > 7:
       cfg.printself()
     
-    for a in self.agents:   # Log topology info for every agent!!!
-      cfg._dblog.log_topo(cfg.simnumber, a.id, [nbr.id for nbr in a.nbrs])
+    if cfg._topo_mode == 'graph':
+      cfg._dblog.log_graph(cfg.simnumber, 
+                           [(a.id, [nbr.id for nbr in a.nbrs]) for a in self.agents])
+    else:
+      for a in self.agents:   # Log topology info for every agent!!!
+        cfg._dblog.log_topo(cfg.simnumber, a.id, [nbr.id for nbr in a.nbrs])
     
     log("Beginning run!")
-    trunstart = time.time()
+    clock = self.clock
+    trunstart = clock.time()
     
     try:
       for iternum in xrange(cfg.nsteps):
-        tstart = time.time()
+        tstart = clock.time()
         
         self.cfg.iternum = iternum
         
         ### PARALLEL - apply
         self.log_teamstatus('apply', groups)
+        proposals = self.batch_propose()
         if cfg._threaded_sim:
-          mythreads = []
+          futures = []
+          pooled = []
+          pending = []
           for a in random.sample(agents, n):
-            ## Should only start threads for the human agents
-            if a.slow:
-              t = threading.Thread(target=a.propose)
-              mythreads.append(t)
-              t.start()
+            # Humans are sent their screens at once; the pool is only
+            # for the slow simulated agents
+            if a.id in proposals:
+              a.tf_delay('propose')
+              for g, gpay in proposals[a.id]:
+                a.applyto(g, gpay)
+            elif a.type == 'human':
+              pending.append(a.start_propose())
+            elif a.slow:
+              futures.append(self.pool.submit(a.propose))
+              pooled.append(a)
             else:
               a.propose()
-          self.joinall(mythreads)
+          # Out of time: agents who haven't started don't get to apply
+          self.joinall(futures, deadline=endtime, agents=pooled)
+          gather(pending)
+          clock.sync()
         else:
           for a in random.sample(agents, n):
-            a.propose()
+            if a.id in proposals:
+              a.tf_delay('propose')
+              for g, gpay in proposals[a.id]:
+                a.applyto(g, gpay)
+            else:
+              a.propose()
         
         ### PARALLELIZE
         if cfg.groups_can_merge:
@@ -292,18 +393,17 @@ class simulation:
         ### PARALLEL - acceptvote
         self.log_teamstatus('acceptvote', groups)
         if cfg._threaded_sim:
-          mythreads = []
+          pending = []
           for g in random.sample(groups, n):
-            ## Should only start threads for the human agents
             if len(g.agents):
               g.update()
               if g.slow:
-                t = threading.Thread(target=g.consider)
-                mythreads.append(t)
-                t.start()
+                # Votes from humans and slow agents are collected below
+                pending.append(g.start_consider())
               else:
                 g.consider()
-          self.joinall(mythreads)
+          gather(pending)
+          clock.sync()
         else:
           for g in random.sample(groups, n):
             if len(g.agents): # or len(g.applications):
@@ -324,6 +424,7 @@ class simulation:
               self.log_teamstatus('join', groups, activeagent=a.id)
             log("Waiting for "+str(a.id))
             a.consider()
+            clock.sync()
         
         ### SERIAL - expel agents
         expelee = None
@@ -335,6 +436,7 @@ class simulation:
             if len(g.agents) > 1:
               self.log_teamstatus('expel', groups, activeagent=g.id)
               expelees = g.expel_agent()
+              clock.sync()
               for expelee in expelees:
                 newgroup = emptygroups.pop()
                 expelee.switchgroup(newgroup)
@@ -342,21 +444,23 @@ class simulation:
         ### PARALLEL - postprocess_iter
         self.log_teamstatus('enditer', groups)
         if cfg._threaded_sim:
-          mythreads = []
+          futures = []
+          pending = []
           for a in random.sample(agents, n):
-            ## Should only start threads for the human agents
-            if a.slow:
-              t = threading.Thread(target=a.postprocess_iter)
-              mythreads.append(t)
-              t.start()
+            if a.type == 'human':
+              pending.append(a.start_postprocess_iter())
+            elif a.slow:
+              futures.append(self.pool.submit(a.postprocess_iter))
             else:
               a.postprocess_iter()
-          self.joinall(mythreads)
+          self.joinall(futures)
+          gather(pending)
+          clock.sync()
         else:
           for a in random.sample(agents, n):
             a.postprocess_iter()
 
-        tend = time.time()
+        tend = clock.time()
 
         if cfg._draw_graph:
           G = cfg._Gptr
@@ -388,7 +492,10 @@ class simulation:
             k = raw_input()
         
         # Check if anything has changed
-        teams = [a.group.id for a in agents]
+        if self.engine is not None:
+          teams = self.engine.teams()
+        else:
+          teams = [a.group.id for a in agents]
         log(lastteams)
         log(teams)
         
@@ -406,6 +513,7 @@ class simulation:
         log("Iteration "+str(iternum)+" complete in "+str(round(tend-tstart, 2))+" seconds",3)
         
         cfg._dblog.log_simtime(cfg.simnumber, iternum, tstart, tend)
+        self.log_delays(iternum)
         
         
         ## TERMINATE SIM CONDITIONS
@@ -417,7 +525,7 @@ class simulation:
           lastteams = teams
           iters += 1
         
-        if endtime and time.time() > endtime and iternum > 2:
+        if endtime and clock.time() > endtime and iternum > 2:
           log("ENDING SIM: OUT OF TIME")
           enditer = iternum
           break
@@ -451,11 +559,10 @@ class simulation:
     for s, pay in globalpay.iteritems():
       globalpay[s] = sum(globalpay[s])/len(globalpay[s])
     
-    tpubstart = time.time()
+    tpubstart = clock.time()
     if not cfg.do_publicgoods:
       if self.humans:
-        for a in self.humans:
-          a.postprocess()
+        gather([a.start_postprocess() for a in self.humans])
       
       if cfg.dynamic_graph:
         for a in agents:
@@ -463,6 +570,10 @@ class simulation:
         
         for g in groups:
           g.postprocess()
+        
+        if cfg._topo_mode == 'graph':
+          cfg._dblog.log_graph(cfg.simnumber, 
+                               [(a.id, [nbr.id for nbr in a.nbrs]) for a in agents], 'simend')
     #elif self.humans:
     else:   # Run even when no humans
       self.publicgoods()
@@ -488,13 +599,14 @@ class simulation:
     
     cfg.lastratings = ratings
     
-    cfg._dblog.log_globalratings(cfg.simnumber, iternum, ratings, etime=time.time())
+    cfg._dblog.log_globalratings(cfg.simnumber, iternum, ratings, etime=clock.time())
         
-    trunend = time.time()
+    trunend = clock.time()
     
     # Log time spent in public goods
     # Total sim time is logged in tfsummary/tfdata
     cfg._dblog.log_simtime(cfg.simnumber, -1, tpubstart, trunend)
+    self.log_delays(-1)
 
     self.log_teamstatus('simend', groups)
   
@@ -508,7 +620,7 @@ class simulation:
     
     cfg._dblog.log_conclusion(groups, self.cfg.simnumber)
     #cfg._dblog.log_simtime(cfg.simnumber, -1, trunstart, trunend)
-    cfg._dblog.forcecommit = True   # Ensure that commits are made, especially when running with no humans.
+    cfg._dblog.commit()   # Ensure that commits are made, especially when running with no humans.
     
 
   def calc_potmult(self, group, cfg, pgdict=None):
@@ -540,23 +652,28 @@ class simulation:
     ## Acquire public goods contributions
     pgdict = {}     # Stores agent contribution choices
     if cfg._threaded_sim:
-      mythreads = []
+      futures = []
+      pending = []
       for a in self.agents:
-        if len(a.group.agents) == 1:
-          t = threading.Thread(target=a.postprocess())
-          mythreads.append(t)
-          t.start()
+        if a.type == 'human':
+          if len(a.group.agents) == 1:
+            pending.append(a.start_postprocess())
+          else:
+            potmult = self.calc_potmult(a.group, cfg)
+            pending.append(a.start_publicgoods(pgdict, potmult))
+        elif len(a.group.agents) == 1:
+          a.postprocess()
         elif a.slow:
           potmult = self.calc_potmult(a.group, cfg)
-          t = threading.Thread(target=a.publicgoods, args=(pgdict, potmult))
-          mythreads.append(t)
-          t.start()
+          futures.append(self.pool.submit(a.publicgoods, pgdict, potmult))
         else:
           potmult = self.calc_potmult(a.group, cfg)
           #contrib, keep = a.publicgoods()
           a.publicgoods(pgdict, potmult)
         #pgdict[a] = (contrib, keep)    # This will get added by the publicgoods threads
-      self.joinall(mythreads)
+      self.joinall(futures)
+      gather(pending)
+      self.clock.sync()
     else:
       for a in self.agents:
         if len(a.group.agents) == 1: 
@@ -568,7 +685,8 @@ class simulation:
           a.publicgoods(pgdict, potmult)
     
     ## Distribute money back to agents
-    mythreads = []
+    futures = []
+    pending = []
     for g in groups:
       if len(g.agents) <= 1: 
       #  for a in g.agents:
@@ -584,15 +702,17 @@ class simulation:
         privatepay = keep
         if a.type == 'human':
           a.showratings()
-        if a.slow and cfg._threaded_sim:
-          t = threading.Thread(target=a.publicgoods_postprocess, args=(startpay, keep, contrib, privatepay, sharedpay, teampays))
-          mythreads.append(t)
-          t.start()
+        if a.type == 'human' and cfg._threaded_sim:
+          pending.append(a.start_publicgoods_postprocess(startpay, keep, contrib, privatepay, sharedpay, teampays))
+        elif a.slow and cfg._threaded_sim:
+          futures.append(self.pool.submit(a.publicgoods_postprocess, startpay, keep, contrib, privatepay, sharedpay, teampays))
         else:
           a.publicgoods_postprocess(startpay, keep, contrib, privatepay, sharedpay, teampays)
         a.nowpay = privatepay + sharedpay  ## TEST
     if cfg._threaded_sim:
-      self.joinall(mythreads)
+      self.joinall(futures)
+      gather(pending)
+      self.clock.sync()
         
     ## Give statistics and rating data to the agents
     #self.pgsummary = {a.id:(float(pgdict[a][0])/(pgdict[a][0]+pgdict[a][1])) for a in self.agents if a in pgdict}
@@ -678,6 +798,8 @@ class simulation:
     for a in agents:
       a.neighbors()
       a.nbrweight()
+      if self.engine is not None:
+        self.engine.bind_agent(a)
     
     self.agents = agents
     self.agentdict = agentdict
@@ -687,6 +809,8 @@ class simulation:
     #groups = dict((a.id, Group(a.id, self.cfg)) for a in self.agents)
     groups = [Group(a.id, self.cfg) for a in self.agents]
     for a, g in izip(self.agents, groups):
+      if self.engine is not None:
+        self.engine.bind_group(g)
       g.addfirst(a)
       a.group = g
       
@@ -702,6 +826,8 @@ class simulation:
         random.seed(cfg.skillseed)
       for a in self.agents:
         a.randbiases()
+      for g in self.groups:
+        g.recalc()    # Bias sums depend on the new biases
       if cfg.skillseed is not None:
         random.setstate(currstate)
   
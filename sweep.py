@@ -0,0 +1,190 @@
+#
+# sweep.py - runs automated parameter sweeps, optionally in parallel
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Runs a list of simulation configurations without humans.
+
+Used by simserver.py auto mode. Each configuration is independent, so
+they can be fanned out over a multiprocessing pool. Workers send back
+the Analyzer results and their database inserts, and the parent writes
+the output file and database in configuration order.
+
+Completed configurations are recorded in the database by fingerprint
+(see fingerprint()), so an interrupted sweep can be restarted and will
+skip what it already finished. A sweep can also be split between
+machines with a shard (i, k): each machine runs the configurations whose
+fingerprint is i modulo k.
+"""
+
+import multiprocessing
+import random
+import hashlib
+import json
+import numpy as np
+
+from graph import GraphManager
+from analyzer import Analyzer, writesummary
+from agentgroup import Agent
+from simulation import simulation
+from configuration import Configuration
+
+
+# Config values that depend on a config's position in the sweep or are set 
+# while it runs, rather than describing the configuration itself
+_FINGERPRINT_SKIP = ('simnumber', 'iternum', 'lastratings')
+
+def fingerprint(cfg):
+  """Return a hex string identifying a configuration in a sweep.
+  
+  Hashes all of the output configuration options, the rep number,
+  and the graph and skill seeds.
+  """
+  configd = cfg.outputcfg()
+  for k in _FINGERPRINT_SKIP:
+    configd.pop(k, None)
+  key = [sorted(configd.items()), cfg._rep, cfg.graphseed, cfg.skillseed]
+  return hashlib.sha1(json.dumps(key, sort_keys=True, default=repr)).hexdigest()
+
+def inshard(fp, shard):
+  """Is the config with fingerprint fp in shard (i, k)?"""
+  if shard is None:
+    return True
+  i, k = shard
+  return int(fp, 16) % k == i
+
+def taskseed(cfg, fp, base):
+  """Random seed for one simulation run.
+
+  If the configuration fixes graphseed or skillseed, derive the seed from
+  its fingerprint fp (which includes those seeds), so a config gets the 
+  same seed when rerun, resumed, or run in another shard; otherwise use 
+  base (drawn by the parent, so forked workers don't share random streams).
+  """
+  if cfg.graphseed is None and cfg.skillseed is None:
+    return base
+  return int(fp[:8], 16)
+
+def runconfig(cfg):
+  """Run one simulation, and return its Analyzer"""
+  gm = GraphManager(cfg)
+  gm.setup()
+  sim = simulation()
+  if sim.setup(gm.G, cfg):
+    sim.run()
+  Gdone = sim.export()
+  ann = Analyzer()
+  ann.load(Gdone, cfg)
+  Agent.agentid = 0
+  return ann
+
+def initworker():
+  """Set up a pool worker process"""
+  if Configuration._dblog is not None:
+    Configuration._dblog.detach()
+
+def runtask(task):
+  """Pool worker function: run one configuration.
+
+  Arguments:
+    task: (index, seed, cfg) tuple
+  Returns:
+    (index, Analyzer.data, cfg.outputcfg(), list of database inserts)
+  """
+  index, seed, cfg = task
+  random.seed(seed)
+  np.random.seed(seed)
+  ann = runconfig(cfg)
+  if Configuration._dblog is not None:
+    inserts = Configuration._dblog.drain_inserts()
+  else:
+    inserts = []
+  return index, ann.data, cfg.outputcfg(), inserts
+
+
+class SweepRunner(object):
+  """Runs a list of configurations and writes their results.
+
+  Attributes:
+    confs: list of Configuration objects, in the order to write them
+    outfile: TSV file to append results to (see analyzer.writesummary)
+    workers: number of worker processes; 1 runs in this process
+    shard: (i, k) to run only shard i of k, or None to run everything
+  """
+  def __init__(self, confs, outfile, workers=1, shard=None):
+    self.confs = confs
+    self.outfile = outfile
+    self.workers = workers
+    self.shard = shard
+
+  def pending(self):
+    """Return a list of (fingerprint, cfg) for configurations in this
+       shard that have not been completed yet"""
+    done = Configuration._dblog.get_sweepdone()
+    todo = []
+    for cfg in self.confs:
+      fp = fingerprint(cfg)
+      if inshard(fp, self.shard) and fp not in done:
+        todo.append((fp, cfg))
+    print len(todo), "of", len(self.confs), "configurations to run", 
+    print "(" + str(len(done)), "done previously)"
+    return todo
+
+  def run(self):
+    """Run all configurations that have not been done yet"""
+    todo = self.pending()
+    if self.workers <= 1:
+      self.runserial(todo)
+    else:
+      self.runparallel(todo)
+
+  def runserial(self, todo):
+    dblog = Configuration._dblog
+    for fp, cfg in todo:
+      cfg.printself()
+      ann = runconfig(cfg)
+      ann.summary()
+      ann.dumpsummary(self.outfile)
+      dblog.log_sweepdone(fp, cfg.simnumber)
+      if cfg._pause_after_sim:
+        k=raw_input()
+
+  def runparallel(self, todo):
+    dblog = Configuration._dblog
+    tasks = [(i, taskseed(cfg, fp, random.getrandbits(32)), cfg)
+             for i, (fp, cfg) in enumerate(todo)]
+
+    pool = multiprocessing.Pool(self.workers, initializer=initworker)
+    try:
+      # imap returns results in task order, so output order is repeatable
+      for index, data, configd, inserts in pool.imap(runtask, tasks):
+        for item in inserts:
+          dblog.requeue(item)
+        dblog.commit()    # as simulation.run does at the end of a sim
+
+        print "Sim", index+1, "of", len(tasks), "done"
+        for var, val in sorted(data.items()):
+          print str(var)+":", val
+        writesummary(self.outfile, data, configd)
+        fp, cfg = todo[index]
+        dblog.log_sweepdone(fp, cfg.simnumber)
+      pool.close()
+    except BaseException:
+      # Stop the workers, so join() does not hide the error
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
@@ -0,0 +1,173 @@
+#
+# test_agentgroup.py - checks the incrementally updated group aggregates
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Checks Group's cached worth, gsize, nslow and bias sums (and the pay
+computed from them) against a full recompute, with cfg._debug_group_cache
+on, for both the bias and non-bias pay paths.
+
+Usage: python test_agentgroup.py
+"""
+
+import random
+import unittest
+import numpy as np
+
+from configuration import Configuration
+from db_logger import NullLogger
+from graph import GraphManager
+from simulation import simulation
+from agentgroup import Agent, Group
+
+
+class GroupCacheTest(unittest.TestCase):
+  def setUp(self):
+    random.seed(4)
+    self.saved_dblog = Configuration._dblog
+
+  def tearDown(self):
+    Configuration._dblog = self.saved_dblog
+    Agent.agentid = 0
+
+  def makecfg(self, bias):
+    cfg = Configuration()
+    cfg.bias = bias
+    cfg._debug_group_cache = True
+    cfg._verbose = 0
+    return cfg
+
+  def makegroups(self, cfg, n=8):
+    """n agents with random skills, worth, slowness and biases, each in
+       a group of their own"""
+    agents = []
+    for i in range(n):
+      skills = np.zeros(cfg.nskills, dtype='int')
+      skills[random.randrange(cfg.nskills)] = 1
+      a = Agent(cfg, skills=skills, aid=i)
+      a.worth = random.randint(0, 5)
+      a.slow = random.random() < 0.3
+      agents.append(a)
+    for a in agents:
+      a.bias = dict((b.id, random.triangular(0.5, 2.0, 1.0))
+                    for b in agents if b is not a)
+    groups = []
+    for a in agents:
+      g = Group(a.id, cfg)
+      g.addfirst(a)
+      groups.append(g)
+    return agents, groups
+
+  def check(self, cfg, groups):
+    """Check every group's cache, skills and pay against its members"""
+    for g in groups:
+      g.checkcache()
+      members = g.agents
+      skills = sum((a.skills for a in members), np.zeros(cfg.nskills, dtype='int'))
+      self.assertEqual(list(g.skills), list(skills))
+      if not members:
+        self.assertEqual(g.nowpay, 0)
+        continue
+      pay = cfg.task(skills)
+      n = len(members)
+      if cfg.bias:
+        # Mean over members of each one's pay weighted by their bias
+        expected = sum(pay/n*sum(a.bias.get(m.id, 1.0) for m in members)/n
+                       for a in members)/n
+      else:
+        expected = pay/n
+      self.assertAlmostEqual(g.nowpay, expected)
+
+  def operations(self, cfg):
+    agents, groups = self.makegroups(cfg)
+    self.check(cfg, groups)
+    # Add: agents join other groups one at a time
+    for a, g in [(1, 0), (2, 0), (3, 0), (5, 4), (6, 4), (7, 4)]:
+      agents[a].switchgroup(groups[g])
+      self.check(cfg, groups)
+    # Remove: a member leaves for an empty group
+    agents[2].switchgroup(groups[2])
+    self.check(cfg, groups)
+    # Biases change; recalc rebuilds the cache
+    for a in agents:
+      for k in a.bias:
+        a.bias[k] *= 1.5
+    for g in groups:
+      g.recalc()
+    self.check(cfg, groups)
+    # Merge: every member of group 4 moves to group 0 (as in considermerge)
+    while groups[4].agents:
+      groups[4].agents[-1].switchgroup(groups[0])
+    self.check(cfg, groups)
+    self.assertEqual(groups[0].gsize, 7)
+    # Expel: members voted out go back to their own (empty) groups
+    for a in (5, 1):
+      agents[a].switchgroup(groups[a])
+      self.check(cfg, groups)
+    # Remove everyone from a group
+    for a in list(groups[0].agents):
+      groups[0].remove(a)
+    self.check(cfg, groups)
+    self.assertEqual((groups[0].gsize, groups[0].biastotal), (0, 0.0))
+
+  def test_operations_no_bias(self):
+    self.operations(self.makecfg(bias=False))
+
+  def test_operations_bias(self):
+    self.operations(self.makecfg(bias=True))
+
+  def test_debug_flag_catches_bad_cache(self):
+    cfg = self.makecfg(bias=True)
+    agents, groups = self.makegroups(cfg, n=3)
+    agents[1].switchgroup(groups[0])
+    groups[0].biassums[1] += 0.5
+    self.assertRaises(AssertionError, groups[0].update)
+    groups[0].recalc()
+    groups[0].nslow += 1
+    self.assertRaises(AssertionError, groups[0].update)
+
+  def runsim(self, **options):
+    """Run a whole simulation with the cache checked on every update"""
+    Configuration._dblog = NullLogger('')
+    cfg = self.makecfg(options.pop('bias'))
+    cfg.n = 16
+    cfg.delay_sim_agents = False
+    cfg._threaded_sim = False
+    cfg.lastratings = {}
+    for k, v in options.iteritems():
+      setattr(cfg, k, v)
+    Agent.agentid = 0
+    gm = GraphManager(cfg)
+    gm.setup()
+    sim = simulation()
+    sim.setup(gm.G, cfg)
+    sim.run()
+    for g in sim.groups:
+      g.checkcache()
+
+  def test_sim_merge_expel(self):
+    for seed in range(3):
+      random.seed(seed)
+      self.runsim(bias=False, groups_can_merge=True, expel_agents=True)
+
+  def test_sim_bias_expel(self):
+    for seed in range(3):
+      random.seed(seed)
+      self.runsim(bias=True, expel_agents=True)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,103 @@
+#
+# test_export.py - checks the Parquet/Arrow exporter
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Exports a small database and reads the files back.
+
+Tests that write files are skipped if pyarrow is not installed.
+
+Usage: python test_export.py
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import export
+from export import pa
+
+
+def read_file(filename):
+  """Return the columns of an exported file as a dictionary of lists"""
+  if filename.endswith('.parquet'):
+    import pyarrow.parquet as pq
+    table = pq.read_table(filename)
+  else:
+    table = pa.ipc.open_file(filename).read_all()
+  return table.to_pydict()
+
+
+class ExportTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.dbfile = os.path.join(self.tmpdir, 'simlog.db')
+    self.outdir = os.path.join(self.tmpdir, 'out')
+    conn = sqlite3.connect(self.dbfile)
+    conn.execute('''CREATE TABLE teamstatus (timestamp real, sessionid integer,
+        eventtype text, simnum integer, agentid integer)''')
+    # Logged out of agentid order, and interleaved between sims
+    rows = [(1.0, 1, 'apply', 0, 3), (2.0, 1, 'apply', 1, 2),
+            (3.0, 1, 'join', 0, 1), (4.0, 1, 'join', 1, 0),
+            (5.0, 1, 'simend', 0, 2)]
+    conn.executemany('INSERT INTO teamstatus VALUES (?,?,?,?,?)', rows)
+    conn.execute('''CREATE TABLE tfdata (timestamp real, sessionid integer,
+        simnum integer, colname text, nvalue real, tvalue text)''')
+    conn.executemany('INSERT INTO tfdata VALUES (?,?,?,?,?,?)', [
+      (1.0, 1, 0, 'earnings', 2.5, ''), (1.0, 1, 0, 'graph', 0, 'random'),
+      (2.0, 1, 1, 'earnings', 3.5, '')])
+    conn.execute('''CREATE TABLE sweepdone (fingerprint text primary key,
+        sessionid integer) WITHOUT ROWID''')
+    conn.commit()
+    conn.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_table_order(self):
+    conn = sqlite3.connect(self.dbfile)
+    self.assertEqual(export.table_order(conn, 'teamstatus', ['sessionid', 'simnum']),
+                     ['sessionid', 'simnum', 'rowid'])
+    self.assertEqual(export.table_order(conn, 'sweepdone', ['sessionid']),
+                     ['sessionid'])
+    conn.close()
+
+  @unittest.skipIf(pa is None, "needs pyarrow")
+  def test_partitions_keep_logged_order(self):
+    for fmt, ext in sorted(export.FORMATS.items()):
+      export.export_db(self.dbfile, self.outdir, ['teamstatus'], fmt, chunk=2)
+      part = os.path.join(self.outdir, 'teamstatus', 'sessionid=1', 'simnum=0',
+                          'part-0'+ext)
+      data = read_file(part)
+      self.assertEqual(data['agentid'], [3, 1, 2])
+      self.assertEqual(data['eventtype'], ['apply', 'join', 'simend'])
+      self.assertNotIn('simnum', data)
+      shutil.rmtree(self.outdir)
+
+  @unittest.skipIf(pa is None, "needs pyarrow")
+  def test_tfdata_wide(self):
+    export.export_db(self.dbfile, self.outdir, ['tfdata'])
+    data = read_file(os.path.join(self.outdir, 'tfdata_wide', 'sessionid=1',
+                                  'part-0.parquet'))
+    self.assertEqual(data['simnum'], [0, 1])
+    self.assertEqual(data['earnings'], [2.5, 3.5])
+    self.assertEqual(data['graph'], ['random', None])
+
+
+if __name__ == '__main__':
+  unittest.main()
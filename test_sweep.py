@@ -0,0 +1,101 @@
+#
+# test_sweep.py - checks resuming and sharding of parameter sweeps
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Runs small sweeps of 4 configurations into a temporary database.
+
+Usage: python test_sweep.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from configuration import Configuration, MultiConfig
+from db_logger import DBLogger
+from sweep import SweepRunner, fingerprint
+
+
+class RecordingLogger(DBLogger):
+  """A DBLogger that remembers the configurations marked done"""
+  def __init__(self, *args, **kwargs):
+    DBLogger.__init__(self, *args, **kwargs)
+    self.finished = []
+
+  def log_sweepdone(self, fp, simnum):
+    self.finished.append(fp)
+    DBLogger.log_sweepdone(self, fp, simnum)
+
+
+class SweepTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.outfile = os.path.join(self.tmpdir, 'sweep.tsv')
+    self.dblog = RecordingLogger(os.path.join(self.tmpdir, 'simlog.db'))
+    self.dblog.start_batch_insert_thread()
+    Configuration._dblog = self.dblog
+    Configuration._verbose = 0
+
+  def tearDown(self):
+    self.dblog.close()
+    Configuration._dblog = None
+    shutil.rmtree(self.tmpdir)
+
+  def makeconfs(self, lastratings=True):
+    confs = list(MultiConfig().itersims())[:4]
+    for cfg in confs:
+      cfg.n = 12
+      cfg.delay_sim_agents = False
+      cfg._threaded_sim = False
+      if lastratings:
+        cfg.lastratings = {}
+    return confs
+
+  def runsweep(self, confs, workers=1, shard=None):
+    """Run a sweep, and return the fingerprints of the configs it ran"""
+    self.dblog.finished = []
+    SweepRunner(confs, self.outfile, workers, shard).run()
+    self.dblog.flush_inserts()
+    return self.dblog.finished
+
+  def test_rerun_skips_done(self):
+    confs = self.makeconfs()
+    fps = set(fingerprint(cfg) for cfg in confs)
+    self.assertEqual(len(fps), 4)
+    ran = self.runsweep(confs)
+    self.assertEqual(sorted(ran), sorted(fps))
+    self.assertEqual(self.dblog.get_sweepdone(), fps)
+    self.assertEqual(self.runsweep(self.makeconfs()), [])
+
+  def test_shards_cover_every_config_once(self):
+    confs = self.makeconfs()
+    fps = [fingerprint(cfg) for cfg in confs]
+    shard0 = self.runsweep(confs, workers=2, shard=(0, 2))
+    shard1 = self.runsweep(self.makeconfs(), workers=2, shard=(1, 2))
+    self.assertEqual(sorted(shard0 + shard1), sorted(fps))
+    self.assertEqual(self.runsweep(self.makeconfs(), workers=2), [])
+
+  def test_worker_error_is_raised(self):
+    # Without lastratings, every simulation fails in the worker; the real
+    # error must come out, not an AssertionError from the pool
+    confs = self.makeconfs(lastratings=False)
+    self.assertRaises(AttributeError, self.runsweep, confs, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+#
+# test_teamdelta.py - checks that 'delta' team status logging is lossless
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Runs a multi-sim session (like simserver.py) logging team status in
+both 'full' and 'delta' mode, and checks that every sim rebuilt from
+'teamdelta' matches 'teamstatus'.
+
+Usage: python test_teamdelta.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from configuration import Configuration
+from db_logger import DBLogger
+from graph import GraphManager
+from simulation import simulation
+from agentgroup import Agent
+
+
+class BothModes(simulation):
+  """A simulation that logs team status in 'full' and 'delta' mode"""
+  def log_teamstatus(self, eventtype, groups, activeagent=-1):
+    cfg = self.cfg
+    gdata = [(g.id, [a.id for a in g.agents], g.nowpay) for g in groups if len(g.agents)]
+    self.log_teamdelta(eventtype, gdata, activeagent)
+    cfg._dblog.log_teamstatus(cfg.simnumber, cfg.iternum, eventtype, gdata, activeagent)
+
+
+class TeamDeltaTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.dblog = DBLogger(os.path.join(self.tmpdir, 'simlog.db'))
+    self.dblog.start_batch_insert_thread()
+    Configuration._dblog = self.dblog
+    Configuration._verbose = 0
+
+  def tearDown(self):
+    self.dblog.close()
+    Configuration._dblog = None
+    Agent.agentid = 0
+    shutil.rmtree(self.tmpdir)
+
+  def runsession(self, nsims, **options):
+    cfg = Configuration()
+    cfg.n = 12
+    cfg.delay_sim_agents = False
+    cfg._threaded_sim = False
+    cfg._log_teamstatus = True
+    cfg.lastratings = {}
+    for k, v in options.iteritems():
+      setattr(cfg, k, v)
+    Agent.agentid = 0
+    gm = GraphManager(cfg)
+    gm.setup()
+    sim = BothModes()
+    sim.setup(gm.G, cfg)
+    for i in range(nsims):
+      if i:
+        Agent.agentid = 0
+        sim.reset()
+        cfg.simnumber += 1
+      sim.run()
+    self.dblog.flush_inserts()
+    return cfg.simnumber
+
+  def check_session(self, nsims, **options):
+    lastsim = self.runsession(nsims, **options)
+    sessionid = self.dblog.sessionid
+    for simnum in range(lastsim-nsims+1, lastsim+1):
+      full = self.dblog.select_rows('teamstatus', 'sessionid=? AND simnum=?',
+                                    (sessionid, simnum))
+      delta = self.dblog.get_teamdelta(sessionid, simnum)
+      self.assertTrue(full)
+      key = lambda r: (r.eventtype, r.internum, r.activeagent,
+                       r.agentid, r.teamid, r.currentpay)
+      self.assertEqual(sorted(map(key, full)), sorted(map(key, delta)))
+
+  def test_keep_teams(self):
+    self.check_session(3, keep_teams=True)
+
+  def test_new_teams(self):
+    self.check_session(3, keep_teams=False)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,201 @@
+#
+# test_utils.py - checks the message framing used between server and clients
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Sends messages through socket pairs and FrameReaders, and checks that
+every codec decodes the messages the server sends to the same values.
+
+Codec tests are skipped if msgpack is not installed.
+
+Usage: python test_utils.py
+"""
+
+import socket
+import threading
+import unittest
+
+import utils
+from clientwaiter import ClientWaiter
+from utils import CODECS, JSON, set_codec, choose_codec, available_codecs
+from utils import send_message, receive_message, iter_frames, pack_message
+from utils import FrameReader, MessageSizeError, HEADER, FLAG_ABORT, CHUNK_SIZE
+
+
+def big_message():
+  """A message that takes several chunks"""
+  return {'nbrs':[[i, 'agent'+str(i)] for i in range(CHUNK_SIZE/4)]}
+
+
+class Unserializable(object):
+  pass
+
+
+class FramingTest(unittest.TestCase):
+  def setUp(self):
+    self.sock, self.peer = socket.socketpair()
+    self.maxsize = utils.MAX_MESSAGE_SIZE
+
+  def tearDown(self):
+    utils.MAX_MESSAGE_SIZE = self.maxsize
+    self.sock.close()
+    self.peer.close()
+
+  def send_in_thread(self, *messages):
+    """Send messages from another thread, as the socket buffer may fill"""
+    def send():
+      for message in messages:
+        try:
+          send_message(self.peer, message)
+        except TypeError:
+          pass
+    thread = threading.Thread(target=send)
+    thread.start()
+    return thread
+
+  def test_round_trip_chunked(self):
+    message = big_message()
+    self.assertTrue(len(pack_message(message)) > 2*CHUNK_SIZE)
+    thread = self.send_in_thread(message, ['small', 1])
+    self.assertEqual(receive_message(self.sock), message)
+    self.assertEqual(receive_message(self.sock), ['small', 1])
+    thread.join()
+
+  def test_reader_one_byte_at_a_time(self):
+    message = big_message()
+    data = pack_message(message) + pack_message(('push', 2), push=True)
+    reader = FrameReader()
+    received = []
+    for i in range(len(data)):
+      received.extend(reader.feed(data[i]))
+    self.assertEqual(received, [(message, False), ([u'push', 2], True)])
+
+  def test_abort_drops_partial_message(self):
+    frames = list(iter_frames(big_message()))
+    self.assertTrue(len(frames) > 1)
+    data = frames[0] + HEADER.pack(0, FLAG_ABORT) + pack_message('next')
+    self.assertEqual(FrameReader().feed(data), [(u'next', False)])
+    self.peer.sendall(data)
+    self.assertEqual(receive_message(self.sock), u'next')
+
+  def test_encode_error_sends_abort(self):
+    bad = ['x'*(2*CHUNK_SIZE), Unserializable()]
+    self.assertRaises(TypeError, pack_message, bad)
+    thread = self.send_in_thread(bad, 'next')
+    self.assertEqual(receive_message(self.sock), u'next')
+    thread.join()
+
+  def test_oversize(self):
+    utils.MAX_MESSAGE_SIZE = CHUNK_SIZE
+    self.assertRaises(MessageSizeError, pack_message, big_message())
+    utils.MAX_MESSAGE_SIZE = None
+    data = pack_message(big_message())
+    utils.MAX_MESSAGE_SIZE = CHUNK_SIZE
+    # Refused as soon as the header of a chunk past the limit arrives
+    self.assertRaises(MessageSizeError, FrameReader().feed, data[:2*CHUNK_SIZE])
+    self.peer.sendall(data[:2*CHUNK_SIZE])
+    self.assertRaises(MessageSizeError, receive_message, self.sock)
+
+  def test_blocking_receive_skips_push(self):
+    self.peer.sendall(pack_message(('ratings', []), push=True) +
+                      pack_message('answer'))
+    self.assertEqual(receive_message(self.sock), u'answer')
+
+
+# Messages in the shapes the server and clients actually send
+MESSAGES = [
+  ('updatestate', {'pay':12.5, 'myteam':(3, '4'), 'team':[1, 2, 5],
+                   'nbrs':[(1, 3, -1), (2, 2, 0)], 'teamdelta':([5], [4]),
+                   'nbrdelta':[(2, 2, 0)]}),
+  ('propose', [(3, 2, 1.25, [3, 6]), (4, 1, 2.0, [4])]),
+  ('updateglobalratings', {1:4.5, 2:3.0, 11:1.0}),
+  ('setconfig', {'n':16, 'nhumans':2, 'show_skills':True, 'bias':False,
+                 'task':u'ra\xefd', 'skills':[[1, 0], [0, 1]], 'seed':None,
+                 '_push_ratings':False}),
+  ('ratings', [[0, 1, 3, -1, 1432.25, u'apply']]),
+  ('getratings', {3:4, 7:1}),
+  ('publicgoods_conclusion', (10.5, ([0, 2], [1.0, 4.0]))),
+  ([(12, 3), (-1, -1, 0.0, 1.5)], None),
+  (u'exitsurvey', [(u'Q\u00e9', u'r\u00e9ponse'), (u'q2', 5)]),
+]
+
+def same(a, b):
+  """Equal, with the same types all the way down (unicode vs str, etc)"""
+  if type(a) != type(b):
+    return False
+  if isinstance(a, list):
+    return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+  if isinstance(a, dict):
+    return (sorted(a) == sorted(b) and 
+            all(same(k, k2) for k, k2 in zip(sorted(a), sorted(b))) and
+            all(same(a[k], b[k]) for k in a))
+  return a == b
+
+
+class CodecTest(unittest.TestCase):
+  def setUp(self):
+    self.sock, self.peer = socket.socketpair()
+
+  def tearDown(self):
+    self.sock.close()
+    self.peer.close()
+
+  @unittest.skipIf('msgpack' not in CODECS, "needs msgpack")
+  def test_msgpack_decodes_like_json(self):
+    msgpack = CODECS['msgpack']
+    for message in MESSAGES:
+      viajson = JSON.decode(''.join(JSON.iterencode(message)))
+      viamsgpack = msgpack.decode(''.join(msgpack.iterencode(message)))
+      self.assertTrue(same(viajson, viamsgpack), 
+                      "{0!r} != {1!r}".format(viajson, viamsgpack))
+
+  @unittest.skipIf('msgpack' not in CODECS, "needs msgpack")
+  def test_receiver_uses_senders_codec(self):
+    set_codec(self.peer, 'msgpack')
+    for message in MESSAGES:
+      send_message(self.peer, message)
+      received = receive_message(self.sock)
+      self.assertTrue(same(received, JSON.decode(pack_message(message)[HEADER.size:])))
+
+  def test_fallback_to_json(self):
+    self.assertEqual(available_codecs()[-1], 'json')
+    self.assertEqual(choose_codec(['zstd', 'json']), 'json')
+    self.assertEqual(choose_codec(['zstd']), 'json')
+    # Handshake with a client without msgpack (done as in frontend.py)
+    waiter = ClientWaiter.__new__(ClientWaiter)   # without waiting for clients
+    agreed = []
+    thread = threading.Thread(target=lambda: agreed.append(waiter.client_setup(self.sock, 0)))
+    thread.start()
+    command, (clientnum, codecs) = receive_message(self.peer)
+    self.assertEqual(codecs, available_codecs())
+    saved = dict(CODECS)
+    try:
+      CODECS.pop('msgpack', None)
+      codec = choose_codec(codecs)
+    finally:
+      CODECS.update(saved)
+    self.assertEqual(codec, 'json')
+    send_message(self.peer, ('codec', codec))
+    thread.join()
+    self.assertEqual(agreed, [u'json'])
+    set_codec(self.peer, codec)
+    send_message(self.peer, MESSAGES[0])
+    self.assertTrue(same(receive_message(self.sock), 
+                         JSON.decode(pack_message(MESSAGES[0])[HEADER.size:])))
+
+
+if __name__ == '__main__':
+  unittest.main()
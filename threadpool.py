@@ -0,0 +1,199 @@
+#
+# threadpool.py - bounded thread pool for running slow agents' actions
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Thread pool with futures, used when Configuration._threaded_sim is set.
+
+The simulation owns one ThreadPool and shares it through cfg._pool.
+Slow agents' decisions (humans, and delayed sim agents) are submitted to
+the pool, and the phase waits on the resulting futures.
+
+Phases can nest (a group considering applications is itself a pool task,
+and it fans out votes to its members), so a thread that waits on a future
+that has not started yet runs it itself instead of blocking. This way a
+bounded pool cannot deadlock.
+"""
+
+import sys
+import time
+import atexit
+import weakref
+import threading
+import Queue
+
+# Pools with live threads, stopped at exit (see ThreadPool.shutdown)
+_pools = weakref.WeakSet()
+
+
+class CancelledError(Exception):
+  """Raised by Future.result() if the task was cancelled"""
+  pass
+
+
+class Future(object):
+  """The pending result of a task submitted to a ThreadPool"""
+  PENDING, RUNNING, FINISHED, CANCELLED = range(4)
+
+  def __init__(self, fn, args, kwargs):
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs
+    self.state = Future.PENDING
+    self.value = None
+    self.exc_info = None
+    self.lock = threading.Lock()
+    self.finished = threading.Event()
+
+  def claim(self):
+    """Mark the task as running. Returns False if it was already
+       started or cancelled, True if the caller should run it."""
+    with self.lock:
+      if self.state != Future.PENDING:
+        return False
+      self.state = Future.RUNNING
+      return True
+
+  def run(self):
+    """Run a claimed task and store its result or exception"""
+    try:
+      self.value = self.fn(*self.args, **self.kwargs)
+    except BaseException:
+      self.exc_info = sys.exc_info()
+    self.state = Future.FINISHED
+    self.finished.set()
+
+  def cancel(self):
+    """Cancel the task if it has not started. Returns True if cancelled."""
+    with self.lock:
+      if self.state != Future.PENDING:
+        return self.state == Future.CANCELLED
+      self.state = Future.CANCELLED
+    self.finished.set()
+    return True
+
+  def cancelled(self):
+    return self.state == Future.CANCELLED
+
+  def done(self):
+    return self.finished.is_set()
+
+  def result(self):
+    """Wait for the task and return its result (or raise its exception).
+
+    If the task has not started yet, run it in this thread.
+    """
+    if self.claim():
+      self.run()
+    # Wait with a timeout so KeyboardInterrupt still gets through
+    while not self.finished.wait(1.0):
+      pass
+    if self.state == Future.CANCELLED:
+      raise CancelledError()
+    if self.exc_info is not None:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+    return self.value
+
+
+class ThreadPool(object):
+  """A bounded pool of worker threads.
+
+  Threads are started as needed, up to maxthreads, and exit after
+  idle_timeout seconds without work, so an unused pool costs nothing.
+  """
+  def __init__(self, maxthreads, idle_timeout=60.0):
+    self.maxthreads = maxthreads
+    self.idle_timeout = idle_timeout
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    self.nthreads = 0
+    self.nidle = 0
+    _pools.add(self)
+
+  def submit(self, fn, *args, **kwargs):
+    """Schedule fn(*args, **kwargs) and return a Future for its result"""
+    future = Future(fn, args, kwargs)
+    self.queue.put(future)
+    with self.lock:
+      if self.queue.qsize() > self.nidle and self.nthreads < self.maxthreads:
+        self.nthreads += 1
+        t = threading.Thread(target=self.worker)
+        t.daemon = True
+        t.start()
+    return future
+
+  def worker(self):
+    """Run tasks from the queue until idle for idle_timeout"""
+    Empty = Queue.Empty     # Module globals may be gone at interpreter exit
+    while True:
+      with self.lock:
+        self.nidle += 1
+      try:
+        future = self.queue.get(timeout=self.idle_timeout)
+      except Empty:
+        with self.lock:
+          self.nidle -= 1
+          if self.queue.empty():
+            self.nthreads -= 1
+            return
+        continue
+      with self.lock:
+        self.nidle -= 1
+        if future is None:
+          self.nthreads -= 1
+          return
+      if future.claim():
+        future.run()
+
+  def shutdown(self, timeout=1.0):
+    """Stop the worker threads once they finish their current tasks,
+       and wait up to timeout seconds for them to exit"""
+    with self.lock:
+      nthreads = self.nthreads
+    for i in xrange(nthreads):
+      self.queue.put(None)
+    deadline = time.time() + timeout
+    while self.nthreads and time.time() < deadline:
+      time.sleep(0.01)
+
+  def wait(self, futures, deadline=None, clock=time):
+    """Wait for all futures, and return a list of their results.
+
+    If deadline passes, tasks that have not started yet are cancelled, 
+    and their result is None. deadline is a clock.time() value; clock is 
+    the time module, or a clock from vclock.py.
+    """
+    results = []
+    for i, f in enumerate(futures):
+      if deadline:
+        if f.claim():
+          f.run()
+        f.finished.wait(max(0.0, deadline - clock.time()))
+        if clock.time() > deadline:
+          for later in futures[i:]:
+            later.cancel()
+      try:
+        results.append(f.result())
+      except CancelledError:
+        results.append(None)
+    return results
+
+
+@atexit.register
+def _shutdown_pools():
+  """Stop idle workers before the interpreter tears down module globals"""
+  for pool in list(_pools):
+    pool.shutdown()
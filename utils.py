@@ -12,21 +12,219 @@ This module provides basic TCP send/receive functionality
 
 import json
 import struct
+import weakref
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 BUFFER_SIZE = 4096
 SERVER_PORT = 1234
 
+# Messages are sent as a series of chunks. Each chunk has a header with its
+# length and a flags byte; the last chunk of a message has FLAG_FINAL set.
+# A chunk with FLAG_ABORT tells the receiver to drop the partial message.
+# FLAG_PUSH marks a message the sender pushed on its own, which is not the
+# answer to a request (see clientmux.Channel.onpush).
+# The high 4 bits of the flags give the codec of the message.
+HEADER = struct.Struct('!IB')
+FLAG_FINAL = 0x01
+FLAG_ABORT = 0x02
+FLAG_PUSH = 0x04
+CODEC_SHIFT = 4
+CHUNK_SIZE = 65536
+MAX_MESSAGE_SIZE = 64*1024*1024   # Refuse larger messages; None for no limit
+
 DEBUG_COMM = False
 
-def send_message(connection, message):
+
+class MessageSizeError(IOError):
+  """A message is larger than MAX_MESSAGE_SIZE"""
+  pass
+
+# Errors from encoding a message partway through; the frames already sent
+# must be followed by an ABORT frame. (Not socket.error, which is also an
+# IOError, as nothing more can be sent on a broken connection.)
+ENCODE_ERRORS = (MessageSizeError, TypeError, ValueError)
+
+
+class JSONCodec(object):
+  """Encodes messages as JSON; always available"""
+  name = 'json'
+  number = 0
+  
+  def iterencode(self, message):
+    return json.JSONEncoder().iterencode(message)
+  
+  def decode(self, msg_string):
+    return json.loads(msg_string)
+
+
+def _jsonkeys(pairs):
+  """Make dictionary keys strings, as they would be after a JSON round trip"""
+  return {(k if isinstance(k, unicode) else unicode(json.dumps(k))): v 
+          for k, v in pairs}
+
+class MsgpackCodec(object):
+  """Encodes messages with msgpack (if installed); smaller and faster.
+     Decoded messages are the same as with JSON."""
+  name = 'msgpack'
+  number = 1
+  
+  def iterencode(self, message):
+    return [msgpack.packb(message, use_bin_type=False)]
+  
+  def decode(self, msg_string):
+    return msgpack.unpackb(msg_string, raw=False, object_pairs_hook=_jsonkeys)
+
+
+CODECS = {}             # name -> codec
+CODEC_NUMBERS = {}      # number (in frame flags) -> codec
+CODEC_PREFERENCE = ['msgpack', 'json']
+
+def register_codec(codec):
+  CODECS[codec.name] = codec
+  CODEC_NUMBERS[codec.number] = codec
+
+JSON = JSONCodec()
+register_codec(JSON)
+# msgpack's pure-Python fallback is slower than json, so only use its C version
+if msgpack is not None and not msgpack.Packer.__module__.endswith('fallback'):
+  register_codec(MsgpackCodec())
+
+def available_codecs():
+  """Names of the installed codecs, most preferred first"""
+  return [name for name in CODEC_PREFERENCE if name in CODECS]
+
+def choose_codec(offered):
+  """Pick the first codec in offered that is installed here"""
+  for name in offered:
+    if name in CODECS:
+      return name
+  return JSON.name
+
+# Codec used to send on each connection; connections not in here use JSON
+_conncodecs = weakref.WeakKeyDictionary()
+
+def set_codec(connection, name):
+  """Send future messages on connection with the named codec"""
+  _conncodecs[connection] = CODECS[name]
+
+def get_codec(connection):
+  return _conncodecs.get(connection, JSON)
+
+def is_serializable(value):
+  """Can value be sent in a message? (with any codec)"""
+  if value is None or isinstance(value, (bool, int, long, float, basestring)):
+    return True
+  if isinstance(value, (list, tuple)):
+    return all(is_serializable(v) for v in value)
+  if isinstance(value, dict):
+    return all(isinstance(k, (basestring, int, long, float)) and 
+               is_serializable(v) for k, v in value.iteritems())
+  return False
+
+def iter_frames(message, codec=JSON, push=False):
+  """Encode a message, and yield it as a series of framed chunks.
+  
+  With JSON, the message is encoded incrementally, so a large message 
+  is never held in memory as one string.
+  If push is set, the chunks are marked with FLAG_PUSH.
+  
+  Raises:
+    MessageSizeError if the message is larger than MAX_MESSAGE_SIZE
+  """
+  cflags = codec.number << CODEC_SHIFT
+  if push:
+    cflags |= FLAG_PUSH
+  pending = []
+  npending = 0
+  total = 0
+  for piece in codec.iterencode(message):
+    pending.append(piece)
+    npending += len(piece)
+    total += len(piece)
+    if MAX_MESSAGE_SIZE is not None and total > MAX_MESSAGE_SIZE:
+      raise MessageSizeError("Message too large to send!")
+    if npending > CHUNK_SIZE:
+      data = ''.join(pending)
+      # Keep the remainder, so the last chunk (sent with FLAG_FINAL) 
+      # is never empty
+      i = 0
+      while len(data) - i > CHUNK_SIZE:
+        yield HEADER.pack(CHUNK_SIZE, cflags) + data[i:i+CHUNK_SIZE]
+        i += CHUNK_SIZE
+      pending, npending = [data[i:]], len(data) - i
+  data = ''.join(pending)
+  yield HEADER.pack(len(data), cflags | FLAG_FINAL) + data
+
+def pack_message(message, codec=JSON, push=False):
+  """Encode a message as one string of framed chunks"""
+  return ''.join(iter_frames(message, codec, push))
+
+def decode_message(msg_string, flags=0):
+  """Unpack the body of a message, with the codec given in its flags"""
+  try:
+    data = CODEC_NUMBERS[flags >> CODEC_SHIFT].decode(msg_string)
+  except ValueError:
+    print "Decoding error on message:", repr(msg_string)
+    print "message length:", len(msg_string)
+    raise
+  if DEBUG_COMM:
+    print "Received", msg_string
+  return data
+
+def check_size(size):
+  if MAX_MESSAGE_SIZE is not None and size > MAX_MESSAGE_SIZE:
+    raise MessageSizeError("Message too large to receive!")
+
+
+class FrameReader(object):
+  """Reassembles messages from data received in arbitrary pieces.
+  
+  Used to read from non-blocking sockets (see clientmux.py).
+  """
+  def __init__(self):
+    self.buf = bytearray()      # Received data not yet parsed
+    self.body = bytearray()     # Chunks of the message being received
+
+  def feed(self, data):
+    """Add received data, and return a list of (message, pushed) pairs for
+       any completed messages; pushed is True if it had FLAG_PUSH"""
+    buf = self.buf
+    buf += data
+    messages = []
+    start = 0
+    while len(buf) - start >= HEADER.size:
+      length, flags = HEADER.unpack_from(buf, start)
+      end = start + HEADER.size + length
+      check_size(len(self.body) + length)   # before waiting for the body
+      if len(buf) < end:
+        break
+      self.body += buf[start+HEADER.size:end]
+      start = end
+      if flags & FLAG_ABORT:
+        self.body = bytearray()
+      elif flags & FLAG_FINAL:
+        messages.append( (decode_message(str(self.body), flags), 
+                          bool(flags & FLAG_PUSH)) )
+        self.body = bytearray()
+    del buf[:start]
+    return messages
+
+
+def send_message(connection, message, push=False):
   """Sends a message to a connection.
   
-  First sends an int with length of the message, 
-  then sends the message in string format with JSON.
+  Encodes the message with the connection's codec (JSON unless set with
+  set_codec), and sends it in chunks, each preceded by a header with the 
+  chunk length and flags (see iter_frames).
   
   Args:
-    connection: a socket connection object
-    message: any JSON-compatible object smaller than BUFFER_SIZE
+    connection: a socket connection object, or a clientmux.Channel
+    message: any object that is_serializable, up to MAX_MESSAGE_SIZE
+    push: True if the message is not the answer to a request
   
   Returns:
     True if successful
@@ -37,63 +235,79 @@ def send_message(connection, message):
   
   if DEBUG_COMM:
     print "Sending", message
-  msg_string = json.dumps(message)
-  if len(msg_string) >= BUFFER_SIZE:
-    raise IOError("Message too large to send!")
-    #return False
-  connection.sendall(struct.pack('!I', len(msg_string)))
-  connection.sendall(msg_string)
+  if hasattr(connection, 'request'):    # Multiplexed; see clientmux.py
+    return connection.send_message(message, push)
+  sent = False
+  try:
+    for frame in iter_frames(message, get_codec(connection), push):
+      connection.sendall(frame)
+      sent = True
+  except ENCODE_ERRORS:
+    if sent:    # Part of the message is out; tell the receiver to drop it
+      connection.sendall(HEADER.pack(0, FLAG_ABORT))
+    raise
   return True
 
 ## http://stupidpythonideas.blogspot.com/2013/05/sockets-are-byte-streams-not-message.html
-def recvall(sock, count):
-  """Receive a specified number of bytes from a socket
+def recvall(sock, buf, start, count):
+  """Receive a specified number of bytes from a socket into a buffer
   
   Not intended for use outside of this module
   
   Args:
     sock: a socket
+    buf: a bytearray with room for count bytes after start
+    start: where in buf to put the data
     count: number of bytes to receive
     
   Returns:
-    None if receive fails
-    a buffer of size [count] if successful
+    False if receive fails (the connection was closed)
+    True if successful
   """
-  buf = b''
+  view = memoryview(buf)[start:start+count]
   while count:
-    newbuf = sock.recv(count)
-    if not newbuf: return None
-    buf += newbuf
-    count -= len(newbuf)
-  return buf
+    nbytes = sock.recv_into(view, count)
+    if not nbytes: return False
+    view = view[nbytes:]
+    count -= nbytes
+  return True
 
 def receive_message(connection):
   """Receives a message from a connection
   
-  First receives an int with length of the message,
-  then receives the message and unpacks it with JSON.
+  Receives chunks until the final one, and decodes the message with the
+  codec the sender used. Pushed messages are skipped; only a 
+  clientmux.Channel can pass them on (see Channel.onpush).
   
   Args:
-    connection: a socket connection object
+    connection: a socket connection object, or a clientmux.Channel
   
   Returns:
     a Python object received from the connection
   
   Raises:
-    ValueError: could not load the object with JSON  
+    IOError: the connection was closed, or the message is too large
+    ValueError: could not decode the message
   """
-  msg_len_raw = recvall(connection, 4)
-  msg_len = struct.unpack('!I', msg_len_raw)[0]
-  msg_string = recvall(connection, msg_len)
-  try:
-    data = json.loads(msg_string)
-  except ValueError:
-    print "JSON error on message:", msg_string
-    print "message length:", msg_len
-    raise
-  if DEBUG_COMM:
-    print "Received", msg_string
-  return data
+  if hasattr(connection, 'request'):
+    return connection.receive_message()
+  header = bytearray(HEADER.size)
+  body = bytearray()
+  while True:
+    if not recvall(connection, header, 0, HEADER.size):
+      raise IOError("Connection closed")
+    length, flags = HEADER.unpack_from(header)
+    start = len(body)
+    check_size(start + length)
+    body.extend(bytearray(length))
+    if not recvall(connection, body, start, length):
+      raise IOError("Connection closed")
+    if flags & FLAG_ABORT:
+      body = bytearray()
+    elif flags & FLAG_FINAL:
+      if not flags & FLAG_PUSH:
+        return decode_message(str(body), flags)
+      body = bytearray()
 
 def send_and_receive(connection, message):
   """Convenience function to send a message, and receive a response.
@@ -103,4 +317,4 @@ def send_and_receive(connection, message):
     return receive_message(connection)
   """
   send_message(connection, message)
-  return receive_message(connection)
\ No newline at end of file
+  return receive_message(connection)
@@ -0,0 +1,98 @@
+#
+# vclock.py - real and simulated clocks for delayed sim agents
+#
+# Copyright (C) 2015  Nathan Dykhuis
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+"""Clocks used by the simulation for agent delays and timestamps.
+
+Sim agents with delay_sim_agents set wait to emulate human decision times.
+Normally that is a real time.sleep (RealClock). With
+Configuration._virtual_time set, the simulation uses a VirtualClock
+instead, which records each delay and advances a simulated time, so a
+rehearsal with delays runs at full speed but logs the same timings.
+
+Agents that would run in parallel each get a lane (their agent ID):
+a delay moves only that agent's lane forward, and at the end of a phase
+the simulation calls sync(), which advances the clock to the slowest lane,
+as if it had waited for every agent to finish.
+"""
+
+import time
+import threading
+
+
+class RealClock(object):
+  """Wall clock time; sleep() really sleeps"""
+  def time(self, lane=None):
+    return time.time()
+
+  def sleep(self, secs, lane=None, label=None):
+    time.sleep(secs)
+
+  def sync(self):
+    pass
+
+  def drain(self):
+    return []
+
+
+class VirtualClock(object):
+  """Simulated clock; sleep() moves simulated time forward instantly.
+
+  Attributes:
+    now: current simulated time, in seconds since the epoch
+    parallel: if True, delays in different lanes overlap until sync();
+              if False, every delay adds to now (like an unthreaded sim)
+    lanes: lane -> simulated time at the end of that lane's last delay
+    events: list of (lane, label, start, end) delays not yet drained
+  """
+  def __init__(self, start=None, parallel=True):
+    if start is None:
+      start = time.time()
+    self.now = start
+    self.parallel = parallel
+    self.lanes = {}
+    self.events = []
+    self.lock = threading.Lock()
+
+  def time(self, lane=None):
+    """Current simulated time, as seen by lane"""
+    with self.lock:
+      return self.lanes.get(lane, self.now)
+
+  def sleep(self, secs, lane=None, label=None):
+    """Record a delay of secs for lane, without waiting"""
+    with self.lock:
+      if self.parallel and lane is not None:
+        start = self.lanes.get(lane, self.now)
+        self.lanes[lane] = start + secs
+      else:
+        start = self.now
+        self.now += secs
+      self.events.append((lane, label, start, start + secs))
+
+  def sync(self):
+    """Phase barrier: advance to the end of the slowest lane"""
+    with self.lock:
+      if self.lanes:
+        self.now = max(self.now, max(self.lanes.itervalues()))
+        self.lanes = {}
+
+  def drain(self):
+    """Return and clear the recorded (lane, label, start, end) delays"""
+    with self.lock:
+      events, self.events = self.events, []
+    return events